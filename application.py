@@ -3,16 +3,44 @@ import supervisor
 from train_predictor import Direction
 import gc
 from buttons import button_down_depressed, button_up_depressed
+from poll_scheduler import FixedPollScheduler
+from warning_timeline import WarningTimeline
+from loop_profiler import NULL_PROFILER
 
 NUM_TRAINS_TO_FETCH=3
+
+# poll_scheduler decides how often we ask the train predictor for updated
+# trains, see poll_scheduler.py. If it isn't provided then we poll every five
+# seconds.
+# 
+# train_fetcher is an optional BackgroundFetcher (see background_fetcher.py)
+# used when we have threads available. When it is provided trains are fetched
+# on a worker thread instead of in the main loop (and the poll_scheduler passed
+# to the BackgroundFetcher is used instead).
+#
+# flushLogsFcn is called at times when it is fine for the main loop to wait on
+# a network request, to send any buffered log records (see
+# logging_extra.BufferedAIOHandler.flush).
+#
+# dumpCrashLogFcn is called right before we reload the board to save the last
+# few log records so they can be logged again after the reload (see
+# logging_extra.CrashLog.dump).
+#
+# profiler is an optional LoopProfiler used to time each phase of the main
+# loop, see loop_profiler.py. If it isn't provided nothing is timed.
 class ApplicationDependencies:
-    def __init__(self, matrix_portal, train_predictor, time_conversion, display, nowFcn, logger):
+    def __init__(self, matrix_portal, train_predictor, time_conversion, display, nowFcn, logger, poll_scheduler=None, train_fetcher=None, flushLogsFcn=None, dumpCrashLogFcn=None, profiler=None):
         self.matrix_portal  = matrix_portal 
         self.train_predictor  = train_predictor 
         self.time_conversion  = time_conversion 
         self.display = display
         self.nowFcn = nowFcn
         self.logger = logger
+        self.poll_scheduler = poll_scheduler
+        self.train_fetcher = train_fetcher
+        self.flushLogsFcn = flushLogsFcn
+        self.dumpCrashLogFcn = dumpCrashLogFcn
+        self.profiler = profiler
 
 class Application:
     def __init__(self, dependencies: ApplicationDependencies ):
@@ -22,9 +50,27 @@ class Application:
         self._display = dependencies.display
         self._nowFcn = dependencies.nowFcn
         self._logger = dependencies.logger
+        self._flushLogsFcn = dependencies.flushLogsFcn
+        self._dumpCrashLogFcn = dependencies.dumpCrashLogFcn
+
+        self._profiler = dependencies.profiler
+        if self._profiler is None:
+            self._profiler = NULL_PROFILER
+
+        self._poll_scheduler = dependencies.poll_scheduler
+        if self._poll_scheduler is None:
+            self._poll_scheduler = FixedPollScheduler(5)
 
-        self._last_train_check = None
+        self._train_fetcher = dependencies.train_fetcher
+        self._train_generation = 0
+        self._first_fresh_fetch = 0
+
+        self._next_train_check = None
         self._trains = [None] * NUM_TRAINS_TO_FETCH
+        self._arrival_times_stale = True
+        self._next_arrival_times_change = None
+        self._timeline = WarningTimeline()
+        self._train_arrived_fcn = self._train_arrived
 
         self._last_nightly_tasks_run = time.monotonic()
 
@@ -44,6 +90,30 @@ class Application:
         self._try_method(self._display.initialize)
         self._try_method(self._sync_clock)
 
+        # The train predictor needs the clock to be set to know which service
+        # day to fetch the schedule for.
+        self._try_method(self._train_predictor.refresh_schedule)
+        self._flush_logs()
+
+    # _flush_logs sends any log records that have been buffered up. We only do
+    # this right after we make other network requests, the main loop has
+    # already been held up anyway.
+    def _flush_logs(self):
+        if self._flushLogsFcn is None:
+            return
+        try:
+            self._flushLogsFcn()
+        except Exception as e:
+            print(f"Failed to flush logs: {e}")
+
+    def _dump_crash_log(self):
+        if self._dumpCrashLogFcn is None:
+            return
+        try:
+            self._dumpCrashLogFcn()
+        except Exception as e:
+            print(f"Failed to save crash log: {e}")
+
     # _try_method is passed a function to call along with arguments. It will
     # call that function, if the function errors out then it will log the
     # exception and then retry after a short delay. If after a few retries it
@@ -62,7 +132,7 @@ class Application:
             except Exception as e:
                 self._logger.exception(e)
             time.sleep(retry_delay)
-            self._logger.debug(f"making additional attempt {attempt_count}")
+            self._logger.debug("making additional attempt %d", attempt_count)
 
         try:
             self._display.render_error()
@@ -75,6 +145,12 @@ class Application:
             # render_error() errors out we can still try to restart the board in
             # an attempt to fix the issue.
             pass
+
+        # Make sure the errors make it to adafruit.io before we restart. In
+        # case they don't (if the WiFi is down for example) we also save them
+        # to be logged again after the restart.
+        self._dump_crash_log()
+        self._flush_logs()
         
         time.sleep(restart_delay)
         supervisor.reload()
@@ -92,31 +168,89 @@ class Application:
         self._logger.debug("running nightly tasks")
         self._last_nightly_tasks_run = time.monotonic()
         self._try_method(self._sync_clock)
-        self._train_predictor.clear_cache()
-        gc.collect()
+        # Syncing the clock can move the current time, so the arrival times
+        # might not change when we expected.
+        self._arrival_times_stale = True
+        self._call_train_predictor(self._train_predictor.clear_cache)
+        with self._profiler.phase("gc"):
+            gc.collect()
+        self._try_method(self._call_train_predictor, [self._train_predictor.refresh_schedule])
+
+    # _call_train_predictor calls a TrainPredictor method and returns the
+    # result. If we are using a BackgroundFetcher the method is run on its
+    # worker thread (and we wait for it) since TrainPredictor isn't thread
+    # safe.
+    def _call_train_predictor(self, method, *args):
+        if self._train_fetcher is not None:
+            return self._train_fetcher.submit(method, *args).result()
+        return method(*args)
 
     # _sync_clock makes a call out to the adafruit ntp servers to update the time on the board.
     def _sync_clock(self):
         self._logger.debug("getting network time")
         self._matrix_portal.network.get_local_time(location="America/New_York")
-        self._logger.debug(f"current time set to {self._nowFcn()}")
+        self._logger.debug("current time set to %s", self._nowFcn())
 
     def _fetch_next_trains(self):
-        # We generally want to make requests to update the train arrival times
-        # fairly frequently as when the train is getting close to the Children's
-        # Museum of Franklin we want to make sure we have an accurate estimate
-        # of arrival time to show the train animation at the correct time. We do
-        # still want to make sure we aren't spamming the MBTA API too much. So
-        # we will do our own rate limiting of no more than one request every
-        # five seconds. When you use a free API key the MBTA API has a rate
-        # limit of 1000 requests a minute. So a request every 5 seconds
-        # shouldn't give us any issues.
-        if self._last_train_check is None or time.monotonic() > self._last_train_check + 5:
+        # When the train is getting close to the Children's Museum of Franklin
+        # we want to make requests to update the train arrival times fairly
+        # frequently to make sure we have an accurate estimate of arrival time
+        # to show the train animation at the correct time. The rest of the
+        # time there is no need to ask as often. The poll scheduler decides
+        # when we make the next request based on the trains we know about. It
+        # also makes sure we aren't spamming the MBTA API too much. When you
+        # use a free API key the MBTA API has a rate limit of 1000 requests a
+        # minute. So a request every 5 seconds shouldn't give us any issues.
+        if self._next_train_check is None or time.monotonic() > self._next_train_check:
             self._logger.debug("fetching trains")
-            self._trains = self._try_method(self._train_predictor.next_trains, [NUM_TRAINS_TO_FETCH])
-            self._last_train_check  = time.monotonic()
-            self._logger.debug(f"trains: {self._trains}")
-            
+            with self._profiler.phase("fetch"):
+                self._trains = self._try_method(self._train_predictor.next_trains, [NUM_TRAINS_TO_FETCH])
+            self._timeline = self._try_method(self._train_predictor.warning_timeline, [self._trains])
+            self._arrival_times_stale = True
+            delay = self._poll_scheduler.next_poll_delay(self._trains, self._nowFcn())
+            self._next_train_check = time.monotonic() + delay
+            self._logger.debug("trains: %s, next check in %ss", self._trains, delay)
+            self._flush_logs()
+
+    # _check_train_fetcher is the same as _fetch_next_trains when we are using
+    # a BackgroundFetcher. It never waits for the network, it just picks up the
+    # latest trains that the BackgroundFetcher has published. We don't switch
+    # to new trains while we are showing the train warning, same as we don't
+    # fetch new trains while the warning is showing.
+    #
+    # We also skip snapshots from fetches that started before the last train
+    # arrived. Those were fetched before the train predictor was told the train
+    # arrived so they still have the warning for that train, and adopting one
+    # would show the warning and mark the train arrived all over again.
+    def _check_train_fetcher(self):
+        warning_active = self._timeline.warning_active
+        self._train_fetcher.poll(paused=warning_active)
+        snapshot = self._train_fetcher.snapshot
+        if snapshot.fetch_number < self._first_fresh_fetch:
+            return
+        if snapshot.generation != self._train_generation and not warning_active:
+            self._trains = snapshot.trains
+            self._timeline = snapshot.timeline
+            self._train_generation = snapshot.generation
+            self._arrival_times_stale = True
+            self._flush_logs()
+
+    # _train_arrived is called by the warning timeline once the warning for a
+    # train has ended.
+    def _train_arrived(self, train):
+        if self._train_fetcher is not None:
+            self._train_fetcher.submit(self._train_predictor.mark_train_arrived, train)
+            self._first_fresh_fetch = self._train_fetcher.fetch_count + 1
+        else:
+            self._try_method(self._train_predictor.mark_train_arrived, [train])
+        self._logger.info("train arrived '%s'", train.schedule_id)
+
+        # Get the next trains right away rather than waiting for the poll
+        # scheduler since the train we were waiting on is gone.
+        self._next_train_check = None
+        if self._train_fetcher is not None:
+            self._train_fetcher.fetch_now()
+
     def _run_loop(self):
         # _run_loop is the main event loop for the board.
         # 
@@ -144,9 +278,11 @@ class Application:
         # https://github.com/adafruit/Adafruit_CircuitPython_Requests/issues/134#issuecomment-3415845378 
         # 
         # So instead what we will do is just wait to send HTTP requests at
-        # opportune times. We make sure we wait for the text to totally scroll
-        # across the screen or any train animation to finish running before we
-        # make a new request for train data. Once we get the response for train
+        # opportune times. We make sure we wait for any train animation to
+        # finish running before we make a new request for train data. The
+        # scrolling text is moved one step at a time each time through the loop
+        # (see _scroll_text) so we don't wait for it, the text just pauses
+        # while we wait for the response. Once we get the response for train
         # data we can resume the normal loop.
         while True:
             # First look for user input from buttons.
@@ -157,29 +293,73 @@ class Application:
             # state of the button at this point in time. This means that you
             # must be pressing the button when we check for the button press or
             # else the press won't be registered.
-            if button_up_depressed():
-                self._try_method(self._display.render_train, [Direction.IN_BOUND])
-                continue
-            if button_down_depressed():
-                self._try_method(self._display.render_train, [Direction.OUT_BOUND])
-                continue              
+            #
+            # The train animation is played one frame at a time each time
+            # through the loop (see _play_train) so once an animation starts we
+            # let it finish before we look at the buttons again.
+            if not self._display.train_playing:
+                if button_up_depressed():
+                    self._try_method(self._display.start_train, [Direction.IN_BOUND, time.monotonic()])
+                elif button_down_depressed():
+                    self._try_method(self._display.start_train, [Direction.OUT_BOUND, time.monotonic()])
             
             # Now move on to regular looping behavior.
+            # 
+            # If we know is a train is approaching and we are showing the train
+            # animation warning we want to keep playing that warning until the
+            # train finishes going by. No need to make a call out to the MBTA to
+            # update train predictions until the train finishes going by. We
+            # also don't want to make a request in the middle of a train
+            # animation since the animation would freeze until the response
+            # comes back.
             self._nightly_tasks()
-            self._try_method(self._fetch_next_trains)
-            train_warning = self._try_method(self._train_predictor.train_passing_warning, [self._trains[0]])
-            if train_warning is not None:
-                # If we know is a train is approaching and we are showing the
-                # train animation warning we want to keep playing that warning
-                # until the train finishes going by. No need to make a call out
-                # to the MBTA to update train predictions until the train
-                # finishes going by.
-                while not train_warning.should_stop():
-                    self._try_method(self._display.render_train, [train_warning.direction])
-                self._try_method(self._train_predictor.mark_train_arrived, [self._trains[0]])
-                self._logger.info(f"train arrived '{self._trains[0].schedule_id}'")
+            if self._train_fetcher is not None:
+                self._try_method(self._check_train_fetcher)
+            elif not self._timeline.warning_active and not self._display.train_playing:
+                self._try_method(self._fetch_next_trains)
+
+            # The warning timeline was computed when we fetched the trains, so
+            # all we need to do here is check if the next event is due. See
+            # WarningTimeline.
+            self._timeline.update(time.monotonic(), self._train_arrived_fcn)
+            if not self._display.train_playing and self._timeline.warning_active:
+                self._try_method(self._display.start_train, [self._timeline.warning_direction, time.monotonic()])
+
+            if self._display.train_playing:
+                self._try_method(self._play_train)
+                self._arrival_times_stale = True
             else:
-                self._try_method(self._display.render_arrival_times, [self._trains])
-                self._try_method(self._display.scroll_text)
+                self._try_method(self._scroll_text)
+
+            self._profiler.summarize_if_due()
+
+    # _play_train waits until the next frame of the train animation is due and
+    # shows it. We only wait for a single frame so that we get back to the top
+    # of the loop between every frame.
+    def _play_train(self):
+        delay = self._display.train_frame_deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        with self._profiler.phase("train"):
+            self._display.tick_train(time.monotonic())
 
+    # _scroll_text is the same as _play_train but for the scrolling title. The
+    # arrival times are only rendered when they change, either because we have
+    # new trains (or were showing the train animation) or because one of the
+    # times is due to tick over to the next minute, see
+    # Display.render_arrival_times.
+    def _scroll_text(self):
+        now = time.monotonic()
+        if self._arrival_times_stale or (self._next_arrival_times_change is not None and now >= self._next_arrival_times_change):
+            self._arrival_times_stale = False
+            with self._profiler.phase("render"):
+                next_change = self._display.render_arrival_times(self._trains)
+            self._next_arrival_times_change = None if next_change is None else now + next_change
 
+        deadline = self._display.text_scroll_deadline
+        if deadline is not None:
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        with self._profiler.phase("scroll"):
+            self._display.tick_text(time.monotonic())
@@ -0,0 +1,298 @@
+import asyncio
+import gc
+import time
+from train_predictor import Direction
+from poll_scheduler import FixedPollScheduler
+from warning_timeline import WarningTimeline
+from network_adapter import BlockingNetworkAdapter
+
+NUM_TRAINS_TO_FETCH=3
+
+# network_adapter is used for every call that makes a network request, see
+# network_adapter.py. If it isn't provided we use a BlockingNetworkAdapter.
+#
+# buttonUpFcn and buttonDownFcn return True while the up / down buttons are
+# pressed (see buttons.py), if they aren't provided the buttons are ignored.
+# reloadFcn is called to restart the board if something keeps failing, on the
+# board this is supervisor.reload.
+#
+# flushLogsFcn sends any buffered log records and dumpCrashLogFcn saves the
+# last few log records before a reload, see ApplicationDependencies.
+class AsyncApplicationDependencies:
+    def __init__(self, matrix_portal, train_predictor, display, nowFcn, logger, network_adapter=None, poll_scheduler=None, buttonUpFcn=None, buttonDownFcn=None, reloadFcn=None, monotonicFcn=time.monotonic, flushLogsFcn=None, dumpCrashLogFcn=None):
+        self.matrix_portal = matrix_portal
+        self.train_predictor = train_predictor
+        self.display = display
+        self.nowFcn = nowFcn
+        self.logger = logger
+        self.network_adapter = network_adapter
+        self.poll_scheduler = poll_scheduler
+        self.buttonUpFcn = buttonUpFcn
+        self.buttonDownFcn = buttonDownFcn
+        self.reloadFcn = reloadFcn
+        self.monotonicFcn = monotonicFcn
+        self.flushLogsFcn = flushLogsFcn
+        self.dumpCrashLogFcn = dumpCrashLogFcn
+
+# AsyncApplication does the same job as Application but each part of the main
+# loop is a separate asyncio task:
+#
+#  * _button_task checks the buttons.
+#  * _display_task scrolls the text and plays the train animation one step at
+#    a time.
+#  * _fetch_task fetches the next trains from the MBTA API.
+#  * _nightly_task runs the nightly tasks.
+#
+# The long comment in Application._run_loop explains why we can't just do this
+# on the board: the requests we make to the MBTA API block until the response
+# comes back. That is what the network adapter is for, every network request
+# goes through it. With a network adapter that can wait for a response without
+# blocking (ThreadNetworkAdapter on CPython, or some day an async socket on the
+# board) the text keeps scrolling and the train animation keeps playing while
+# we wait for the response. With BlockingNetworkAdapter everything still works,
+# the other tasks just stall while we make the request like they do with
+# Application.
+#
+# Since the buttons are checked every buttonPollSeconds you no longer need to be
+# holding the button down at just the right time.
+#
+# TrainPredictor isn't thread safe and with ThreadNetworkAdapter a call to it
+# runs on another thread while the other tasks keep going, so every call to
+# the train predictor goes through _call_train_predictor which only makes one
+# call at a time (Application does the same with BackgroundFetcher.submit).
+class AsyncApplication:
+    def __init__(self, dependencies: AsyncApplicationDependencies, buttonPollSeconds=0.05, fetchCheckSeconds=0.1, arrivalTimesRenderSeconds=60, nightlyCheckSeconds=60):
+        self._matrix_portal = dependencies.matrix_portal
+        self._train_predictor = dependencies.train_predictor
+        self._display = dependencies.display
+        self._nowFcn = dependencies.nowFcn
+        self._logger = dependencies.logger
+        self._buttonUpFcn = dependencies.buttonUpFcn
+        self._buttonDownFcn = dependencies.buttonDownFcn
+        self._reloadFcn = dependencies.reloadFcn
+        self._monotonicFcn = dependencies.monotonicFcn
+        self._flushLogsFcn = dependencies.flushLogsFcn
+        self._dumpCrashLogFcn = dependencies.dumpCrashLogFcn
+
+        self._network_adapter = dependencies.network_adapter
+        if self._network_adapter is None:
+            self._network_adapter = BlockingNetworkAdapter()
+
+        self._poll_scheduler = dependencies.poll_scheduler
+        if self._poll_scheduler is None:
+            self._poll_scheduler = FixedPollScheduler(5)
+
+        self._buttonPollSeconds = buttonPollSeconds
+        self._fetchCheckSeconds = fetchCheckSeconds
+        self._arrivalTimesRenderSeconds = arrivalTimesRenderSeconds
+        self._nightlyCheckSeconds = nightlyCheckSeconds
+
+        self._running = False
+        self._tasks = []
+        self._next_train_check = None
+        self._refetch_requested = False
+        self._trains = [None] * NUM_TRAINS_TO_FETCH
+        self._timeline = WarningTimeline()
+        self._train_arrived_fcn = self._train_arrived
+        self._button_direction = None
+        self._next_arrival_times_render = None
+        self._last_nightly_tasks_run = self._monotonicFcn()
+
+        self._train_predictor_lock = asyncio.Lock()
+        self._arrived_trains = []
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        self._running = True
+        await self._startup()
+        self._tasks = [
+            asyncio.create_task(self._button_task()),
+            asyncio.create_task(self._display_task()),
+            asyncio.create_task(self._fetch_task()),
+            asyncio.create_task(self._nightly_task()),
+        ]
+        try:
+            await asyncio.gather(*self._tasks)
+        except asyncio.CancelledError:
+            pass
+
+    # stop cancels all of the tasks, ending run_async.
+    def stop(self):
+        self._running = False
+        for task in self._tasks:
+            task.cancel()
+
+    async def _startup(self):
+        self._logger.info("starting train board")
+
+        # See Application._startup for why the display needs to be initialized
+        # first.
+        await self._try_method(self._display.initialize)
+        await self._try_method(self._sync_clock, network=True)
+        await self._try_method(self._train_predictor.refresh_schedule, network=True, train_predictor=True)
+        await self._flush_logs()
+
+    # _flush_logs is the same as Application._flush_logs, the flush goes
+    # through the network adapter like any other network request.
+    async def _flush_logs(self):
+        if self._flushLogsFcn is None:
+            return
+        try:
+            await self._network_adapter.call(self._flushLogsFcn)
+        except Exception as e:
+            print(f"Failed to flush logs: {e}")
+
+    # _try_method is the same as Application._try_method but waits without
+    # blocking the other tasks. If network is True the method is called using
+    # the network adapter. If train_predictor is True the method is a
+    # TrainPredictor method and is called with _call_train_predictor.
+    async def _try_method(self, method, positional_arguments = [], network=False, train_predictor=False):
+        attempt_count = 0
+        max_attempt_count = 5
+        retry_delay = 5
+        restart_delay = 60
+
+        while attempt_count < max_attempt_count:
+            attempt_count += 1
+            try:
+                if train_predictor:
+                    return await self._call_train_predictor(method, positional_arguments, network)
+                if network:
+                    return await self._network_adapter.call(method, *positional_arguments)
+                return method(*positional_arguments)
+            except Exception as e:
+                self._logger.exception(e)
+            await asyncio.sleep(retry_delay)
+            self._logger.debug("making additional attempt %d", attempt_count)
+
+        try:
+            self._display.render_error()
+        except Exception:
+            # See Application._try_method
+            pass
+
+        if self._dumpCrashLogFcn is not None:
+            try:
+                self._dumpCrashLogFcn()
+            except Exception as e:
+                print(f"Failed to save crash log: {e}")
+        await self._flush_logs()
+        await asyncio.sleep(restart_delay)
+        if self._reloadFcn is not None:
+            self._reloadFcn()
+
+    # _call_train_predictor calls a TrainPredictor method (using the network
+    # adapter if network is True) once any other call to the train predictor
+    # has finished.
+    async def _call_train_predictor(self, method, positional_arguments=[], network=False):
+        async with self._train_predictor_lock:
+            if network:
+                return await self._network_adapter.call(method, *positional_arguments)
+            return method(*positional_arguments)
+
+    def _sync_clock(self):
+        self._logger.debug("getting network time")
+        self._matrix_portal.network.get_local_time(location="America/New_York")
+        self._logger.debug("current time set to %s", self._nowFcn())
+
+    # _train_arrived is called by the warning timeline, which can't wait for
+    # the train predictor, so the train is marked as arrived by _fetch_task
+    # before it fetches the next trains. We use our own flag to ask for the
+    # next trains right away rather than clearing _next_train_check since a
+    # fetch that is already running sets _next_train_check when it finishes.
+    def _train_arrived(self, train):
+        self._arrived_trains.append(train)
+        self._logger.info("train arrived '%s'", train.schedule_id)
+        self._refetch_requested = True
+
+    async def _button_task(self):
+        while self._running:
+            if self._button_direction is None:
+                if self._buttonUpFcn is not None and self._buttonUpFcn():
+                    self._button_direction = Direction.IN_BOUND
+                elif self._buttonDownFcn is not None and self._buttonDownFcn():
+                    self._button_direction = Direction.OUT_BOUND
+            await asyncio.sleep(self._buttonPollSeconds)
+
+    async def _display_task(self):
+        while self._running:
+            now = self._monotonicFcn()
+            self._timeline.update(now, self._train_arrived_fcn)
+
+            # Once the train animation starts we play it all the way through,
+            # then start it again if we still need to show a train.
+            if self._display.train_playing:
+                if not await self._try_method(self._display.tick_train, [now]):
+                    self._button_direction = None
+            if not self._display.train_playing:
+                direction = self._timeline.warning_direction
+                if direction is None:
+                    direction = self._button_direction
+                if direction is not None:
+                    await self._try_method(self._display.start_train, [direction, now])
+                    self._next_arrival_times_render = None
+
+            # Sleep until the next frame is due rather than for a whole frame
+            # so that time spent in the other tasks doesn't add up and slow
+            # the animation down, see TrainAnimation.
+            if self._display.train_playing:
+                await asyncio.sleep(max(0, self._display.train_frame_deadline - self._monotonicFcn()))
+                continue
+
+            # The arrival times are only shown in minutes so there is no need
+            # to render them for every step of the scrolling text. We render
+            # them again when they are due to change (see
+            # Display.render_arrival_times) or after arrivalTimesRenderSeconds,
+            # whichever comes first.
+            now = self._monotonicFcn()
+            if self._next_arrival_times_render is None or now >= self._next_arrival_times_render:
+                next_change = await self._try_method(self._display.render_arrival_times, [self._trains])
+                if next_change is None or next_change > self._arrivalTimesRenderSeconds:
+                    next_change = self._arrivalTimesRenderSeconds
+                self._next_arrival_times_render = now + next_change
+            await self._try_method(self._display.scroll_step)
+            await asyncio.sleep(self._display.text_scroll_delay)
+
+    async def _fetch_task(self):
+        # See Application._fetch_next_trains, like Application we don't fetch
+        # trains while we are showing the train warning.
+        while self._running:
+            while self._arrived_trains:
+                await self._try_method(self._train_predictor.mark_train_arrived, [self._arrived_trains.pop(0)], train_predictor=True)
+            due = self._next_train_check is None or self._monotonicFcn() > self._next_train_check
+            if not self._timeline.warning_active and (self._refetch_requested or due):
+                self._refetch_requested = False
+                self._logger.debug("fetching trains")
+                trains = await self._try_method(self._train_predictor.next_trains, [NUM_TRAINS_TO_FETCH], network=True, train_predictor=True)
+                if self._refetch_requested:
+                    # A train arrived while we were fetching. These trains
+                    # were fetched before it was marked as arrived so they
+                    # still have the warning for it, throw them away and
+                    # fetch again next time around.
+                    self._logger.debug("train arrived during fetch, fetching again")
+                elif trains is not None:
+                    self._trains = trains
+                    self._timeline = await self._call_train_predictor(self._train_predictor.warning_timeline, [trains])
+                    self._next_arrival_times_render = None
+                delay = self._poll_scheduler.next_poll_delay(self._trains, self._nowFcn())
+                self._next_train_check = self._monotonicFcn() + delay
+                self._logger.debug("trains: %s, next check in %ss", self._trains, delay)
+                await self._flush_logs()
+            await asyncio.sleep(self._fetchCheckSeconds)
+
+    async def _nightly_task(self):
+        while self._running:
+            await asyncio.sleep(self._nightlyCheckSeconds)
+            if self._monotonicFcn() < self._last_nightly_tasks_run + 7200:
+                continue
+            if self._nowFcn().hour != 3:
+                continue
+
+            self._logger.debug("running nightly tasks")
+            self._last_nightly_tasks_run = self._monotonicFcn()
+            await self._try_method(self._sync_clock, network=True)
+            await self._try_method(self._train_predictor.clear_cache, train_predictor=True)
+            gc.collect()
+            await self._try_method(self._train_predictor.refresh_schedule, network=True, train_predictor=True)
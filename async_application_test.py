@@ -0,0 +1,256 @@
+from async_application import AsyncApplication, AsyncApplicationDependencies
+from network_adapter import BlockingNetworkAdapter, ThreadNetworkAdapter
+from warning_timeline import WarningTimeline, TimelineEvent
+from train_animation import TrainAnimation
+from train_predictor import TrainArrival, Direction
+from poll_scheduler import FixedPollScheduler
+from datetime import datetime
+import asyncio
+import threading
+import time
+import unittest
+import logging
+
+mock_logger = logging.getLogger("mock")
+
+# FakeDisplay records when each step of the scrolling text and each frame of
+# the train animation is shown.
+class FakeDisplay:
+    def __init__(self, text_scroll_delay=0.02, train_frame_duration=0.02, train_frame_count=5):
+        self.text_scroll_delay = text_scroll_delay
+        self.train_frame_duration = train_frame_duration
+        self._train_animation = TrainAnimation(train_frame_count, train_frame_duration, self.render_train_frame)
+        self.frames = []
+        self.arrival_times = []
+
+    def initialize(self):
+        pass
+
+    def render_arrival_times(self, trains):
+        self.arrival_times.append(trains)
+
+    def scroll_step(self):
+        self.frames.append((time.monotonic(), "scroll"))
+
+    def start_train(self, direction, now):
+        self._train_animation.start(now)
+
+    def tick_train(self, now):
+        return self._train_animation.tick(now)
+
+    @property
+    def train_playing(self):
+        return self._train_animation.running
+
+    @property
+    def train_frame_deadline(self):
+        return self._train_animation.next_deadline
+
+    def render_train_frame(self, frame):
+        self.frames.append((time.monotonic(), "train"))
+
+    def render_error(self):
+        raise AssertionError("unexpected error")
+
+class FakeNetwork:
+    def get_local_time(self, location):
+        pass
+
+class FakeMatrixPortal:
+    def __init__(self):
+        self.network = FakeNetwork()
+
+# SlowTrainPredictor takes fetchSeconds to fetch the next trains, like a slow
+# response from the MBTA API.
+class SlowTrainPredictor:
+    def __init__(self, fetchSeconds=2, timeline_events=None):
+        self._fetchSeconds = fetchSeconds
+        self._timeline_events = timeline_events
+        self.fetch_count = 0
+        self.arrived = []
+
+    def refresh_schedule(self):
+        pass
+
+    def next_trains(self, count):
+        time.sleep(self._fetchSeconds)
+        self.fetch_count += 1
+        return [None] * count
+
+    def warning_timeline(self, trains):
+        events = self._timeline_events
+        self._timeline_events = None
+        return WarningTimeline(events)
+
+    def mark_train_arrived(self, train):
+        self.arrived.append(train.schedule_id)
+
+    def clear_cache(self):
+        pass
+
+# OverlapCheckingTrainPredictor records the most calls that were ever running
+# at the same time. TrainPredictor isn't thread safe so that should only ever
+# be one. If fetchSecondsList is provided each fetch takes the next time from
+# the list instead of fetchSeconds.
+class OverlapCheckingTrainPredictor(SlowTrainPredictor):
+    def __init__(self, refreshSeconds=0.2, fetchSecondsList=None, **kwargs):
+        super().__init__(**kwargs)
+        self._refreshSeconds = refreshSeconds
+        self._fetchSecondsList = fetchSecondsList
+        self._lock = threading.Lock()
+        self._running_calls = 0
+        self.max_running_calls = 0
+        self.calls = []
+
+    def _call(self, name, fcn, *args):
+        with self._lock:
+            self._running_calls += 1
+            self.max_running_calls = max(self.max_running_calls, self._running_calls)
+            self.calls.append(name)
+        try:
+            return fcn(*args)
+        finally:
+            with self._lock:
+                self._running_calls -= 1
+
+    def refresh_schedule(self):
+        self._call("refresh_schedule", time.sleep, self._refreshSeconds)
+
+    def next_trains(self, count):
+        if self._fetchSecondsList:
+            self._fetchSeconds = self._fetchSecondsList.pop(0)
+        return self._call("next_trains", super().next_trains, count)
+
+    def clear_cache(self):
+        self._call("clear_cache", super().clear_cache)
+
+    def mark_train_arrived(self, train):
+        self._call("mark_train_arrived", super().mark_train_arrived, train)
+
+# RepeatingTimelinePredictor returns the same warning timeline for every
+# fetch until the train is marked as arrived, like TrainPredictor.
+class RepeatingTimelinePredictor(OverlapCheckingTrainPredictor):
+    def warning_timeline(self, trains):
+        if self.arrived or self._timeline_events is None:
+            return WarningTimeline()
+        return WarningTimeline(list(self._timeline_events))
+
+# ListPollScheduler waits the next delay from the list before each poll.
+class ListPollScheduler:
+    def __init__(self, delays):
+        self._delays = delays
+
+    def next_poll_delay(self, trains, now):
+        return self._delays.pop(0) if len(self._delays) > 1 else self._delays[0]
+
+def run_for(app, seconds):
+    async def run():
+        task = asyncio.create_task(app.run_async())
+        await asyncio.sleep(seconds)
+        app.stop()
+        await task
+    asyncio.run(run())
+
+def create_app(display, predictor, network_adapter, **kwargs):
+    deps = AsyncApplicationDependencies(FakeMatrixPortal(), predictor, display, datetime.now, mock_logger, network_adapter=network_adapter, **kwargs)
+    return AsyncApplication(deps)
+
+def longest_gap(frames):
+    times = [t for t, _ in frames]
+    return max(later - earlier for earlier, later in zip(times, times[1:]))
+
+class Test_frame_cadence(unittest.TestCase):
+    def test_thread_adapter(self):
+        # The text should keep scrolling at the same rate while we wait 2
+        # seconds for the MBTA API.
+        display = FakeDisplay()
+        predictor = SlowTrainPredictor(fetchSeconds=2)
+        run_for(create_app(display, predictor, ThreadNetworkAdapter()), 2.5)
+
+        self.assertEqual(predictor.fetch_count, 1)
+        self.assertGreater(len(display.frames), 2.5 / display.text_scroll_delay / 2)
+        self.assertLess(longest_gap(display.frames), 0.2)
+
+    def test_blocking_adapter(self):
+        # With a blocking adapter everything stalls while we fetch, the same as
+        # Application.
+        display = FakeDisplay()
+        predictor = SlowTrainPredictor(fetchSeconds=2)
+        run_for(create_app(display, predictor, BlockingNetworkAdapter()), 2.5)
+
+        self.assertEqual(predictor.fetch_count, 1)
+        self.assertGreaterEqual(longest_gap(display.frames), 1.9)
+
+class Test_train_warning(unittest.TestCase):
+    def test_warning_plays_during_fetch(self):
+        # The warning starts right away and lasts 0.5 seconds. The animation
+        # should play for the whole time even though the fetch that comes
+        # after the warning is slow.
+        train = TrainArrival("schedule", 0, Direction.IN_BOUND, 0)
+        start = time.monotonic()
+        events = [(start, TimelineEvent.WARNING_START, train), (start + 0.5, TimelineEvent.WARNING_END, train)]
+        display = FakeDisplay()
+        predictor = SlowTrainPredictor(fetchSeconds=0, timeline_events=events)
+        run_for(create_app(display, predictor, ThreadNetworkAdapter()), 1)
+
+        self.assertEqual(predictor.arrived, ["schedule"])
+        train_frames = [t for t, kind in display.frames if kind == "train"]
+        self.assertGreater(len(train_frames), 10)
+        self.assertLess(train_frames[-1] - start, 0.6)
+        self.assertEqual(display.frames[-1][1], "scroll")
+
+    def test_button(self):
+        # A single press of the button plays the animation once.
+        presses = [True]
+        display = FakeDisplay(train_frame_count=5)
+        predictor = SlowTrainPredictor(fetchSeconds=0)
+        app = create_app(display, predictor, ThreadNetworkAdapter(), buttonUpFcn=lambda: presses.pop() if presses else False)
+        run_for(app, 0.5)
+
+        self.assertEqual([kind for _, kind in display.frames].count("train"), 5)
+
+class Test_train_predictor_calls(unittest.TestCase):
+    def test_nightly_refresh_during_fetch(self):
+        # The nightly tasks come due while a slow fetch is running on another
+        # thread. The nightly clear_cache and refresh_schedule have to wait
+        # for the fetch to finish.
+        predictor = OverlapCheckingTrainPredictor(fetchSeconds=0.6)
+        three_am = lambda: datetime(2025, 10, 22, 3, 0, 0)
+        deps = AsyncApplicationDependencies(FakeMatrixPortal(), predictor, FakeDisplay(), three_am, mock_logger, network_adapter=ThreadNetworkAdapter())
+        app = AsyncApplication(deps, nightlyCheckSeconds=0.1)
+        app._last_nightly_tasks_run = -7200
+        run_for(app, 1)
+
+        self.assertEqual(predictor.calls[:4], ["refresh_schedule", "next_trains", "clear_cache", "refresh_schedule"])
+        self.assertEqual(predictor.max_running_calls, 1)
+
+    def test_train_arrived_during_fetch(self):
+        # The first fetch returns a short warning that starts and ends while
+        # the second (slow) fetch is running. The train is only marked as
+        # arrived once that fetch is done.
+        start = time.monotonic()
+        train = TrainArrival("schedule", 0, Direction.IN_BOUND, 0)
+        events = [(start + 0.25, TimelineEvent.WARNING_START, train), (start + 0.4, TimelineEvent.WARNING_END, train)]
+        predictor = OverlapCheckingTrainPredictor(fetchSeconds=0, fetchSecondsList=[0, 0.6, 0], refreshSeconds=0, timeline_events=events)
+        run_for(create_app(FakeDisplay(), predictor, ThreadNetworkAdapter(), poll_scheduler=FixedPollScheduler(0)), 1.2)
+
+        self.assertEqual(predictor.arrived, ["schedule"])
+        self.assertEqual(predictor.calls[:4], ["refresh_schedule", "next_trains", "next_trains", "mark_train_arrived"])
+        self.assertEqual(predictor.max_running_calls, 1)
+
+    def test_stale_fetch_after_train_arrived(self):
+        # The second (slow) fetch starts before the warning and the train
+        # arrives while it is running, so it comes back with the same warning.
+        # Those trains are thrown away and we fetch again right away, even
+        # though the poll scheduler wouldn't have us fetch for a while.
+        start = time.monotonic()
+        train = TrainArrival("schedule", 0, Direction.IN_BOUND, 0)
+        events = [(start + 0.45, TimelineEvent.WARNING_START, train), (start + 0.6, TimelineEvent.WARNING_END, train)]
+        predictor = RepeatingTimelinePredictor(fetchSeconds=0, fetchSecondsList=[0, 0.6, 0], refreshSeconds=0, timeline_events=events)
+        run_for(create_app(FakeDisplay(), predictor, ThreadNetworkAdapter(), poll_scheduler=ListPollScheduler([0.2, 10])), 1.2)
+
+        self.assertEqual(predictor.arrived, ["schedule"])
+        self.assertEqual(predictor.calls, ["refresh_schedule", "next_trains", "next_trains", "mark_train_arrived", "next_trains"])
+
+if __name__ == '__main__':
+    unittest.main()
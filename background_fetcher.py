@@ -0,0 +1,160 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from poll_scheduler import FixedPollScheduler
+from warning_timeline import WarningTimeline
+
+# background_fetcher is only used when running on a Linux single-board
+# computer (with Blinka driving the LED panel) where we have threads. It isn't
+# copied onto the Matrix Portal, concurrent.futures doesn't exist in
+# CircuitPython so main.py falls back to fetching trains in the main loop.
+
+# TrainSnapshot is the result of a fetch. Snapshots are never modified once
+# they are published, generation counts up by one for each new snapshot.
+# fetch_number is the number of the fetch that produced the snapshot (see
+# BackgroundFetcher.fetch_count).
+class TrainSnapshot:
+    __slots__ = ("trains", "timeline", "generation", "fetch_number")
+
+    def __init__(self, trains, timeline, generation, fetch_number=0):
+        self.trains = trains
+        self.timeline = timeline
+        self.generation = generation
+        self.fetch_number = fetch_number
+
+# BackgroundFetcherDependencies
+#
+# poll_scheduler decides how often we fetch trains, see poll_scheduler.py. If
+# it isn't provided then we fetch every five seconds.
+class BackgroundFetcherDependencies:
+    def __init__(self, train_predictor, nowFcn, logger, poll_scheduler=None, monotonicFcn=time.monotonic):
+        self.train_predictor = train_predictor
+        self.nowFcn = nowFcn
+        self.logger = logger
+        self.poll_scheduler = poll_scheduler
+        self.monotonicFcn = monotonicFcn
+
+# BackgroundFetcher calls TrainPredictor.next_trains on a worker thread so that
+# the main loop never has to wait on the network.
+#
+# The main loop calls poll() every time through the loop, which starts a new
+# fetch on the worker thread when the poll scheduler says one is due. It never
+# waits for the fetch to finish. When the fetch finishes the worker publishes a
+# new TrainSnapshot, which the main loop picks up by reading snapshot.
+#
+# Publishing is double buffered: the worker writes the new snapshot into
+# whichever of the two slots isn't currently the front and then flips _front.
+# Assigning an int is atomic so the main loop can read snapshot without taking
+# a lock and always sees a complete snapshot, either the old one or the new
+# one.
+#
+# TrainPredictor isn't thread safe, so once we are using a BackgroundFetcher
+# everything that uses the train predictor needs to run on the worker thread
+# using submit().
+class BackgroundFetcher:
+    def __init__(self, dependencies: BackgroundFetcherDependencies, count=3, maxConsecutiveErrors=5):
+        self._train_predictor = dependencies.train_predictor
+        self._nowFcn = dependencies.nowFcn
+        self._logger = dependencies.logger
+        self._monotonicFcn = dependencies.monotonicFcn
+        self._poll_scheduler = dependencies.poll_scheduler
+        if self._poll_scheduler is None:
+            self._poll_scheduler = FixedPollScheduler(5)
+
+        self._count = count
+        self._maxConsecutiveErrors = maxConsecutiveErrors
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._future = None
+        self._fetch_count = 0
+        self._next_fetch = None
+        self._fetch_requested = True
+        self._consecutive_errors = 0
+        self._last_error = None
+
+        initial = TrainSnapshot([None] * count, WarningTimeline(), 0)
+        self._snapshots = [initial, initial]
+        self._front = 0
+
+    @property
+    def snapshot(self):
+        return self._snapshots[self._front]
+
+    @property
+    def fetching(self):
+        return self._future is not None
+
+    # fetch_count is the number of fetches that have been started. Fetches run
+    # on the worker thread in the order they were submitted along with
+    # everything passed to submit(), so a snapshot with a fetch_number greater
+    # than fetch_count was at the time submit() was called is guaranteed to
+    # have been fetched after that call ran.
+    @property
+    def fetch_count(self):
+        return self._fetch_count
+
+    # poll starts a new fetch if one is due. If paused is True we don't start
+    # a new fetch, for example while we are showing the train warning.
+    #
+    # If the last maxConsecutiveErrors fetches all failed poll raises the last
+    # error so the application can deal with it (see Application._try_method).
+    # Before raising it starts another fetch (if one isn't already running) so
+    # that when the application retries, poll stops raising if that fetch
+    # worked.
+    def poll(self, paused=False):
+        if self._future is not None and self._future.done():
+            self._future = None
+
+        if self._consecutive_errors >= self._maxConsecutiveErrors:
+            if self._future is None:
+                self._start_fetch()
+            raise self._last_error
+
+        if self._future is not None or paused:
+            return
+        if not self._fetch_requested and self._next_fetch is not None and self._monotonicFcn() < self._next_fetch:
+            return
+        self._fetch_requested = False
+        self._start_fetch()
+
+    # fetch_now makes the next call to poll start a fetch right away rather
+    # than waiting for the poll scheduler. This is only called from the main
+    # loop so it uses its own flag rather than _next_fetch which is set by the
+    # worker.
+    def fetch_now(self):
+        self._fetch_requested = True
+
+    # submit runs fcn(*args) on the worker thread, after any fetch that is in
+    # progress, and returns a concurrent.futures.Future for the result.
+    def submit(self, fcn, *args):
+        return self._executor.submit(fcn, *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _start_fetch(self):
+        self._fetch_count += 1
+        self._future = self._executor.submit(self._fetch, self._fetch_count)
+
+    def _fetch(self, fetch_number):
+        try:
+            self._logger.debug("fetching trains")
+            trains = self._train_predictor.next_trains(self._count)
+            timeline = self._train_predictor.warning_timeline(trains)
+        except Exception as e:
+            self._logger.exception(e)
+            self._consecutive_errors += 1
+            self._last_error = e
+            self._next_fetch = self._monotonicFcn() + self._poll_scheduler.next_poll_delay(self.snapshot.trains, self._nowFcn())
+            return
+        self._consecutive_errors = 0
+        self._last_error = None
+
+        self._publish(trains, timeline, fetch_number)
+        delay = self._poll_scheduler.next_poll_delay(trains, self._nowFcn())
+        self._next_fetch = self._monotonicFcn() + delay
+        self._logger.debug("trains: %s, next check in %ss", trains, delay)
+
+    def _publish(self, trains, timeline, fetch_number):
+        back = 1 - self._front
+        self._snapshots[back] = TrainSnapshot(trains, timeline, self.snapshot.generation + 1, fetch_number)
+        self._front = back
@@ -0,0 +1,177 @@
+from background_fetcher import BackgroundFetcher, BackgroundFetcherDependencies
+from poll_scheduler import FixedPollScheduler
+from warning_timeline import WarningTimeline
+from datetime import datetime
+import threading
+import time
+import unittest
+import logging
+
+mock_logger = logging.getLogger("mock")
+
+# SlowTrainPredictor takes fetchSeconds to fetch the next trains, like a slow
+# response from the MBTA API. Each fetch returns a different list of trains.
+class SlowTrainPredictor:
+    def __init__(self, fetchSeconds, error=None):
+        self._fetchSeconds = fetchSeconds
+        self._error = error
+        self.fetch_count = 0
+        self.threads = set()
+
+    def next_trains(self, count):
+        self.threads.add(threading.get_ident())
+        time.sleep(self._fetchSeconds)
+        if self._error is not None:
+            raise self._error
+        self.fetch_count += 1
+        return [f"train-{self.fetch_count}"] + [None] * (count - 1)
+
+    def warning_timeline(self, trains):
+        return WarningTimeline()
+
+    def refresh_schedule(self):
+        self.threads.add(threading.get_ident())
+
+def create_fetcher(predictor, intervalSeconds=5, **kwargs):
+    deps = BackgroundFetcherDependencies(predictor, datetime.now, mock_logger, FixedPollScheduler(intervalSeconds))
+    return BackgroundFetcher(deps, **kwargs)
+
+# render_loop stands in for Application._run_loop, each iteration polls the
+# fetcher, reads the latest snapshot and then "renders" for frameSeconds. It
+# returns how long each iteration took along with the snapshot generations it
+# saw.
+def render_loop(fetcher, seconds, frameSeconds=0.01, paused=False):
+    latencies = []
+    generations = []
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start = time.monotonic()
+        fetcher.poll(paused=paused)
+        snapshot = fetcher.snapshot
+        generations.append(snapshot.generation)
+        time.sleep(frameSeconds)
+        latencies.append(time.monotonic() - start)
+    return latencies, generations
+
+class Test_BackgroundFetcher(unittest.TestCase):
+    def test_render_latency_with_slow_network(self):
+        predictor = SlowTrainPredictor(fetchSeconds=2)
+        fetcher = create_fetcher(predictor)
+        try:
+            latencies, generations = render_loop(fetcher, 2.5)
+        finally:
+            fetcher.shutdown()
+
+        # The render loop keeps going while the fetch takes 2 seconds.
+        self.assertGreater(len(latencies), 100)
+        self.assertLess(max(latencies), 0.1)
+
+        # It sees the empty initial snapshot until the fetch finishes and then
+        # the new trains.
+        self.assertEqual(generations[0], 0)
+        self.assertEqual(generations[-1], 1)
+        self.assertEqual(fetcher.snapshot.trains, ["train-1", None, None])
+        self.assertNotIn(threading.get_ident(), predictor.threads)
+
+    def test_poll_scheduler(self):
+        predictor = SlowTrainPredictor(fetchSeconds=0)
+        fetcher = create_fetcher(predictor, intervalSeconds=0.2)
+        try:
+            render_loop(fetcher, 0.5)
+            fetch_count = predictor.fetch_count
+            self.assertGreaterEqual(fetch_count, 2)
+            self.assertLessEqual(fetch_count, 4)
+
+            # fetch_now skips the wait.
+            fetcher.poll()
+            fetcher.fetch_now()
+            render_loop(fetcher, 0.05)
+            self.assertEqual(predictor.fetch_count, fetch_count + 1)
+        finally:
+            fetcher.shutdown()
+
+    def test_paused(self):
+        predictor = SlowTrainPredictor(fetchSeconds=0)
+        fetcher = create_fetcher(predictor)
+        try:
+            render_loop(fetcher, 0.1, paused=True)
+            self.assertEqual(predictor.fetch_count, 0)
+            self.assertEqual(fetcher.snapshot.generation, 0)
+        finally:
+            fetcher.shutdown()
+
+    def test_repeated_errors(self):
+        # A failed fetch is retried on the next poll interval, once enough of
+        # them fail in a row poll raises the error.
+        predictor = SlowTrainPredictor(fetchSeconds=0, error=OSError("no network"))
+        fetcher = create_fetcher(predictor, intervalSeconds=0, maxConsecutiveErrors=3)
+        try:
+            with self.assertRaises(OSError):
+                render_loop(fetcher, 1)
+            self.assertEqual(fetcher.snapshot.generation, 0)
+        finally:
+            fetcher.shutdown()
+
+    def test_recovers_after_repeated_errors(self):
+        # Once poll raises, the application retries a few times before giving
+        # up (see Application._try_method). If the network has come back by
+        # then one of the retries should work.
+        predictor = SlowTrainPredictor(fetchSeconds=0, error=OSError("no network"))
+        fetcher = create_fetcher(predictor, intervalSeconds=0, maxConsecutiveErrors=3)
+        try:
+            with self.assertRaises(OSError):
+                render_loop(fetcher, 1)
+
+            predictor._error = None
+            for attempt in range(5):
+                try:
+                    fetcher.poll()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            else:
+                self.fail("poll kept raising after the network came back")
+
+            render_loop(fetcher, 0.1)
+            self.assertGreater(fetcher.snapshot.generation, 0)
+        finally:
+            fetcher.shutdown()
+
+    def test_fetch_number(self):
+        # A fetch that is in progress when submit() is called was started
+        # first, so its snapshot has a fetch_number no greater than fetch_count
+        # was then. The next fetch runs after whatever was submitted.
+        predictor = SlowTrainPredictor(fetchSeconds=0.2)
+        fetcher = create_fetcher(predictor)
+        try:
+            fetcher.poll()
+            self.assertTrue(fetcher.fetching)
+            order = []
+            fetcher.submit(lambda: order.append(predictor.fetch_count))
+            submitted_at = fetcher.fetch_count
+
+            render_loop(fetcher, 0.3)
+            self.assertEqual(fetcher.snapshot.fetch_number, submitted_at)
+
+            fetcher.fetch_now()
+            render_loop(fetcher, 0.3)
+            self.assertGreater(fetcher.snapshot.fetch_number, submitted_at)
+            self.assertEqual(order, [1])
+            self.assertEqual(predictor.fetch_count, 2)
+        finally:
+            fetcher.shutdown()
+
+    def test_submit(self):
+        # Other calls to the train predictor run on the worker thread too.
+        predictor = SlowTrainPredictor(fetchSeconds=0)
+        fetcher = create_fetcher(predictor)
+        try:
+            fetcher.poll()
+            fetcher.submit(predictor.refresh_schedule).result()
+            self.assertEqual(len(predictor.threads), 1)
+            self.assertNotIn(threading.get_ident(), predictor.threads)
+        finally:
+            fetcher.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
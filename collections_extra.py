@@ -1,3 +1,4 @@
+from array import array
 from collections import OrderedDict
 
 # LimitedSizeOrderedSet is a set that removes the oldest elements when we hit
@@ -79,4 +80,270 @@ class LimitedSizeOrderedDict:
         return len(self._data)
 
     def __iter__(self):
-        return iter(self._data)
\ No newline at end of file
+        return iter(self._data)
+
+# _EMPTY marks a free (or removed) slot in a _HashedRing.
+_EMPTY = object()
+
+# _HashedRing is the shared implementation of HashedLimitedSizeOrderedSet and
+# HashedLimitedSizeOrderedDict.
+# 
+# The OrderedDict based classes above allocate a new hash table entry (and
+# every so often resize the whole table) on each insert, which fragments the
+# heap on the board when we run for days at a time. Instead everything here is
+# allocated up front:
+# 
+#  * _keys, _values and _hashes form a ring buffer of entries in insertion
+#    order. The oldest entry is at _head and the next entry is written at
+#    _tail (both keep counting up, the slot is the count modulo the ring size).
+#  * _index is an open addressing (linear probing) hash table of ring slots,
+#    keyed by the hash of each key. A zero means the bucket is empty, otherwise
+#    it holds the ring slot plus one.
+# 
+# Hashes are masked to 30 bits so they (and everything else we store) are
+# small ints on MicroPython / CircuitPython and don't need to be allocated.
+# 
+# Re-adding an existing key needs to move it to the end of the order. Rather
+# than shifting the ring buffer we mark the old slot as _EMPTY and append a new
+# one. That is why the ring holds twice max_size entries, when it fills up we
+# compact it in place which at most happens once every max_size re-adds.
+class _HashedRing:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._ring_size = 2 * max(max_size, 1)
+        self._keys = [_EMPTY] * self._ring_size
+        self._values = [None] * self._ring_size
+        self._hashes = array("L", [0]) * self._ring_size
+
+        index_size = 1
+        while index_size < 2 * self._ring_size:
+            index_size *= 2
+        self._index_mask = index_size - 1
+        self._index = array("H" if self._ring_size < 0xFFFF else "L", [0]) * index_size
+
+        self._head = 0
+        self._tail = 0
+        self._count = 0
+
+    def clear(self):
+        for slot in range(self._ring_size):
+            self._keys[slot] = _EMPTY
+            self._values[slot] = None
+        for bucket in range(len(self._index)):
+            self._index[bucket] = 0
+        self._head = 0
+        self._tail = 0
+        self._count = 0
+
+    def __contains__(self, key):
+        return self._index[self._find(key, hash(key) & 0x3FFFFFFF)] != 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for position in range(self._head, self._tail):
+            key = self._keys[position % self._ring_size]
+            if key is not _EMPTY:
+                yield key
+
+    # _find returns the bucket in _index for key, or the empty bucket where it
+    # should be inserted if it isn't there.
+    def _find(self, key, key_hash):
+        bucket = key_hash & self._index_mask
+        while True:
+            entry = self._index[bucket]
+            if entry == 0:
+                return bucket
+            slot = entry - 1
+            if self._hashes[slot] == key_hash and self._keys[slot] == key:
+                return bucket
+            bucket = (bucket + 1) & self._index_mask
+
+    def _put(self, key, value):
+        key_hash = hash(key) & 0x3FFFFFFF
+        bucket = self._find(key, key_hash)
+        if self._index[bucket] != 0:
+            self._remove_slot(self._index[bucket] - 1, bucket)
+            bucket = self._find(key, key_hash)
+
+        if self._tail - self._head == self._ring_size:
+            self._compact()
+            bucket = self._find(key, key_hash)
+
+        slot = self._tail % self._ring_size
+        self._keys[slot] = key
+        self._values[slot] = value
+        self._hashes[slot] = key_hash
+        self._index[bucket] = slot + 1
+        self._tail += 1
+        self._count += 1
+
+        if self._count > self.max_size:
+            self._evict_oldest()
+        return slot
+
+    def _evict_oldest(self):
+        while self._head < self._tail:
+            slot = self._head % self._ring_size
+            if self._keys[slot] is not _EMPTY:
+                self._remove_slot(slot, self._bucket_for_slot(slot))
+                return
+            self._head += 1
+
+    def _bucket_for_slot(self, slot):
+        bucket = self._hashes[slot] & self._index_mask
+        while self._index[bucket] != slot + 1:
+            bucket = (bucket + 1) & self._index_mask
+        return bucket
+
+    def _remove_slot(self, slot, bucket):
+        self._keys[slot] = _EMPTY
+        self._values[slot] = None
+        self._count -= 1
+        while self._head < self._tail and self._keys[self._head % self._ring_size] is _EMPTY:
+            self._head += 1
+
+        # Linear probing can't just empty the bucket since that would break the
+        # probe sequence of later entries, so we shift back any entries after it
+        # that belong at or before the bucket we are emptying.
+        mask = self._index_mask
+        next_bucket = bucket
+        while True:
+            next_bucket = (next_bucket + 1) & mask
+            entry = self._index[next_bucket]
+            if entry == 0:
+                break
+            home = self._hashes[entry - 1] & mask
+            if (next_bucket - home) & mask >= (next_bucket - bucket) & mask:
+                self._index[bucket] = entry
+                bucket = next_bucket
+        self._index[bucket] = 0
+
+    # _compact moves all of the entries up to fill in the _EMPTY slots left
+    # behind by re-adding keys, keeping them in order starting from _head, and
+    # rebuilds _index to match. Entries only ever move to a position we have
+    # already read so we never overwrite one we still need.
+    def _compact(self):
+        write = self._head
+        for position in range(self._head, self._tail):
+            slot = position % self._ring_size
+            key = self._keys[slot]
+            if key is _EMPTY:
+                continue
+            write_slot = write % self._ring_size
+            if write_slot != slot:
+                self._move_slot(slot, write_slot)
+            write += 1
+
+        # Keep _head and _tail small.
+        start = self._head - self._head % self._ring_size
+        self._head -= start
+        self._tail = write - start
+
+        for bucket in range(len(self._index)):
+            self._index[bucket] = 0
+        for position in range(self._head, self._tail):
+            slot = position % self._ring_size
+            bucket = self._hashes[slot] & self._index_mask
+            while self._index[bucket] != 0:
+                bucket = (bucket + 1) & self._index_mask
+            self._index[bucket] = slot + 1
+
+    def _move_slot(self, from_slot, to_slot):
+        self._keys[to_slot] = self._keys[from_slot]
+        self._values[to_slot] = self._values[from_slot]
+        self._hashes[to_slot] = self._hashes[from_slot]
+        self._keys[from_slot] = _EMPTY
+        self._values[from_slot] = None
+
+# HashedLimitedSizeOrderedSet is a drop in replacement for
+# LimitedSizeOrderedSet that doesn't allocate when elements are added, see
+# _HashedRing.
+class HashedLimitedSizeOrderedSet(_HashedRing):
+    def add(self, element):
+        self._put(element, None)
+
+# HashedLimitedSizeOrderedDict is a drop in replacement for
+# LimitedSizeOrderedDict that doesn't allocate when elements are added, see
+# _HashedRing.
+class HashedLimitedSizeOrderedDict(_HashedRing):
+    def __setitem__(self, key, value):
+        self._put(key, value)
+
+    def __getitem__(self, key):
+        entry = self._index[self._find(key, hash(key) & 0x3FFFFFFF)]
+        if entry == 0:
+            raise KeyError(key)
+        return self._values[entry - 1]
+
+# ExpiringLimitedSizeOrderedDict is a HashedLimitedSizeOrderedDict where each
+# entry also has a time (in seconds, see "Times" in time_conversion.py) that
+# it expires at.
+# 
+# Expired entries are removed lazily when they are looked up, and every
+# sweepIntervalSeconds we sweep through and remove all of the expired entries
+# so they don't take up room that newer entries could use. Like
+# HashedLimitedSizeOrderedDict if we go over max_size the oldest entry is
+# removed even if it hasn't expired yet.
+# 
+# nowFcn returns the current time in seconds.
+class ExpiringLimitedSizeOrderedDict(_HashedRing):
+    def __init__(self, max_size, nowFcn, sweepIntervalSeconds=3600):
+        super().__init__(max_size)
+        self._expires = [0] * self._ring_size
+        self._nowFcn = nowFcn
+        self._sweepIntervalSeconds = sweepIntervalSeconds
+        self._next_sweep = None
+        self.expired_count = 0
+
+    def set(self, key, value, expires):
+        now = self._nowFcn()
+        if self._next_sweep is None or now >= self._next_sweep:
+            self.sweep(now)
+        slot = self._put(key, value)
+        self._expires[slot] = expires
+
+    def get(self, key, default=None):
+        slot = self._live_slot(key)
+        if slot is None:
+            return default
+        return self._values[slot]
+
+    def __getitem__(self, key):
+        slot = self._live_slot(key)
+        if slot is None:
+            raise KeyError(key)
+        return self._values[slot]
+
+    def __contains__(self, key):
+        return self._live_slot(key) is not None
+
+    # sweep removes all of the entries that have expired.
+    def sweep(self, now=None):
+        if now is None:
+            now = self._nowFcn()
+        self._next_sweep = now + self._sweepIntervalSeconds
+        for position in range(self._head, self._tail):
+            slot = position % self._ring_size
+            if self._keys[slot] is not _EMPTY and self._expires[slot] <= now:
+                self._remove_slot(slot, self._bucket_for_slot(slot))
+                self.expired_count += 1
+
+    # _live_slot returns the ring slot for key, or None if it isn't in the
+    # dict. If the entry has expired it is removed.
+    def _live_slot(self, key):
+        bucket = self._find(key, hash(key) & 0x3FFFFFFF)
+        entry = self._index[bucket]
+        if entry == 0:
+            return None
+        slot = entry - 1
+        if self._expires[slot] <= self._nowFcn():
+            self._remove_slot(slot, bucket)
+            self.expired_count += 1
+            return None
+        return slot
+
+    def _move_slot(self, from_slot, to_slot):
+        super()._move_slot(from_slot, to_slot)
+        self._expires[to_slot] = self._expires[from_slot]
@@ -1,10 +1,15 @@
-from collections_extra import LimitedSizeOrderedSet, LimitedSizeOrderedDict
+from collections_extra import LimitedSizeOrderedSet, LimitedSizeOrderedDict, HashedLimitedSizeOrderedSet, HashedLimitedSizeOrderedDict, ExpiringLimitedSizeOrderedDict
+import random
+import time
+import tracemalloc
 import unittest
 
 
 class Test_LimitedSizeOrderedSet(unittest.TestCase):
+    set_class = LimitedSizeOrderedSet
+
     def test_basic_functionality(self):
-        set = LimitedSizeOrderedSet(max_size=100)
+        set = self.set_class(max_size=100)
         self.assertEqual(len(set), 0)
         self.assertFalse("foo" in set)
 
@@ -27,7 +32,7 @@ class Test_LimitedSizeOrderedSet(unittest.TestCase):
 
     def test_hit_max_size(self):
         # When we hit the max size the oldest elements in the set should be removed
-        set = LimitedSizeOrderedSet(max_size=5)
+        set = self.set_class(max_size=5)
 
         set.add(1)
         set.add(2)
@@ -54,7 +59,7 @@ class Test_LimitedSizeOrderedSet(unittest.TestCase):
         # update the location of that element in the order so it is pushed to
         # the front of the order.
         
-        set = LimitedSizeOrderedSet(max_size=3)
+        set = self.set_class(max_size=3)
 
         set.add(1)
         set.add(2)
@@ -78,8 +83,10 @@ class Test_LimitedSizeOrderedSet(unittest.TestCase):
         self.assertTrue(4 in set)
 
 class Test_LimitedSizeOrderedDict(unittest.TestCase):
+    dict_class = LimitedSizeOrderedDict
+
     def test_basic_functionality(self):
-        limitedDict = LimitedSizeOrderedDict(max_size=100)
+        limitedDict = self.dict_class(max_size=100)
         self.assertEqual(len(limitedDict), 0)
         self.assertFalse("foo" in limitedDict)
 
@@ -103,7 +110,7 @@ class Test_LimitedSizeOrderedDict(unittest.TestCase):
 
     def test_hit_max_size(self):
         # When we hit the max size the oldest elements in the set should be removed
-        limitedDict = LimitedSizeOrderedDict(max_size=5)
+        limitedDict = self.dict_class(max_size=5)
 
         limitedDict[1] = "1"
         limitedDict[2] = "2"
@@ -141,7 +148,7 @@ class Test_LimitedSizeOrderedDict(unittest.TestCase):
         # should update the location of that element in the order so it is
         # pushed to the front of the order.
         
-        limitedDict = LimitedSizeOrderedDict(max_size=3)
+        limitedDict = self.dict_class(max_size=3)
 
         limitedDict[1] = "1"
         limitedDict[2] = "2"
@@ -174,5 +181,218 @@ class Test_LimitedSizeOrderedDict(unittest.TestCase):
         self.assertEqual(limitedDict[4], "4")
 
 
+# The hashed versions should pass all the same tests.
+class Test_HashedLimitedSizeOrderedSet(Test_LimitedSizeOrderedSet):
+    set_class = HashedLimitedSizeOrderedSet
+
+class Test_HashedLimitedSizeOrderedDict(Test_LimitedSizeOrderedDict):
+    dict_class = HashedLimitedSizeOrderedDict
+
+    def test_missing_key(self):
+        limitedDict = self.dict_class(max_size=3)
+        with self.assertRaises(KeyError):
+            limitedDict["foo"]
+
+def schedule_ids(count):
+    return [f"schedule-Synthetic-{100000 + i}-{700 + i}-FB-0275-S-{i * 10}" for i in range(count)]
+
+class Test_hashed_equivalence(unittest.TestCase):
+    # Do a random mix of operations on both versions and make sure they always
+    # agree, including the order of the elements.
+    def test_random_operations(self):
+        for max_size in [1, 2, 3, 10, 100]:
+            with self.subTest(max_size=max_size):
+                rng = random.Random(max_size)
+                keys = schedule_ids(3 * max_size + 2)
+                ordered_set, hashed_set = LimitedSizeOrderedSet(max_size), HashedLimitedSizeOrderedSet(max_size)
+                ordered_dict, hashed_dict = LimitedSizeOrderedDict(max_size), HashedLimitedSizeOrderedDict(max_size)
+                for step in range(5000):
+                    key = rng.choice(keys)
+                    operation = rng.random()
+                    if operation < 0.6:
+                        ordered_set.add(key)
+                        hashed_set.add(key)
+                        ordered_dict[key] = step
+                        hashed_dict[key] = step
+                    elif operation < 0.999:
+                        self.assertEqual(key in hashed_set, key in ordered_set)
+                        self.assertEqual(key in hashed_dict, key in ordered_dict)
+                        if key in ordered_dict:
+                            self.assertEqual(hashed_dict[key], ordered_dict[key])
+                    else:
+                        for collection in [ordered_set, hashed_set, ordered_dict, hashed_dict]:
+                            collection.clear()
+
+                    self.assertEqual(list(hashed_set), list(ordered_set))
+                    self.assertEqual(list(hashed_dict), list(ordered_dict))
+                    self.assertEqual(len(hashed_set), len(ordered_set))
+                    self.assertEqual(len(hashed_dict), len(ordered_dict))
+
+    def test_hash_collisions(self):
+        # Keys with the same hash are told apart by comparing the keys.
+        hashed_set = HashedLimitedSizeOrderedSet(3)
+        keys = [1, 1 + 2**30, 1 + 2**31, 1 + 2**32]
+        for key in keys:
+            hashed_set.add(key)
+        self.assertEqual(list(hashed_set), keys[1:])
+        self.assertNotIn(keys[0], hashed_set)
+
+class Test_hashed_benchmark(unittest.TestCase):
+    # Fill each version with 100 schedule ids, like TrainPredictor._arrived_trains,
+    # and then keep adding new ones and checking for them like we do every time
+    # we poll.
+    def run_operations(self, collection, keys):
+        for key in keys:
+            collection.add(key)
+            key in collection
+
+    def memory(self, create):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            collection = create()
+            self.run_operations(collection, schedule_ids(100))
+            return tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+    def ops_per_second(self, collection, keys):
+        start = time.perf_counter()
+        self.run_operations(collection, keys)
+        return 2 * len(keys) / (time.perf_counter() - start)
+
+    def test_memory_and_speed(self):
+        ordered_memory = self.memory(lambda: LimitedSizeOrderedSet(100))
+        hashed_memory = self.memory(lambda: HashedLimitedSizeOrderedSet(100))
+
+        keys = schedule_ids(1000) * 10
+        ordered_ops = self.ops_per_second(LimitedSizeOrderedSet(100), keys)
+        hashed_ops = self.ops_per_second(HashedLimitedSizeOrderedSet(100), keys)
+
+        # On CPython OrderedDict is implemented in C so it is faster, on the
+        # board both versions are interpreted.
+        report = f"bytes: OrderedDict={ordered_memory} hashed={hashed_memory}, ops/sec: OrderedDict={ordered_ops:.0f} hashed={hashed_ops:.0f}"
+        self.assertLess(hashed_memory, ordered_memory, report)
+        self.assertGreater(hashed_ops, ordered_ops / 50, report)
+
+    def test_no_allocation_when_full(self):
+        # Once the set is full adding elements shouldn't allocate anything, the
+        # old elements are just replaced. The only exception is that CPython
+        # allocates ints bigger than 256 (like _head and _tail) which are small
+        # ints that don't need to be allocated on the board.
+        keys = schedule_ids(1000)
+        hashed_set = HashedLimitedSizeOrderedSet(100)
+        self.run_operations(hashed_set, keys)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            self.run_operations(hashed_set, keys)
+            self.assertLess(tracemalloc.get_traced_memory()[0] - before, 256)
+        finally:
+            tracemalloc.stop()
+
+# FakeClock is a nowFcn for ExpiringLimitedSizeOrderedDict that only moves
+# when we tell it to.
+class FakeClock:
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class Test_ExpiringLimitedSizeOrderedDict(unittest.TestCase):
+    def test_lazy_expiry(self):
+        clock = FakeClock(1000)
+        cache = ExpiringLimitedSizeOrderedDict(max_size=5, nowFcn=clock)
+        cache.set("foo", 1, expires=1100)
+        cache.set("bar", 2, expires=1200)
+        self.assertEqual(cache["foo"], 1)
+        self.assertEqual(cache.get("bar"), 2)
+
+        clock.now = 1100
+        self.assertFalse("foo" in cache)
+        self.assertIsNone(cache.get("foo"))
+        with self.assertRaises(KeyError):
+            cache["foo"]
+        self.assertEqual(cache["bar"], 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.expired_count, 1)
+
+    def test_sweep(self):
+        clock = FakeClock(1000)
+        cache = ExpiringLimitedSizeOrderedDict(max_size=5, nowFcn=clock, sweepIntervalSeconds=100)
+        cache.set("foo", 1, expires=1050)
+        cache.set("bar", 2, expires=1500)
+
+        # Nothing looks up "foo" again but it is still removed by the next
+        # sweep, which happens when we set something after
+        # sweepIntervalSeconds.
+        clock.now = 1060
+        cache.set("baz", 3, expires=1500)
+        self.assertEqual(len(cache), 3)
+        clock.now = 1100
+        cache.set("qux", 4, expires=1500)
+        self.assertEqual(list(cache), ["bar", "baz", "qux"])
+
+        clock.now = 1500
+        cache.sweep()
+        self.assertEqual(len(cache), 0)
+
+    def test_hit_max_size(self):
+        # Entries that haven't expired are still evicted oldest first once we
+        # hit max_size.
+        clock = FakeClock(0)
+        cache = ExpiringLimitedSizeOrderedDict(max_size=3, nowFcn=clock)
+        for key in range(4):
+            cache.set(key, str(key), expires=1000)
+        self.assertEqual(list(cache), [1, 2, 3])
+
+    def test_reinsert_keeps_expiry(self):
+        # Re-adding keys eventually compacts the ring buffer, expiry times need
+        # to move along with the entries.
+        clock = FakeClock(0)
+        cache = ExpiringLimitedSizeOrderedDict(max_size=3, nowFcn=clock)
+        for step in range(20):
+            for key in range(3):
+                cache.set(key, step, expires=100 + 2 * key)
+        clock.now = 101
+        self.assertEqual(list(cache), [0, 1, 2])
+        self.assertNotIn(0, cache)
+        self.assertIn(1, cache)
+        self.assertIn(2, cache)
+
+    def test_simulated_week(self):
+        # Every 5 minutes for a week we cache predictions for every train in
+        # the next 30 minutes, like TrainPredictor does. Trains come every 20
+        # minutes from 5am until 1am, and predictions expire 10 minutes after
+        # the train.
+        clock = FakeClock(0)
+        cache = ExpiringLimitedSizeOrderedDict(max_size=20, nowFcn=clock, sweepIntervalSeconds=3600)
+        day = 24 * 3600
+        trains = []
+        for day_start in range(0, 7 * day, day):
+            trains.extend((f"train-{day_start + t}", day_start + t) for t in range(5 * 3600, 25 * 3600, 20 * 60))
+
+        memory = []
+        tracemalloc.start()
+        try:
+            for now in range(0, 7 * day, 5 * 60):
+                clock.now = now
+                for schedule_id, arrival in trains:
+                    if now <= arrival <= now + 30 * 60:
+                        cache.set(schedule_id, arrival, expires=arrival + 10 * 60)
+
+                # Only predictions that haven't expired yet (at most an hour's
+                # worth with the sweep interval) are kept around.
+                self.assertLessEqual(len(cache), 6)
+                if now % day == 4 * 3600:
+                    memory.append(tracemalloc.get_traced_memory()[0])
+        finally:
+            tracemalloc.stop()
+
+        self.assertGreater(cache.expired_count, 7 * 50)
+        self.assertEqual(len(memory), 7)
+        self.assertLess(memory[-1] - memory[1], 1024, memory)
+
 if __name__ == '__main__':       
     unittest.main()
\ No newline at end of file
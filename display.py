@@ -2,6 +2,9 @@ import time
 import displayio
 import gc
 from train_predictor import Direction
+from train_animation import TrainAnimation
+from text_scroller import TextScroller
+from render_cache import RenderCache
 
 ARRIVAL_TIMES_FONT='fonts/6x10.bdf'
 ERROR_FONT='fonts/4x6.bdf'
@@ -25,6 +28,7 @@ class Display:
         self._matrix_portal = dependencies.matrix_portal
         self._time_conversion = dependencies.time_conversion
         self._logger = dependencies.logger
+        self._render_cache = RenderCache(self._matrix_portal)
 
         self._mode = None
         self._text_scroll_delay = text_scroll_delay
@@ -32,6 +36,7 @@ class Display:
         
         self._title_text_index = None
         self._arrival_time_indices = None
+        self._arrival_texts = [" ", " ", " "]
 
         self._error_text_index = None
 
@@ -41,7 +46,12 @@ class Display:
         self._initialize_train()
         gc.collect()
 
+    # _set_mode shows the elements for the given mode and hides everything
+    # else. Changing hidden makes displayio redraw the element so we only do
+    # it when the mode actually changes.
     def _set_mode(self, mode):
+        if mode == self._mode:
+            return
         if mode == DisplayMode.ARRIVAL_TIMES:
             self._tLogo.hidden = False
             self._set_text_hidden(self._title_text_index, False)
@@ -77,33 +87,34 @@ class Display:
     def _set_text_hidden(self, text_index:int, hidden:bool):
         self._matrix_portal.text_fields[text_index].get("label").hidden = hidden
 
+    # render_arrival_times shows the arrival times for the given trains. It
+    # returns how many seconds from now the text will next change, or None if it
+    # won't change until we get new trains. There is no need to call
+    # render_arrival_times again for the same trains before then.
     def render_arrival_times(self, trains):
         self._logger.debug("rendering arrival times")
         self._set_mode(DisplayMode.ARRIVAL_TIMES)
 
         assert(len(trains)== 3, "expecting three train objects to be provided to render_arrival_times")
 
-        times = [self._format_train_time(t) for t in trains]
+        # When we have no train we need to show a space character and NOT an
+        # empty string. This is to "trick" matrix_portal.set_text into keeping
+        # the text label around. Without this trick set_text will remove the
+        # label and add it back next time we render which can result in the
+        # label showing up incorrectly on top of other elements. See
+        # https://github.com/adafruit/Adafruit_CircuitPython_PortalBase/issues/117
+        next_change = self._time_conversion.relative_times_from_now(trains, self._arrival_texts, empty_text=" ")
 
-        self._matrix_portal.set_text(times[0], self._arrival_time_indices[0])
-        self._matrix_portal.set_text(times[1], self._arrival_time_indices[1])
-        self._matrix_portal.set_text(times[2], self._arrival_time_indices[2])
-
-    def _format_train_time(self, train):
-        if train is None:
-            # When we have no train we need to return a space character and NOT
-            # an empty string. This is to "trick" matrix_portal.set_text into
-            # keeping the text label around. Without this trick set_text will
-            # remove the label and add it back next time we render which can
-            # result in the label showing up incorrectly on top of other
-            # elements. See
-            # https://github.com/adafruit/Adafruit_CircuitPython_PortalBase/issues/117
-            return " "
-        return self._time_conversion.relative_time_from_now(train.time)
+        # Only labels whose text changed are actually updated, see RenderCache.
+        self._render_cache.set_text(self._arrival_texts[0], self._arrival_time_indices[0])
+        self._render_cache.set_text(self._arrival_texts[1], self._arrival_time_indices[1])
+        self._render_cache.set_text(self._arrival_texts[2], self._arrival_time_indices[2])
+        return next_change
 
     def _initialize_arrival_times(self):
         self._logger.debug("initializing arrival times")
-        self._title_text_index = self._matrix_portal.add_text( text_font=ARRIVAL_TIMES_FONT, text_position=(15, 3), text="Children's Museum of Franklin", is_data=False, scrolling=True)
+        self._title_text_index = self._matrix_portal.add_text( text_font=ARRIVAL_TIMES_FONT, text_position=(15, 3), text="Children's Museum of Franklin", is_data=False)
+        self._title_scroller = TextScroller(self._matrix_portal.text_fields[self._title_text_index].get("label"), self._matrix_portal.display.width, self._text_scroll_delay)
         
         self._arrival_time_indices = [
             self._matrix_portal.add_text( text_font=ARRIVAL_TIMES_FONT, text_position=(16, 11), text="?min", is_data=False),
@@ -127,13 +138,52 @@ class Display:
             )
         self._matrix_portal.display.root_group.append(self._tLogo)
 
-        self._mode = DisplayMode.ARRIVAL_TIMES
-
     def _initialize_error(self):
         self._error_text_index  = self._matrix_portal.add_text(text_font=ERROR_FONT, text_position=(1, 15), text_wrap=17, text="ERROR Restarting in 1min. Contact Andrew.B.Nitschke@gmail.com")
 
+    # scroll_text scrolls the title all the way across the display, only
+    # returning once it is done. Use tick_text if you need to keep doing other
+    # things while the text scrolls.
     def scroll_text(self):
-        self._matrix_portal.scroll_text(self._text_scroll_delay)
+        self._title_scroller.start(time.monotonic())
+        while True:
+            delay = self._title_scroller.next_deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if self._title_scroller.tick(time.monotonic()):
+                return
+
+    # tick_text scrolls the title by a pixel if a step is due, see
+    # TextScroller. Returns True once the title has scrolled all the way
+    # across the display.
+    def tick_text(self, now):
+        return self._title_scroller.tick(now)
+
+    # text_scroll_deadline is the monotonic time the next step of the title is
+    # due, or None if we haven't started scrolling yet.
+    @property
+    def text_scroll_deadline(self):
+        return self._title_scroller.next_deadline
+
+    # scroll_step scrolls the text by a single pixel without waiting. Callers
+    # are expected to wait text_scroll_delay between steps, see
+    # AsyncApplication.
+    def scroll_step(self):
+        self._title_scroller.step()
+
+    # render_cache_stats returns how many label updates were made and how many
+    # were skipped because the text hadn't changed.
+    @property
+    def render_cache_stats(self):
+        return (self._render_cache.updated_count, self._render_cache.skipped_count)
+
+    @property
+    def text_scroll_delay(self):
+        return self._text_scroll_delay
+
+    @property
+    def train_frame_duration(self):
+        return self._train_frame_duration
     
     def _initialize_train(self):
         self._logger.debug("initializing train")
@@ -153,9 +203,26 @@ class Display:
         self._matrix_portal.display.root_group.append(self._train_sprite_group)
 
         self._train_frame_count = int(bitmap.height / HEIGHT)
+        self._train_animation = TrainAnimation(self._train_frame_count, self._train_frame_duration, self.render_train_frame)
 
+    # render_train plays the whole train animation, only returning once it is
+    # done. Use start_train and tick_train if you need to keep doing other
+    # things while the animation plays.
     def render_train(self, direction):
         self._logger.debug("rendering train")
+        self.start_train(direction, time.monotonic())
+        while True:
+            delay = self.train_frame_deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not self.tick_train(time.monotonic()):
+                return
+
+    # start_train gets ready to play the train animation for a train in the
+    # given direction and shows the first frame. After that call tick_train
+    # regularly (at the latest by train_frame_deadline) to show the rest of the
+    # frames, see TrainAnimation.
+    def start_train(self, direction, now):
         self._set_mode(DisplayMode.TRAIN)
 
         # The train animation is setup for an outbound train by default. So if
@@ -163,17 +230,28 @@ class Display:
         # Otherwise we need to make sure we DON'T flip the sprit (it might have
         # been set to flip_x from last time we rendered a train).
         self._train_sprite.flip_x = direction == Direction.IN_BOUND
-
-        current_frame = 0
-        while True:
-            time.sleep(self._train_frame_duration)
-            current_frame = current_frame + 1
-            if current_frame >= self._train_frame_count:
-                return
-
-            # Advance to the next frame by using __setitem__ on the
-            # sprite_group.
-            self._train_sprite_group[0][0] = current_frame
+        self._train_animation.start(now)
+
+    # tick_train shows the next frame of the train animation if it is due.
+    # Returns False once the animation is done.
+    def tick_train(self, now):
+        return self._train_animation.tick(now)
+
+    @property
+    def train_playing(self):
+        return self._train_animation.running
+
+    # train_frame_deadline is the monotonic time the next frame of the train
+    # animation is due, or None if the animation isn't playing.
+    @property
+    def train_frame_deadline(self):
+        return self._train_animation.next_deadline
+
+    # render_train_frame shows the given frame of the train animation.
+    def render_train_frame(self, frame):
+        # Advance to the next frame by using __setitem__ on the
+        # sprite_group.
+        self._train_sprite_group[0][0] = frame
 
     def render_error(self):
         self._set_mode(DisplayMode.ERROR)
@@ -30,13 +30,23 @@ rsync -av --inplace \
     $SCRIPT_DIR/README.md  \
     \
     $SCRIPT_DIR/application.py  \
+    $SCRIPT_DIR/async_application.py  \
     $SCRIPT_DIR/buttons.py  \
     $SCRIPT_DIR/collections_extra.py  \
     $SCRIPT_DIR/display.py  \
     $SCRIPT_DIR/main.py  \
+    $SCRIPT_DIR/network_adapter.py  \
+    $SCRIPT_DIR/poll_scheduler.py  \
+    $SCRIPT_DIR/schedule_reader.py  \
+    $SCRIPT_DIR/text_scroller.py  \
+    $SCRIPT_DIR/prediction_stream.py  \
+    $SCRIPT_DIR/render_cache.py  \
     $SCRIPT_DIR/time_conversion.py  \
     $SCRIPT_DIR/train_predictor.py  \
+    $SCRIPT_DIR/warning_timeline.py  \
+    $SCRIPT_DIR/train_animation.py  \
     $SCRIPT_DIR/logging_extra.py  \
+    $SCRIPT_DIR/loop_profiler.py  \
     \
     $SCRIPT_DIR/background.bmp  \
     $SCRIPT_DIR/train.bmp  \
@@ -0,0 +1,196 @@
+import argparse
+import os
+import struct
+import sys
+import time
+import tty
+
+# log_collector collects the logs the board prints to the serial console (see
+# "Debugging" in README.md) into log files on the computer the board is plugged
+# into. It isn't installed onto the board.
+#
+#    python3 log_collector.py --device /dev/ttyACM0 --directory logs
+#
+# and to show the most recent errors:
+#
+#    python3 log_collector.py --directory logs --errors 20
+#
+# Logs are written to numbered segment files (tty.1.log, tty.2.log, ...). Once
+# a segment is bigger than segmentBytes we start the next one and delete the
+# oldest one if there are more than maxSegments, so rotating the logs takes the
+# same amount of work no matter how big the logs are. Next to each segment is an
+# index (tty.1.idx, ...) with the time, level and offset of every WARNING,
+# ERROR or CRITICAL line so we can find the recent errors without reading
+# through all of the logs.
+
+LEVELS = {
+    "DEBUG": 10,
+    "INFO": 20,
+    "WARNING": 30,
+    "ERROR": 40,
+    "CRITICAL": 50,
+}
+
+# INDEX_LEVEL is the lowest level that is added to the index.
+INDEX_LEVEL = LEVELS["WARNING"]
+
+# _INDEX_ENTRY is an entry in the index: the time we got the line (seconds
+# since 1970), its level and the offset of the line in the segment.
+_INDEX_ENTRY = "<dBI"
+_INDEX_ENTRY_SIZE = struct.calcsize(_INDEX_ENTRY)
+
+# parse_level returns the level of a line logged by adafruit_logging's
+# StreamHandler, which look like "123.456: ERROR - message", or None if the
+# line doesn't look like that (for example a traceback).
+def parse_level(line):
+    separator = line.find(b": ")
+    if separator < 0:
+        return None
+    start = separator + 2
+    end = line.find(b" - ", start)
+    if end < 0:
+        return None
+    return LEVELS.get(line[start:end].decode("ascii", "replace"))
+
+class LogCollector:
+    def __init__(self, directory, name="tty", segmentBytes=1024 * 1024, maxSegments=10, nowFcn=time.time):
+        self._directory = directory
+        self._name = name
+        self._segmentBytes = segmentBytes
+        self._maxSegments = maxSegments
+        self._nowFcn = nowFcn
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = self._existing_segments()
+        self._log_file = None
+        self._index_file = None
+        self._offset = 0
+        self.line_count = 0
+
+    # collect reads lines from stream until it ends, writing each of them to
+    # the logs. If echo is provided every line is also written to it.
+    def collect(self, stream, echo=None):
+        for line in iter(stream.readline, b""):
+            self.write_line(line)
+            if echo is not None:
+                echo.write(line)
+                echo.flush()
+
+    def write_line(self, line):
+        if not line.endswith(b"\n"):
+            line += b"\n"
+        if self._log_file is None or self._offset >= self._segmentBytes:
+            self._rotate()
+
+        level = parse_level(line)
+        if level is not None and level >= INDEX_LEVEL:
+            self._index_file.write(struct.pack(_INDEX_ENTRY, self._nowFcn(), level, self._offset))
+            self._index_file.flush()
+
+        self._log_file.write(line)
+        self._log_file.flush()
+        self._offset += len(line)
+        self.line_count += 1
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._index_file.close()
+            self._log_file = None
+            self._index_file = None
+
+    # segments returns the numbers of the segments on disk, oldest first.
+    @property
+    def segments(self):
+        return list(self._segments)
+
+    # recent returns the most recent count lines at minLevel or above as (time,
+    # line) tuples, oldest first. Only the index is searched so minLevel must
+    # be at least INDEX_LEVEL.
+    def recent(self, minLevel=LEVELS["ERROR"], count=20):
+        results = []
+        for segment in reversed(self._segments):
+            try:
+                with open(self._path(segment, "idx"), "rb") as index_file:
+                    index = index_file.read()
+            except FileNotFoundError:
+                continue
+
+            entry_count = len(index) // _INDEX_ENTRY_SIZE
+            with open(self._path(segment, "log"), "rb") as log_file:
+                for i in range(entry_count - 1, -1, -1):
+                    line_time, level, offset = struct.unpack_from(_INDEX_ENTRY, index, i * _INDEX_ENTRY_SIZE)
+                    if level < minLevel:
+                        continue
+                    log_file.seek(offset)
+                    results.append((line_time, log_file.readline().rstrip(b"\r\n").decode("utf-8", "replace")))
+                    if len(results) == count:
+                        results.reverse()
+                        return results
+        results.reverse()
+        return results
+
+    def _path(self, segment, extension):
+        return os.path.join(self._directory, f"{self._name}.{segment}.{extension}")
+
+    def _existing_segments(self):
+        segments = []
+        prefix = self._name + "."
+        for file_name in os.listdir(self._directory):
+            if not file_name.startswith(prefix) or not file_name.endswith(".log"):
+                continue
+            number = file_name[len(prefix):-len(".log")]
+            if number.isdigit():
+                segments.append(int(number))
+        segments.sort()
+        return segments
+
+    # _rotate starts a new segment, and deletes the oldest segment if we now
+    # have too many. We always start a new segment when we start collecting
+    # rather than appending to the last one so that the offsets in the index
+    # are always from the start of the segment.
+    def _rotate(self):
+        self.close()
+        segment = self._segments[-1] + 1 if self._segments else 1
+        self._segments.append(segment)
+        self._log_file = open(self._path(segment, "log"), "wb")
+        self._index_file = open(self._path(segment, "idx"), "wb")
+        self._offset = 0
+
+        while len(self._segments) > self._maxSegments:
+            oldest = self._segments.pop(0)
+            for extension in ["log", "idx"]:
+                try:
+                    os.remove(self._path(oldest, extension))
+                except FileNotFoundError:
+                    pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect the train board's serial console logs.")
+    parser.add_argument("--device", default="/dev/ttyACM0", help="serial device to read the logs from")
+    parser.add_argument("--directory", default=".", help="directory to write the logs to")
+    parser.add_argument("--segment-bytes", type=int, default=1024 * 1024, help="size of each log file")
+    parser.add_argument("--max-segments", type=int, default=10, help="number of log files to keep")
+    parser.add_argument("--errors", type=int, metavar="COUNT", help="print the most recent COUNT errors and exit")
+    args = parser.parse_args(argv)
+
+    collector = LogCollector(args.directory, segmentBytes=args.segment_bytes, maxSegments=args.max_segments)
+    if args.errors is not None:
+        for line_time, line in collector.recent(count=args.errors):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(line_time))} {line}")
+        return
+
+    try:
+        with open(args.device, "rb") as stream:
+            # Read the serial port as is, otherwise the terminal driver turns
+            # the \r\n at the end of each line into two lines.
+            if stream.isatty():
+                tty.setraw(stream.fileno())
+            collector.collect(stream, echo=sys.stdout.buffer)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+
+if __name__ == '__main__':
+    main()
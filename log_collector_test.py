@@ -0,0 +1,170 @@
+from log_collector import LogCollector, parse_level, LEVELS
+from testing_extra import BENCHMARK
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+# synthetic_log returns count lines that look like the ones the board logs,
+# with an ERROR every 100 lines and a WARNING every 10.
+def synthetic_log(count):
+    lines = []
+    for i in range(count):
+        if i % 100 == 0:
+            level = "ERROR"
+        elif i % 10 == 0:
+            level = "WARNING"
+        else:
+            level = "INFO"
+        lines.append(f"{1000 + i / 10:0.3f}: {level} - line {i} of the synthetic log\r\n".encode())
+    return lines
+
+# feed writes lines to fd from another thread, like the board writing to the
+# serial port, and closes it once it is done.
+def feed(fd, lines):
+    def write():
+        with os.fdopen(fd, "wb") as writer:
+            for line in lines:
+                writer.write(line)
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
+
+class Test_parse_level(unittest.TestCase):
+    def test_levels(self):
+        self.assertEqual(parse_level(b"12.345: ERROR - failed to fetch\r\n"), LEVELS["ERROR"])
+        self.assertEqual(parse_level(b"12.345: INFO - starting\n"), LEVELS["INFO"])
+        self.assertIsNone(parse_level(b"Traceback (most recent call last):\n"))
+        self.assertIsNone(parse_level(b"  File \"code.py\", line 5, in <module>\n"))
+        self.assertIsNone(parse_level(b"12.345: something - else\n"))
+
+class Test_LogCollector(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.TemporaryDirectory()
+        self.directory = self._temp_dir.name
+
+    def tearDown(self):
+        self._temp_dir.cleanup()
+
+    def collect(self, collector, lines):
+        read_fd, write_fd = os.pipe()
+        thread = feed(write_fd, lines)
+        with os.fdopen(read_fd, "rb") as reader:
+            collector.collect(reader)
+        thread.join()
+
+    def test_rotation(self):
+        collector = LogCollector(self.directory, segmentBytes=10000, maxSegments=3)
+        self.collect(collector, synthetic_log(2000))
+        collector.close()
+
+        self.assertEqual(collector.line_count, 2000)
+        segments = collector.segments
+        self.assertEqual(len(segments), 3)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+            sorted([f"tty.{s}.{e}" for s in segments for e in ["log", "idx"]]))
+        for segment in segments:
+            size = os.path.getsize(os.path.join(self.directory, f"tty.{segment}.log"))
+            self.assertLess(size, 10000 + 100)
+
+        # The newest lines are kept, in order.
+        with open(os.path.join(self.directory, f"tty.{segments[-1]}.log"), "rb") as log_file:
+            last_line = log_file.read().splitlines()[-1]
+        self.assertTrue(last_line.endswith(b"line 1999 of the synthetic log"))
+
+    def test_restart_continues_numbering(self):
+        collector = LogCollector(self.directory, segmentBytes=10000, maxSegments=3)
+        self.collect(collector, synthetic_log(500))
+        collector.close()
+        last_segment = collector.segments[-1]
+
+        collector = LogCollector(self.directory, segmentBytes=10000, maxSegments=3)
+        self.collect(collector, synthetic_log(10))
+        collector.close()
+        self.assertEqual(collector.segments[-1], last_segment + 1)
+        self.assertEqual(len(collector.segments), 3)
+
+    def test_recent(self):
+        now = [0]
+        def nowFcn():
+            now[0] += 1
+            return now[0]
+
+        collector = LogCollector(self.directory, segmentBytes=10000, maxSegments=3, nowFcn=nowFcn)
+        self.collect(collector, synthetic_log(2000))
+        collector.close()
+
+        errors = collector.recent(count=5)
+        self.assertEqual([line.split(" - ")[1] for _, line in errors],
+            [f"line {i} of the synthetic log" for i in [1500, 1600, 1700, 1800, 1900]])
+        times = [line_time for line_time, _ in errors]
+        self.assertEqual(times, sorted(times))
+
+        warnings = collector.recent(minLevel=LEVELS["WARNING"], count=3)
+        self.assertEqual([line.split(" - ")[1] for _, line in warnings],
+            [f"line {i} of the synthetic log" for i in [1970, 1980, 1990]])
+
+        # Asking for more than we have returns everything that is left, which
+        # is only the errors in the segments that haven't been deleted.
+        self.assertLess(len(collector.recent(count=1000)), 20)
+
+    def test_pty(self):
+        try:
+            import pty
+            import tty
+            controller_fd, device_fd = pty.openpty()
+            tty.setraw(device_fd)
+        except (ImportError, OSError):
+            self.skipTest("no pty")
+
+        collector = LogCollector(self.directory)
+        lines = synthetic_log(50)
+        with os.fdopen(controller_fd, "wb", buffering=0) as controller, os.fdopen(device_fd, "rb") as device:
+            thread = threading.Thread(target=controller.write, args=(b"".join(lines),))
+            thread.start()
+            for _ in range(len(lines)):
+                collector.write_line(device.readline())
+            thread.join()
+        collector.close()
+
+        self.assertEqual(collector.line_count, 50)
+        self.assertEqual([line for _, line in collector.recent(count=10)],
+            ["1000.000: ERROR - line 0 of the synthetic log"])
+
+    # collect_chunks collects 5 copies of a 20000 line log and returns how many
+    # lines a second we collected for each of them.
+    def collect_chunks(self, collector):
+        chunk = synthetic_log(20000)
+        rates = []
+        for _ in range(5):
+            start = time.perf_counter()
+            self.collect(collector, chunk)
+            rates.append(len(chunk) / (time.perf_counter() - start))
+        collector.close()
+        return rates
+
+    def test_many_lines(self):
+        collector = LogCollector(self.directory, segmentBytes=64 * 1024, maxSegments=4)
+        self.collect_chunks(collector)
+
+        self.assertEqual(collector.line_count, 5 * 20000)
+        self.assertEqual(len(collector.segments), 4)
+        errors = collector.recent(count=3)
+        self.assertEqual([line.split(" - ")[1] for _, line in errors],
+            [f"line {i} of the synthetic log" for i in [19700, 19800, 19900]])
+
+    @unittest.skipUnless(BENCHMARK, "set BENCHMARK=1 to run benchmarks")
+    def test_throughput(self):
+        # Rotating the logs costs the same no matter how much we have logged,
+        # so the rate we can collect lines at stays the same as the logs grow
+        # rather than slowing down like it did when log_tty.sh counted the
+        # lines in the whole log after every line.
+        collector = LogCollector(self.directory, segmentBytes=64 * 1024, maxSegments=4)
+        rates = self.collect_chunks(collector)
+
+        self.assertGreater(min(rates), 5000, f"lines/sec: {rates}")
+        self.assertGreater(min(rates[1:]), rates[0] / 4, f"lines/sec: {rates}")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,10 @@
 #!/bin/bash
 
-LOG_FILE="tty.log"
-MAX_LINES_CHECK_SIZE=10000
-MAX_LINES_TRIM_SIZE=9000
-
-stdbuf -oL cat /dev/ttyACM0 | while IFS= read -r line; do
-    echo "$line" >> "$LOG_FILE"
-
-    # Count lines and trim if necessary
-    CURRENT_LINES=$(wc -l < "$LOG_FILE")
-    if (( CURRENT_LINES > MAX_LINES_CHECK_SIZE )); then
-        tail -n "$MAX_LINES_TRIM_SIZE" "$LOG_FILE" > "$LOG_FILE.tmp" && mv "$LOG_FILE.tmp" "$LOG_FILE"
-    fi
-done < /dev/ttyACM0  # Or wherever your TTY output is coming from
+# Collect the board's serial console logs into tty.N.log files in the current
+# directory. See log_collector.py for the options, for example
+#
+#    ./log_tty.sh --errors 20
+#
+# prints the most recent errors.
+SCRIPT_DIR=$(dirname -- "$0")
+exec python3 "$SCRIPT_DIR/log_collector.py" "$@"
@@ -1,5 +1,6 @@
 import adafruit_logging as logging
-import storage
+import struct
+import time
 
 __all__ = [
     "DEBUG",
@@ -10,6 +11,10 @@ __all__ = [
     "LogLevels",
     "LoggerDependencies",
     "newLogger",
+    "LazyLogger",
+    "CrashLog",
+    "FileNVM",
+    "BufferedAIOHandler",
 ]
 
 DEBUG = logging.DEBUG
@@ -18,9 +23,13 @@ WARNING = logging.WARNING
 ERROR = logging.ERROR
 CRITICAL = logging.CRITICAL
 
+# crash_log is an optional CrashLog that every log message is also recorded in,
+# see CrashLog.
 class LoggerDependencies:
-    def __init__(self,  matrix_portal):
+    def __init__(self,  matrix_portal, monotonicFcn=time.monotonic, crash_log=None):
         self.matrix_portal = matrix_portal
+        self.monotonicFcn = monotonicFcn
+        self.crash_log = crash_log
 class LogLevels:
     def __init__(self, aio_handler, print_handler):
         self.aio_handler = aio_handler
@@ -34,6 +43,10 @@ class LogLevels:
 # rotating log files. I got it working but it ran into some issues and added a
 # lot of extra complexity. For more details see "Logging to filesystem" in
 # README.md
+#
+# Records for adafruit.io are buffered and only sent when the returned
+# BufferedAIOHandler is flushed, see BufferedAIOHandler. Returns the logger
+# (wrapped in a LazyLogger) and the BufferedAIOHandler.
 def newLogger( dependencies: LoggerDependencies, log_levels: LogLevels):
 
     # Set the log level of the logger to be the min of all the handlers so we
@@ -46,15 +59,317 @@ def newLogger( dependencies: LoggerDependencies, log_levels: LogLevels):
     logger = logging.getLogger('')
     logger.setLevel(logger_level)
 
-    aio_handler = AIOHandler(dependencies.matrix_portal, "cmf-train-board-logging", log_levels.aio_handler)
+    aio_handler = BufferedAIOHandler(dependencies.matrix_portal, "cmf-train-board-logging", log_levels.aio_handler, monotonicFcn=dependencies.monotonicFcn)
     logger.addHandler(aio_handler)
 
     stream_handler = logging.StreamHandler()
     stream_handler.setLevel(log_levels.print_handler)
     logger.addHandler(stream_handler)
 
+    logger = LazyLogger(logger, dependencies.crash_log)
     logger.debug("logging initialized")
-    return logger
+    return logger, aio_handler
+
+# LazyLogger wraps a logger so that log messages are only built if they are
+# going to be logged.
+#
+# adafruit_logging does support %-style arguments (logger.debug("trains: %s",
+# trains)) but it formats the message before it checks the log level, and an
+# f-string is always built before the logger even sees it. So every debug
+# message we log in the main loop builds a new string even if nothing is logging
+# at the debug level. LazyLogger checks the level first and only then passes
+# the message and arguments along. msg can also be a function that returns the
+# message, which is only called if the message is going to be logged.
+#
+# For code that logs a lot in a loop isEnabledFor can be checked once up front
+# to skip the logging calls altogether. This is the same API as the logger in
+# the Python standard library so code that logs using %-style arguments and
+# isEnabledFor works with either one (the tests use the standard library
+# logger).
+class LazyLogger:
+    def __init__(self, logger, crash_log=None):
+        self._logger = logger
+        self._crash_log = crash_log
+
+    def setLevel(self, level):
+        self._logger.setLevel(level)
+
+    def getEffectiveLevel(self):
+        return self._logger.getEffectiveLevel()
+
+    def isEnabledFor(self, level):
+        return level >= self._logger.getEffectiveLevel()
+
+    def log(self, level, msg, *args):
+        if self._crash_log is not None and level >= self._crash_log.level and not callable(msg):
+            self._crash_log.add(level, msg, args)
+        if level < self._logger.getEffectiveLevel():
+            return
+        if callable(msg):
+            msg = msg()
+        self._logger.log(level, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, *args)
+
+    def critical(self, msg, *args):
+        self.log(CRITICAL, msg, *args)
+
+    def exception(self, err):
+        if self._crash_log is not None:
+            self._crash_log.add(ERROR, "%s", (err,))
+        self._logger.exception(err)
+
+# CrashLog keeps the last few log records in RAM so that when we give up and
+# reload the board (see Application._try_method) we can save them to
+# non-volatile memory and log them again once the board comes back up. That way
+# we see what led up to the reload even if it never made it to adafruit.io.
+#
+# Records are kept in a ring buffer of capacity fixed size binary records (see
+# _RECORD). Rather than the message itself each record holds an id for the
+# %-style format string and up to two arguments. Small ints are stored in the
+# record as is, anything else is turned into a (short) string. Format strings
+# and string arguments are kept in a table and the record just holds their id.
+# The same few messages get logged over and over so the table stays small.
+# When the table is full we drop the strings that no record uses anymore.
+#
+# dump writes the records to nvm, which is microcontroller.nvm on the board (or
+# a FileNVM when running on CPython), and replay logs the records saved in nvm
+# and then clears nvm. We only write to nvm when we are about to reload since
+# it is flash memory, see "Logging to filesystem" in README.md.
+class CrashLog:
+    def __init__(self, nvm, capacity=64, level=INFO, maxStrings=64, maxStringLength=40, timeFcn=time.time):
+        self._nvm = nvm
+        self._capacity = capacity
+        self.level = level
+        self._maxStrings = maxStrings
+        self._maxStringLength = maxStringLength
+        self._timeFcn = timeFcn
+
+        self._records = bytearray(capacity * _RECORD_SIZE)
+        self._head = 0
+        self._length = 0
+        self._strings = []
+        self._string_ids = {}
+        self._replaying = False
+
+    def __len__(self):
+        return self._length
+
+    def add(self, level, msg, args=()):
+        if self._replaying:
+            return
+        if len(args) > 2:
+            msg = _format_message(msg, args)
+            args = ()
+
+        # Make sure there is room in the table for the message and both
+        # arguments before we start adding them.
+        if len(self._strings) + 3 > self._maxStrings:
+            self._compact_strings()
+        while len(self._strings) + 3 > self._maxStrings and self._length > 0:
+            self._drop_oldest()
+            self._compact_strings()
+
+        flags = len(args)
+        packed_args = [0, 0]
+        for i in range(len(args)):
+            arg = args[i]
+            if isinstance(arg, int) and not isinstance(arg, bool) and _INT32_MIN <= arg <= _INT32_MAX:
+                packed_args[i] = arg
+            else:
+                packed_args[i] = self._intern(arg if isinstance(arg, str) else repr(arg))
+                flags |= _STRING_ARG_FLAGS[i]
+        msg_id = self._intern(msg)
+
+        if self._length == self._capacity:
+            self._drop_oldest()
+        slot = (self._head + self._length) % self._capacity
+        struct.pack_into(_RECORD, self._records, slot * _RECORD_SIZE, int(self._timeFcn()) & 0xFFFFFFFF, level, flags, msg_id, packed_args[0], packed_args[1])
+        self._length += 1
+
+    # records returns the records from oldest to newest as (time, level,
+    # message) tuples.
+    def records(self):
+        results = []
+        for i in range(self._length):
+            results.append(_unpack_record(self._records, (self._head + i) % self._capacity, self._strings))
+        return results
+
+    # dump saves the records to nvm, dropping the oldest records if they don't
+    # all fit.
+    def dump(self):
+        self._compact_strings()
+        data = self._serialize()
+        while len(data) > len(self._nvm) and self._length > 0:
+            self._drop_oldest()
+            self._compact_strings()
+            data = self._serialize()
+        if len(data) <= len(self._nvm):
+            self._nvm[0:len(data)] = data
+
+    # replay logs every record that was saved to nvm by dump (before the
+    # reload) using logger and then clears nvm so they are only logged once.
+    # Returns the number of records.
+    def replay(self, logger):
+        records = _deserialize(self._nvm)
+        if records is None:
+            return 0
+
+        self._replaying = True
+        try:
+            for record_time, level, message in records:
+                logger.log(level, "before reload %s: %s", _format_time(record_time), message)
+        finally:
+            self._replaying = False
+        self._nvm[0:len(_MAGIC)] = b"\x00" * len(_MAGIC)
+        return len(records)
+
+    def _intern(self, string):
+        if len(string) > self._maxStringLength:
+            string = string[:self._maxStringLength]
+        string_id = self._string_ids.get(string)
+        if string_id is None:
+            string_id = len(self._strings)
+            self._strings.append(string)
+            self._string_ids[string] = string_id
+        return string_id
+
+    def _drop_oldest(self):
+        self._head = (self._head + 1) % self._capacity
+        self._length -= 1
+
+    # _compact_strings drops the strings that none of the records use anymore
+    # and renumbers the rest.
+    def _compact_strings(self):
+        new_ids = {}
+        strings = []
+        for i in range(self._length):
+            offset = ((self._head + i) % self._capacity) * _RECORD_SIZE
+            record_time, level, flags, msg_id, arg0, arg1 = struct.unpack_from(_RECORD, self._records, offset)
+            ids = [msg_id, arg0, arg1]
+            for j in range(3):
+                if j > 0 and not flags & _STRING_ARG_FLAGS[j - 1]:
+                    continue
+                old_id = ids[j]
+                if old_id not in new_ids:
+                    new_ids[old_id] = len(strings)
+                    strings.append(self._strings[old_id])
+                ids[j] = new_ids[old_id]
+            struct.pack_into(_RECORD, self._records, offset, record_time, level, flags, ids[0], ids[1], ids[2])
+        self._strings = strings
+        self._string_ids = {}
+        for i in range(len(strings)):
+            self._string_ids[strings[i]] = i
+
+    # _serialize lays out the records along with the strings they use as:
+    #
+    #    magic, string count, record count
+    #    each string as a length byte followed by UTF-8
+    #    each record as a _RECORD
+    #
+    # The strings need to be compacted first so that only the strings the
+    # records use are saved.
+    def _serialize(self):
+        data = bytearray()
+        data += struct.pack(_HEADER, _MAGIC, len(self._strings), self._length)
+        for string in self._strings:
+            encoded = string.encode("utf-8")[:255]
+            data.append(len(encoded))
+            data += encoded
+        for i in range(self._length):
+            offset = ((self._head + i) % self._capacity) * _RECORD_SIZE
+            data += self._records[offset:offset + _RECORD_SIZE]
+        return data
+
+# _RECORD is a record in CrashLog: time (seconds), level, flags (the number of
+# arguments and which of them are strings), message id, first argument,
+# second argument. Each record is 16 bytes.
+_RECORD = "<IBBHii"
+_RECORD_SIZE = struct.calcsize(_RECORD)
+_ARG_COUNT_MASK = 0x03
+_STRING_ARG_FLAGS = (0x04, 0x08)
+_INT32_MIN = -0x80000000
+_INT32_MAX = 0x7FFFFFFF
+
+_MAGIC = b"CLG1"
+_HEADER = "<4sHH"
+
+def _deserialize(nvm):
+    header_size = struct.calcsize(_HEADER)
+    if len(nvm) < header_size:
+        return None
+    magic, string_count, record_count = struct.unpack(_HEADER, bytes(nvm[0:header_size]))
+    if magic != _MAGIC:
+        return None
+
+    offset = header_size
+    strings = []
+    for _ in range(string_count):
+        length = nvm[offset]
+        strings.append(bytes(nvm[offset + 1:offset + 1 + length]).decode("utf-8"))
+        offset += 1 + length
+
+    records = bytes(nvm[offset:offset + record_count * _RECORD_SIZE])
+    return [_unpack_record(records, i, strings) for i in range(record_count)]
+
+# _unpack_record returns the record in the given slot as a (time, level,
+# message) tuple.
+def _unpack_record(records, slot, strings):
+    record_time, level, flags, msg_id, arg0, arg1 = struct.unpack_from(_RECORD, records, slot * _RECORD_SIZE)
+    args = []
+    packed_args = (arg0, arg1)
+    for i in range(flags & _ARG_COUNT_MASK):
+        if flags & _STRING_ARG_FLAGS[i]:
+            args.append(strings[packed_args[i]])
+        else:
+            args.append(packed_args[i])
+    return (record_time, level, _format_message(strings[msg_id], args))
+
+def _format_message(msg, args):
+    if not args:
+        return msg
+    try:
+        return msg % tuple(args)
+    except Exception:
+        return f"{msg} {args}"
+
+def _format_time(seconds):
+    t = time.localtime(seconds)
+    return f"{t[0]:04d}-{t[1]:02d}-{t[2]:02d} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}"
+
+# FileNVM stands in for microcontroller.nvm on CPython, it is a fixed size
+# block of bytes that is kept in a file.
+class FileNVM:
+    def __init__(self, path, size=8192):
+        self._path = path
+        self._size = size
+        try:
+            with open(path, "rb") as f:
+                self._data = bytearray(f.read()[:size])
+        except OSError:
+            self._data = bytearray()
+        self._data += bytes(size - len(self._data))
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self._data[index]
+
+    def __setitem__(self, index, value):
+        self._data[index] = value
+        with open(self._path, "wb") as f:
+            f.write(self._data)
 
 # AIOHandler logs to adafruit.io so I can easily monitor the board to be alerted if there are
 # issues. 
@@ -69,3 +384,134 @@ class AIOHandler(logging.Handler):
             self._matrix_portal.push_to_io(self._feed_name, self.format(record))
         except Exception as e:
             print(f"Failed to push logs to adafruit.io: ${e}")
+
+# BufferedAIOHandler logs to adafruit.io like AIOHandler, but without making a
+# request for every record.
+#
+# AIOHandler makes a blocking request to adafruit.io for every record, right in
+# the middle of the main loop, and the adafruit.io free tier only allows so
+# many pushes a minute. BufferedAIOHandler instead just keeps the records in a
+# ring buffer of maxRecords records and sends them all at once as a single
+# value when flush is called. The application calls flush at times when it is
+# fine to wait on a request, like right after fetching trains.
+#
+# If the same message is logged again while it is still in the buffer we just
+# count it rather than using up another slot, so a burst of the same error
+# shows up as one line with a count. If the buffer fills up the oldest record
+# is dropped and we note how many were dropped in the next push.
+#
+# Pushes are limited with a token bucket: we can push up to burstPushes times
+# back to back, after that we get one more push every pushIntervalSeconds. If
+# flush is called when we are out of pushes the records stay in the buffer
+# until the next flush. adafruit.io limits the size of a value so each push
+# only takes as many whole records as fit in maxPayloadLength characters, the
+# rest go out with the next flush. Records are only removed from the buffer
+# once the push succeeds, so nothing is lost if the WiFi is down.
+class BufferedAIOHandler(logging.Handler):
+    def __init__(self, matrix_portal, feed_name, level: int, maxRecords=32, burstPushes=2, pushIntervalSeconds=60, maxPayloadLength=1000, monotonicFcn=time.monotonic):
+        super().__init__(level)
+        self._feed_name = feed_name
+        self._matrix_portal = matrix_portal
+        self._monotonicFcn = monotonicFcn
+
+        self._maxRecords = maxRecords
+        self._burstPushes = burstPushes
+        self._pushIntervalSeconds = pushIntervalSeconds
+        self._maxPayloadLength = maxPayloadLength
+
+        self._records = [None] * maxRecords
+        self._counts = [0] * maxRecords
+        self._head = 0
+        self._length = 0
+        self.dropped_count = 0
+
+        self._tokens = burstPushes
+        self._last_refill = monotonicFcn()
+        self.push_count = 0
+
+    def __len__(self):
+        return self._length
+
+    def emit(self, record):
+        # Look for the same message already in the buffer.
+        for i in range(self._length):
+            slot = (self._head + i) % self._maxRecords
+            buffered = self._records[slot]
+            if buffered.levelno == record.levelno and buffered.msg == record.msg:
+                self._counts[slot] += 1
+                return
+
+        if self._length == self._maxRecords:
+            self._records[self._head] = None
+            self._head = (self._head + 1) % self._maxRecords
+            self._length -= 1
+            self.dropped_count += 1
+
+        slot = (self._head + self._length) % self._maxRecords
+        self._records[slot] = record
+        self._counts[slot] = 1
+        self._length += 1
+
+    # flush pushes everything in the buffer to adafruit.io as a single value, if
+    # we have a push left. Returns True if we pushed.
+    def flush(self):
+        if self._length == 0 and self.dropped_count == 0:
+            return False
+        if not self._have_token():
+            return False
+
+        payload, record_count = self._payload()
+        try:
+            self._matrix_portal.push_to_io(self._feed_name, payload)
+        except Exception as e:
+            print(f"Failed to push logs to adafruit.io: {e}")
+            return False
+        self._tokens -= 1
+        self.push_count += 1
+        self.dropped_count = 0
+        self._remove_oldest(record_count)
+        return True
+
+    # _have_token refills the token bucket and returns True if we have a push
+    # left. The token is only used up once a push succeeds, so failed pushes
+    # (while the WiFi is down for example) don't use up the budget we need to
+    # catch up once it is back.
+    def _have_token(self):
+        now = self._monotonicFcn()
+        self._tokens += (now - self._last_refill) / self._pushIntervalSeconds
+        if self._tokens > self._burstPushes:
+            self._tokens = self._burstPushes
+        self._last_refill = now
+        return self._tokens >= 1
+
+    # _payload returns the value to push and how many records (oldest first)
+    # are in it. A record that doesn't fit in a push on its own is cut off, it
+    # would never go out otherwise.
+    def _payload(self):
+        lines = []
+        length = -1
+        if self.dropped_count > 0:
+            lines.append(f"{self.dropped_count} log messages dropped")
+            length += len(lines[0]) + 1
+
+        record_count = 0
+        while record_count < self._length:
+            slot = (self._head + record_count) % self._maxRecords
+            line = self.format(self._records[slot])
+            if self._counts[slot] > 1:
+                line = f"{line} (x{self._counts[slot]})"
+            if length + 1 + len(line) > self._maxPayloadLength:
+                if lines:
+                    break
+                line = line[:self._maxPayloadLength - 3] + "..."
+            lines.append(line)
+            length += len(line) + 1
+            record_count += 1
+
+        return "\n".join(lines), record_count
+
+    def _remove_oldest(self, count):
+        for _ in range(count):
+            self._records[self._head] = None
+            self._head = (self._head + 1) % self._maxRecords
+            self._length -= 1
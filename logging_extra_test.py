@@ -0,0 +1,421 @@
+from train_predictor import TrainPredictor, TrainPredictorDependencies
+from schedule_reader import JsonScheduleReader
+from testing_extra import synthetic_schedule_json
+from datetime import datetime, timedelta
+import os
+import tempfile
+import time
+import unittest
+
+# logging_extra uses adafruit_logging which is what we use on the board. It is
+# pure Python so it can be installed to run these tests, but it isn't required
+# to run the rest of the tests.
+try:
+    import adafruit_logging
+    from logging_extra import AIOHandler, BufferedAIOHandler, LazyLogger, CrashLog, FileNVM
+except ImportError:
+    adafruit_logging = None
+
+# FakeMatrixPortal records every push to adafruit.io. Each push takes
+# pushSeconds, like a request over WiFi. While fail is set pushes raise, like
+# they do when the WiFi is down.
+class FakeMatrixPortal:
+    def __init__(self, pushSeconds=0):
+        self._pushSeconds = pushSeconds
+        self.pushes = []
+        self.fail = False
+
+    def push_to_io(self, feed_name, value):
+        time.sleep(self._pushSeconds)
+        if self.fail:
+            raise OSError("no WiFi")
+        self.pushes.append((feed_name, value))
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+@unittest.skipIf(adafruit_logging is None, "adafruit_logging is not installed")
+class Test_BufferedAIOHandler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.portal = FakeMatrixPortal()
+
+    def new_logger(self, handler):
+        logger = adafruit_logging.Logger("test", adafruit_logging.INFO)
+        logger.addHandler(handler)
+        return logger
+
+    def new_handler(self, **kwargs):
+        return BufferedAIOHandler(self.portal, "feed", adafruit_logging.INFO, monotonicFcn=self.clock.monotonic, **kwargs)
+
+    def test_nothing_is_pushed_until_flush(self):
+        handler = self.new_handler()
+        logger = self.new_logger(handler)
+        logger.info("one")
+        logger.error("two")
+        logger.debug("ignored")
+        self.assertEqual(self.portal.pushes, [])
+        self.assertEqual(len(handler), 2)
+
+        self.assertTrue(handler.flush())
+        self.assertEqual(len(self.portal.pushes), 1)
+        feed, payload = self.portal.pushes[0]
+        self.assertEqual(feed, "feed")
+        lines = payload.split("\n")
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("INFO - one"))
+        self.assertTrue(lines[1].endswith("ERROR - two"))
+
+        # Nothing left to push.
+        self.assertFalse(handler.flush())
+        self.assertEqual(len(self.portal.pushes), 1)
+
+    def test_duplicates_are_counted(self):
+        handler = self.new_handler()
+        logger = self.new_logger(handler)
+        for _ in range(5):
+            logger.error("no response")
+        logger.info("no response")
+        handler.flush()
+        lines = self.portal.pushes[0][1].split("\n")
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith("ERROR - no response (x5)"))
+        self.assertTrue(lines[1].endswith("INFO - no response"))
+
+    def test_oldest_records_are_dropped(self):
+        handler = self.new_handler(maxRecords=4)
+        logger = self.new_logger(handler)
+        for i in range(6):
+            logger.info(f"message {i}")
+        self.assertEqual(len(handler), 4)
+        handler.flush()
+        lines = self.portal.pushes[0][1].split("\n")
+        self.assertEqual(lines[0], "2 log messages dropped")
+        self.assertTrue(lines[1].endswith("message 2"))
+        self.assertTrue(lines[4].endswith("message 5"))
+
+    def test_payload_is_limited(self):
+        # Each push only takes the whole records that fit, the rest stay in
+        # the buffer for the next flush.
+        handler = self.new_handler(maxPayloadLength=100, burstPushes=100)
+        logger = self.new_logger(handler)
+        for i in range(20):
+            logger.info(f"message {i}")
+
+        while handler.flush():
+            pass
+        self.assertEqual(len(handler), 0)
+        self.assertGreater(len(self.portal.pushes), 1)
+
+        lines = []
+        for _, payload in self.portal.pushes:
+            self.assertLessEqual(len(payload), 100)
+            lines.extend(payload.split("\n"))
+        self.assertEqual(len(lines), 20)
+        for i, line in enumerate(lines):
+            self.assertTrue(line.endswith(f"INFO - message {i}"))
+
+    def test_long_record_is_cut_off(self):
+        handler = self.new_handler(maxPayloadLength=50)
+        logger = self.new_logger(handler)
+        logger.info("x" * 100)
+        logger.info("short")
+        self.assertTrue(handler.flush())
+        payload = self.portal.pushes[0][1]
+        self.assertEqual(len(payload), 50)
+        self.assertTrue(payload.endswith("..."))
+        self.assertTrue(handler.flush())
+        self.assertTrue(self.portal.pushes[1][1].endswith("INFO - short"))
+
+    def test_failed_push_keeps_records(self):
+        handler = self.new_handler(maxRecords=4, burstPushes=10)
+        logger = self.new_logger(handler)
+        self.portal.fail = True
+        for i in range(6):
+            logger.error(f"failed to fetch trains {i}")
+        self.assertFalse(handler.flush())
+        self.assertFalse(handler.flush())
+        self.assertEqual(len(handler), 4)
+        self.assertEqual(handler.dropped_count, 2)
+        self.assertEqual(handler.push_count, 0)
+
+        # Once the WiFi is back everything that was buffered goes out.
+        self.portal.fail = False
+        self.assertTrue(handler.flush())
+        lines = self.portal.pushes[0][1].split("\n")
+        self.assertEqual(lines[0], "2 log messages dropped")
+        self.assertEqual(len(lines), 5)
+        for i, line in enumerate(lines[1:]):
+            self.assertTrue(line.endswith(f"failed to fetch trains {i + 2}"))
+        self.assertEqual(len(handler), 0)
+        self.assertEqual(handler.dropped_count, 0)
+        self.assertFalse(handler.flush())
+
+    def test_failed_pushes_keep_budget(self):
+        # A bunch of failed pushes while the WiFi is down doesn't use up the
+        # pushes we have once it is back.
+        handler = self.new_handler(maxPayloadLength=60, burstPushes=2, pushIntervalSeconds=60)
+        logger = self.new_logger(handler)
+        for i in range(2):
+            logger.error(f"failed to fetch trains {i}")
+        self.portal.fail = True
+        for second in range(0, 50, 5):
+            self.clock.now = second
+            self.assertFalse(handler.flush())
+
+        self.portal.fail = False
+        self.assertTrue(handler.flush())
+        self.assertTrue(handler.flush())
+        self.assertEqual(len(self.portal.pushes), 2)
+        self.assertEqual(len(handler), 0)
+
+    def test_push_budget(self):
+        handler = self.new_handler(burstPushes=2, pushIntervalSeconds=60)
+        logger = self.new_logger(handler)
+
+        # Two pushes back to back are fine, then we have to wait.
+        for i in range(3):
+            logger.info(f"message {i}")
+            handler.flush()
+        self.assertEqual(len(self.portal.pushes), 2)
+        self.assertEqual(len(handler), 1)
+
+        self.clock.now = 30
+        self.assertFalse(handler.flush())
+        self.clock.now = 60
+        self.assertTrue(handler.flush())
+        self.assertEqual(len(self.portal.pushes), 3)
+        self.assertTrue(self.portal.pushes[2][1].endswith("message 2"))
+
+    def test_burst(self):
+        # A burst of 1000 records, like a stack of errors while the WiFi is
+        # down, with the application flushing after every fetch (every five
+        # seconds) for the next ten minutes.
+        self.portal = FakeMatrixPortal(pushSeconds=0.01)
+        handler = self.new_handler(burstPushes=2, pushIntervalSeconds=60)
+        logger = self.new_logger(handler)
+
+        latencies = []
+        for i in range(1000):
+            start = time.perf_counter()
+            logger.error(f"failed to fetch trains: error {i % 10}")
+            latencies.append(time.perf_counter() - start)
+        self.assertEqual(self.portal.pushes, [])
+
+        for second in range(0, 600, 5):
+            self.clock.now = second
+            handler.flush()
+
+        # The whole burst goes out in a single push, and then we stay in budget.
+        self.assertEqual(len(self.portal.pushes), 1)
+        self.assertEqual(handler.push_count, 1)
+        lines = self.portal.pushes[0][1].split("\n")
+        self.assertEqual(len(lines), 10)
+        for line in lines:
+            self.assertTrue(line.endswith("(x100)"))
+
+        # Logging never waits on a push.
+        self.assertLess(max(latencies), 0.01)
+
+        # Whereas AIOHandler waits for a push on every record.
+        blocking_portal = FakeMatrixPortal(pushSeconds=0.01)
+        blocking_logger = self.new_logger(AIOHandler(blocking_portal, "feed", adafruit_logging.INFO))
+        start = time.perf_counter()
+        for i in range(10):
+            blocking_logger.error(f"failed to fetch trains: error {i}")
+        self.assertGreaterEqual(time.perf_counter() - start, 10 * 0.01)
+        self.assertEqual(len(blocking_portal.pushes), 10)
+
+# RecordingHandler keeps every message that is logged.
+class RecordingHandler:
+    def __init__(self):
+        self.level = 0
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.msg)
+
+# new_counting_logger returns an adafruit_logging logger that counts how many
+# messages it builds. adafruit_logging builds the message (msg % args) every
+# time _log is called, even if the message isn't logged.
+def new_counting_logger(level):
+    class CountingLogger(adafruit_logging.Logger):
+        built_count = 0
+
+        def _log(self, level, msg, *args):
+            CountingLogger.built_count += 1
+            super()._log(level, msg, *args)
+
+    logger = CountingLogger("counting", level)
+    handler = RecordingHandler()
+    logger.addHandler(handler)
+    return logger, handler
+
+@unittest.skipIf(adafruit_logging is None, "adafruit_logging is not installed")
+class Test_LazyLogger(unittest.TestCase):
+    def test_levels(self):
+        inner, handler = new_counting_logger(adafruit_logging.INFO)
+        logger = LazyLogger(inner)
+        logger.debug("trains: %s", [1, 2, 3])
+        logger.info("trains: %s", [1, 2, 3])
+        logger.error("failed %d times", 5)
+        self.assertEqual(handler.messages, ["trains: [1, 2, 3]", "failed 5 times"])
+        self.assertEqual(inner.built_count, 2)
+
+        self.assertFalse(logger.isEnabledFor(adafruit_logging.DEBUG))
+        self.assertTrue(logger.isEnabledFor(adafruit_logging.INFO))
+        logger.setLevel(adafruit_logging.DEBUG)
+        self.assertTrue(logger.isEnabledFor(adafruit_logging.DEBUG))
+
+    def test_callable_message(self):
+        inner, handler = new_counting_logger(adafruit_logging.INFO)
+        logger = LazyLogger(inner)
+        calls = []
+        def message():
+            calls.append(1)
+            return "expensive"
+        logger.debug(message)
+        self.assertEqual(calls, [])
+        logger.info(message)
+        self.assertEqual(calls, [1])
+        self.assertEqual(handler.messages, ["expensive"])
+
+@unittest.skipIf(adafruit_logging is None, "adafruit_logging is not installed")
+class Test_analyze_items_logging(unittest.TestCase):
+    # Count how many log messages get built computing every train for a full
+    # day of schedules.
+    def analyze(self, logger):
+        deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=lambda: datetime.fromisoformat('2025-10-22T04:00:00'), mbta_api_key=None, logger=logger)
+        train_predictor = TrainPredictor(deps, maxPredictionSkewSeconds=None)
+        items = JsonScheduleReader.items(synthetic_schedule_json(200, service_date="2025-10-22"))
+        start = time.perf_counter()
+        train_predictor._analyze_items(3, items)
+        return time.perf_counter() - start
+
+    def test_messages_built(self):
+        built = {}
+        seconds = {}
+        for name, level in [("info", adafruit_logging.INFO), ("debug", adafruit_logging.DEBUG)]:
+            inner, handler = new_counting_logger(level)
+            seconds[name] = min(self.analyze(LazyLogger(inner)) for _ in range(3))
+            built[name] = inner.built_count
+
+        # At the debug level we build a couple of messages for every train, at
+        # the info level we don't build any at all.
+        self.assertGreaterEqual(built["debug"], 2 * 200 * 3)
+        self.assertEqual(built["info"], 0)
+        self.assertLess(seconds["info"], seconds["debug"])
+
+@unittest.skipIf(adafruit_logging is None, "adafruit_logging is not installed")
+class Test_CrashLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "nvm")
+        self.clock = FakeClock()
+        self.clock.now = 1761134400
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def new_crash_log(self, nvm_size=8192, **kwargs):
+        return CrashLog(FileNVM(self.path, nvm_size), timeFcn=self.clock.monotonic, **kwargs)
+
+    # log_messages logs count messages like the ones the application logs and
+    # returns what each message says.
+    def log_messages(self, logger, count):
+        expected = []
+        for i in range(count):
+            self.clock.now += 7
+            if i % 3 == 0:
+                logger.info("train arrived '%s'", f"Schedule-{i}")
+                expected.append(f"train arrived 'Schedule-{i}'")
+            elif i % 3 == 1:
+                logger.info("making additional attempt %d", i % 5)
+                expected.append(f"making additional attempt {i % 5}")
+            else:
+                logger.exception(ValueError(f"bad response {i}"))
+                expected.append(f"ValueError('bad response {i}')")
+        return expected
+
+    def test_record_size(self):
+        # What gets logged when the WiFi drops out: the same few messages over
+        # and over with a different attempt count.
+        crash_log = self.new_crash_log()
+        logger = LazyLogger(adafruit_logging.Logger("crash", adafruit_logging.CRITICAL), crash_log)
+        expected = []
+        for i in range(64):
+            self.clock.now += 5
+            if i % 2 == 0:
+                logger.exception(OSError(116))
+                expected.append("OSError(116)")
+            else:
+                logger.info("making additional attempt %d", i % 5)
+                expected.append(f"making additional attempt {i % 5}")
+        self.assertEqual([message for _, _, message in crash_log.records()], expected)
+        crash_log.dump()
+
+        # Each record is 16 bytes, plus the strings that are saved once no
+        # matter how many records use them. Saving the log lines as text (the
+        # way adafruit_logging formats them) would take more than twice as much
+        # space.
+        data = bytes(FileNVM(self.path, 8192)[0:8192]).rstrip(b"\x00")
+        text_size = sum(len(f"{self.clock.now:<0.3f}: ERROR - {message}") for message in expected)
+        self.assertEqual(len(crash_log._records), 64 * 16)
+        self.assertLess(len(data), 64 * 16 + 100)
+        self.assertLess(len(data), text_size / 2)
+
+    def test_records_survive_reload(self):
+        crash_log = self.new_crash_log(capacity=32)
+        logger = LazyLogger(adafruit_logging.Logger("crash", adafruit_logging.CRITICAL), crash_log)
+        expected = self.log_messages(logger, 200)
+        logger.debug("debug messages aren't kept")
+        self.assertEqual([message for _, _, message in crash_log.records()], expected[-32:])
+        crash_log.dump()
+        reload_time = self.clock.now
+
+        # After the reload we get a new CrashLog reading the same nvm.
+        self.clock.now += 60
+        crash_log = self.new_crash_log(capacity=32)
+        inner, handler = new_counting_logger(adafruit_logging.INFO)
+        logger = LazyLogger(inner, crash_log)
+        self.assertEqual(crash_log.replay(logger), 32)
+        self.assertEqual(len(handler.messages), 32)
+        for message, expected_message in zip(handler.messages, expected[-32:]):
+            self.assertTrue(message.startswith("before reload "), message)
+            self.assertTrue(message.endswith(": " + expected_message), message)
+        last = time.localtime(reload_time)
+        self.assertIn(f"{last[3]:02d}:{last[4]:02d}:{last[5]:02d}", handler.messages[-1])
+
+        # The replayed messages aren't added to the new crash log, and they are
+        # only replayed once.
+        self.assertEqual(len(crash_log), 0)
+        self.assertEqual(self.new_crash_log().replay(logger), 0)
+
+    def test_string_table_is_bounded(self):
+        crash_log = self.new_crash_log(capacity=32, maxStrings=8)
+        logger = LazyLogger(adafruit_logging.Logger("crash", adafruit_logging.CRITICAL), crash_log)
+        expected = self.log_messages(logger, 200)
+        self.assertLessEqual(len(crash_log._strings), 8)
+        records = [message for _, _, message in crash_log.records()]
+        self.assertGreater(len(records), 0)
+        self.assertEqual(records, expected[-len(records):])
+
+    def test_small_nvm_keeps_newest(self):
+        crash_log = self.new_crash_log(nvm_size=256, capacity=64)
+        logger = LazyLogger(adafruit_logging.Logger("crash", adafruit_logging.CRITICAL), crash_log)
+        expected = self.log_messages(logger, 64)
+        crash_log.dump()
+
+        inner, handler = new_counting_logger(adafruit_logging.INFO)
+        count = self.new_crash_log(nvm_size=256).replay(inner)
+        self.assertGreater(count, 0)
+        self.assertLess(count, 64)
+        for message, expected_message in zip(handler.messages, expected[-count:]):
+            self.assertTrue(message.endswith(": " + expected_message), message)
+
+if __name__ == '__main__':
+    unittest.main()
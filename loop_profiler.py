@@ -0,0 +1,179 @@
+import time
+
+# Upper bounds (in microseconds) of the buckets in each PhaseHistogram. Anything
+# longer than the last bound goes into one extra bucket at the end.
+DEFAULT_BUCKET_BOUNDS_US = (100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000, 2000000, 5000000)
+
+# PhaseHistogram keeps track of how long a phase of the main loop takes. Rather
+# than keeping every sample (we don't have the memory for that on the board)
+# each sample is counted in a fixed bucket, so percentiles are only as precise
+# as the buckets: percentile_us returns the upper bound of the bucket the
+# percentile falls in (or the longest sample if that is smaller).
+class PhaseHistogram:
+    def __init__(self, bucket_bounds_ns):
+        self._bucket_bounds_ns = bucket_bounds_ns
+        self.counts = [0] * (len(bucket_bounds_ns) + 1)
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, elapsed_ns):
+        # There are only a handful of buckets so a linear search is about as
+        # fast as a binary search would be (and CircuitPython doesn't have
+        # bisect).
+        bucket = 0
+        bounds = self._bucket_bounds_ns
+        while bucket < len(bounds) and elapsed_ns > bounds[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total_ns += elapsed_ns
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    @property
+    def mean_us(self):
+        if self.count == 0:
+            return 0
+        return self.total_ns // self.count // 1000
+
+    @property
+    def max_us(self):
+        return self.max_ns // 1000
+
+    def percentile_us(self, percent):
+        if self.count == 0:
+            return 0
+        # The sample we are looking for is the one at this (1 based) rank.
+        rank = (self.count * percent + 99) // 100
+        if rank < 1:
+            rank = 1
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if bucket < len(self._bucket_bounds_ns):
+            return min(self._bucket_bounds_ns[bucket], self.max_ns) // 1000
+        return self.max_ns // 1000
+
+    def reset(self):
+        for bucket in range(len(self.counts)):
+            self.counts[bucket] = 0
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+# _Phase is the context manager returned by LoopProfiler.phase. There is one
+# per phase name that is reused every time so timing a phase doesn't allocate
+# anything. This means a phase can't be nested inside another phase with the
+# same name, but different phases can be nested (for example "parse" is part
+# of "fetch").
+class _Phase:
+    def __init__(self, histogram, nsFcn):
+        self._histogram = histogram
+        self._nsFcn = nsFcn
+        self._start = 0
+
+    def __enter__(self):
+        self._start = self._nsFcn()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.add(self._nsFcn() - self._start)
+        return False
+
+# LoopProfiler measures how long each phase of the main loop takes, for
+# example:
+#
+#    with profiler.phase("render"):
+#        display.render_arrival_times(trains)
+#
+# or profiler.wrap("render", display.render_arrival_times) to time every call
+# to a function. Times are measured with time.monotonic_ns and counted in a
+# PhaseHistogram for each phase. summarize_if_due is called once each time
+# through the main loop and every summarySeconds logs a line for each phase
+# with the count, mean, 50th / 90th / 99th percentiles and max (all in
+# microseconds), then starts the histograms over so each summary only covers
+# the time since the last one.
+#
+# Profiling is opt in, when it isn't enabled NULL_PROFILER is used instead,
+# see NullProfiler.
+class LoopProfiler:
+    def __init__(self, logger, summarySeconds=600, bucketBoundsUs=DEFAULT_BUCKET_BOUNDS_US, nsFcn=time.monotonic_ns):
+        self._logger = logger
+        self._summary_ns = summarySeconds * 1000000000
+        self._bucket_bounds_ns = [bound * 1000 for bound in bucketBoundsUs]
+        self._nsFcn = nsFcn
+
+        # Phases are kept in the order they were first used so the summary
+        # comes out in the same order every time.
+        self._names = []
+        self._phases = {}
+        self._next_summary_ns = nsFcn() + self._summary_ns
+
+    def phase(self, name):
+        phase = self._phases.get(name)
+        if phase is None:
+            phase = _Phase(PhaseHistogram(self._bucket_bounds_ns), self._nsFcn)
+            self._phases[name] = phase
+            self._names.append(name)
+        return phase
+
+    def wrap(self, name, fcn):
+        phase = self.phase(name)
+        def wrapped(*args, **kwargs):
+            with phase:
+                return fcn(*args, **kwargs)
+        return wrapped
+
+    def histogram(self, name):
+        return self.phase(name)._histogram
+
+    def summarize_if_due(self):
+        now = self._nsFcn()
+        if now < self._next_summary_ns:
+            return False
+        self._next_summary_ns = now + self._summary_ns
+        self.summarize()
+        return True
+
+    def summarize(self):
+        for name in self._names:
+            histogram = self._phases[name]._histogram
+            if histogram.count == 0:
+                continue
+            self._logger.info("profile %s: count=%d mean=%dus p50=%dus p90=%dus p99=%dus max=%dus",
+                name, histogram.count, histogram.mean_us, histogram.percentile_us(50),
+                histogram.percentile_us(90), histogram.percentile_us(99), histogram.max_us)
+            histogram.reset()
+
+# _NullPhase is the context manager returned by NullProfiler.phase, it doesn't
+# do anything.
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+# NullProfiler has the same methods as LoopProfiler but doesn't measure
+# anything. phase always returns the same do nothing context manager and wrap
+# returns the function as is, so when profiling isn't enabled all it costs is
+# a method call and entering / exiting an empty with block for each phase.
+class NullProfiler:
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def wrap(self, name, fcn):
+        return fcn
+
+    def summarize_if_due(self):
+        return False
+
+    def summarize(self):
+        pass
+
+NULL_PROFILER = NullProfiler()
@@ -0,0 +1,210 @@
+from loop_profiler import LoopProfiler, NullProfiler, NULL_PROFILER, PhaseHistogram
+from train_predictor import TrainPredictor, TrainPredictorDependencies
+from testing_extra import MockNetwork, StubMBTAServer, synthetic_schedule_json, BENCHMARK
+from datetime import datetime, timedelta
+import time
+import unittest
+import logging
+
+# FakeClock is a time.monotonic_ns that only moves when the test moves it.
+class FakeClock:
+    def __init__(self):
+        self.now_ns = 0
+
+    def __call__(self):
+        return self.now_ns
+
+    def advance_us(self, us):
+        self.now_ns += us * 1000
+
+# RecordingLogger keeps the messages that are logged at the info level.
+class RecordingLogger:
+    def __init__(self):
+        self.messages = []
+
+    def info(self, msg, *args):
+        self.messages.append(msg % args)
+
+class Test_PhaseHistogram(unittest.TestCase):
+    def test_buckets(self):
+        histogram = PhaseHistogram([100000, 200000, 500000])
+        for us in [50, 100, 101, 200, 300, 499, 501, 10000]:
+            histogram.add(us * 1000)
+        self.assertEqual(histogram.counts, [2, 2, 2, 2])
+        self.assertEqual(histogram.count, 8)
+        self.assertEqual(histogram.max_us, 10000)
+        self.assertEqual(histogram.mean_us, (50 + 100 + 101 + 200 + 300 + 499 + 501 + 10000) // 8)
+
+    def test_percentiles(self):
+        histogram = PhaseHistogram([1000000, 2000000, 5000000, 10000000])
+
+        # 90 samples of 1.5ms, 9 of 4ms and 1 of 30ms.
+        for _ in range(90):
+            histogram.add(1500000)
+        for _ in range(9):
+            histogram.add(4000000)
+        histogram.add(30000000)
+
+        self.assertEqual(histogram.percentile_us(0), 2000)
+        self.assertEqual(histogram.percentile_us(50), 2000)
+        self.assertEqual(histogram.percentile_us(90), 2000)
+        self.assertEqual(histogram.percentile_us(91), 5000)
+        self.assertEqual(histogram.percentile_us(99), 5000)
+        # Past the last bucket all we know is the longest sample.
+        self.assertEqual(histogram.percentile_us(100), 30000)
+
+    def test_percentile_capped_at_max(self):
+        histogram = PhaseHistogram([1000000, 10000000])
+        histogram.add(2000000)
+        histogram.add(3000000)
+        self.assertEqual(histogram.percentile_us(50), 3000)
+
+    def test_empty(self):
+        histogram = PhaseHistogram([1000])
+        self.assertEqual(histogram.mean_us, 0)
+        self.assertEqual(histogram.percentile_us(50), 0)
+
+    def test_reset(self):
+        histogram = PhaseHistogram([1000])
+        histogram.add(500)
+        histogram.add(5000)
+        histogram.reset()
+        self.assertEqual(histogram.counts, [0, 0])
+        self.assertEqual((histogram.count, histogram.total_ns, histogram.max_ns), (0, 0, 0))
+
+class Test_LoopProfiler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.logger = RecordingLogger()
+        self.profiler = LoopProfiler(self.logger, summarySeconds=10, bucketBoundsUs=[1000, 10000, 100000], nsFcn=self.clock)
+
+    def test_phase(self):
+        for us in [500, 2000, 3000]:
+            with self.profiler.phase("render"):
+                self.clock.advance_us(us)
+        histogram = self.profiler.histogram("render")
+        self.assertEqual(histogram.counts, [1, 2, 0, 0])
+        self.assertEqual(histogram.total_ns, 5500000)
+
+    def test_phase_records_exceptions(self):
+        with self.assertRaises(RuntimeError):
+            with self.profiler.phase("fetch"):
+                self.clock.advance_us(200000)
+                raise RuntimeError("timed out")
+        self.assertEqual(self.profiler.histogram("fetch").counts, [0, 0, 0, 1])
+
+    def test_nested_phases(self):
+        with self.profiler.phase("fetch"):
+            self.clock.advance_us(5000)
+            with self.profiler.phase("parse"):
+                self.clock.advance_us(20000)
+        self.assertEqual(self.profiler.histogram("fetch").total_ns, 25000000)
+        self.assertEqual(self.profiler.histogram("parse").total_ns, 20000000)
+
+    def test_wrap(self):
+        def render(text):
+            self.clock.advance_us(1500)
+            return text.upper()
+        wrapped = self.profiler.wrap("render", render)
+        self.assertEqual(wrapped("5min"), "5MIN")
+        self.assertEqual(self.profiler.histogram("render").counts, [0, 1, 0, 0])
+
+    def test_summarize_if_due(self):
+        with self.profiler.phase("fetch"):
+            self.clock.advance_us(50000)
+        for _ in range(10):
+            with self.profiler.phase("scroll"):
+                self.clock.advance_us(300)
+
+        self.assertFalse(self.profiler.summarize_if_due())
+        self.assertEqual(self.logger.messages, [])
+
+        self.clock.advance_us(10000000)
+        self.assertTrue(self.profiler.summarize_if_due())
+        self.assertEqual(self.logger.messages, [
+            "profile fetch: count=1 mean=50000us p50=50000us p90=50000us p99=50000us max=50000us",
+            "profile scroll: count=10 mean=300us p50=300us p90=300us p99=300us max=300us",
+        ])
+
+        # The histograms start over after each summary and phases that didn't
+        # run since the last summary are left out.
+        with self.profiler.phase("scroll"):
+            self.clock.advance_us(2000)
+        self.assertFalse(self.profiler.summarize_if_due())
+        self.clock.advance_us(10000000)
+        self.assertTrue(self.profiler.summarize_if_due())
+        self.assertEqual(self.logger.messages[2:], [
+            "profile scroll: count=1 mean=2000us p50=2000us p90=2000us p99=2000us max=2000us",
+        ])
+
+    def test_train_predictor_phases(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            now = datetime.fromisoformat('2025-10-22T12:00:00')
+            deps = TrainPredictorDependencies(MockNetwork(), datetime, timedelta, lambda: now, mbta_api_key=None, logger=logging.getLogger("mock"), profiler=self.profiler)
+            train_predictor = TrainPredictor(deps, schedulesSource=server.url, predictionsSource=server.predictions_url)
+            train_predictor.next_trains(count=3)
+            train_predictor.next_trains(count=3)
+
+        # The schedule is parsed once and the predictions are only parsed on
+        # the first poll, nothing has changed by the second poll so the MBTA
+        # API responds with a 304.
+        self.assertEqual(self.profiler.histogram("parse").count, 2)
+        self.assertEqual(self.profiler.histogram("analyze").count, 2)
+        self.assertEqual(self.profiler.histogram("gc").count, 2)
+
+class Test_NullProfiler(unittest.TestCase):
+    def test_does_nothing(self):
+        profiler = NullProfiler()
+        with profiler.phase("render"):
+            pass
+        render = lambda: None
+        self.assertIs(profiler.wrap("render", render), render)
+        self.assertFalse(profiler.summarize_if_due())
+
+    def test_many_phases(self):
+        # The same phase is reused every time, with the real clock.
+        profiler = LoopProfiler(RecordingLogger())
+        for _ in range(100000):
+            with NULL_PROFILER.phase("scroll"), profiler.phase("scroll"):
+                pass
+        histogram = profiler.histogram("scroll")
+        self.assertEqual(histogram.count, 100000)
+        self.assertEqual(sum(histogram.counts), 100000)
+
+    @unittest.skipUnless(BENCHMARK, "set BENCHMARK=1 to run benchmarks")
+    def test_overhead(self):
+        # Time the same phase with no profiler at all, with the NullProfiler
+        # and with a LoopProfiler. The NullProfiler should cost next to
+        # nothing per phase.
+        iterations = 100000
+        profiler = LoopProfiler(RecordingLogger())
+
+        def bare():
+            start = time.perf_counter()
+            for _ in range(iterations):
+                pass
+            return time.perf_counter() - start
+
+        def timed(profiler):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                with profiler.phase("scroll"):
+                    pass
+            return time.perf_counter() - start
+
+        bare_seconds = min(bare() for _ in range(5))
+        null_seconds = min(timed(NULL_PROFILER) for _ in range(5))
+        enabled_seconds = min(timed(profiler) for _ in range(5))
+
+        null_ns = (null_seconds - bare_seconds) / iterations * 1e9
+        enabled_ns = (enabled_seconds - bare_seconds) / iterations * 1e9
+        overhead = f"overhead per phase: disabled {null_ns:.0f}ns, enabled {enabled_ns:.0f}ns"
+
+        self.assertLess(null_ns, 2000, overhead)
+        self.assertLess(enabled_ns, 20000, overhead)
+        self.assertLess(null_seconds, enabled_seconds, overhead)
+        self.assertEqual(profiler.histogram("scroll").count, 5 * iterations)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,30 +1,62 @@
 import os
 import board
+import microcontroller
 
 from adafruit_matrixportal.matrixportal import MatrixPortal
 from adafruit_datetime import datetime,timedelta
 
 import logging_extra
 from train_predictor import TrainPredictor, TrainPredictorDependencies
+from schedule_reader import StreamingScheduleReader
 from time_conversion import TimeConversion, TimeConversionDependencies
 from display import Display, DisplayDependencies
 from application import Application, ApplicationDependencies
+from poll_scheduler import AdaptivePollScheduler, PollSchedulerDependencies
+from loop_profiler import LoopProfiler
+
+# When running on a Linux single-board computer we have threads so we fetch
+# trains in the background, see background_fetcher.py. background_fetcher.py
+# isn't installed on the Matrix Portal (CircuitPython doesn't have
+# concurrent.futures) so there we fetch in the main loop.
+try:
+    from background_fetcher import BackgroundFetcher, BackgroundFetcherDependencies
+except ImportError:
+    BackgroundFetcher = None
 
 matrix_portal = MatrixPortal(status_neopixel=board.NEOPIXEL)
 
+# Debug messages are only built if one of the handlers logs at the debug level
+# (see LazyLogger), so setting print_handler to INFO makes the main loop a bit
+# cheaper when nobody is watching the serial console.
 log_levels = logging_extra.LogLevels(aio_handler=logging_extra.INFO, print_handler=logging_extra.DEBUG)
-logger = logging_extra.newLogger(logging_extra.LoggerDependencies(matrix_portal), log_levels)
+# The crash log keeps the last few log records so they can be saved before the
+# board reloads itself and logged again once it is back up, see CrashLog. On a
+# Linux single-board computer Blinka's microcontroller module doesn't have nvm
+# so we keep the crash log in a file instead.
+nvm = getattr(microcontroller, "nvm", None)
+if nvm is None:
+    nvm = logging_extra.FileNVM("crash_log.bin")
+crash_log = logging_extra.CrashLog(nvm)
+logger, aio_handler = logging_extra.newLogger(logging_extra.LoggerDependencies(matrix_portal, crash_log=crash_log), log_levels)
+crash_log.replay(logger)
 
 mbta_api_key = os.getenv("MBTA_API_KEY")
 if mbta_api_key is None:
     logger.error("missing MBTA API key")
     raise KeyError("missing MBTA API key")
 
+# Setting LOOP_PROFILER_SECONDS in settings.toml times each phase of the main
+# loop and logs a summary that often, see loop_profiler.py.
+profiler = None
+loop_profiler_seconds = os.getenv("LOOP_PROFILER_SECONDS")
+if loop_profiler_seconds is not None:
+    profiler = LoopProfiler(logger, summarySeconds=int(loop_profiler_seconds))
+
 # inboundOffsetAverageSeconds, inboundOffsetStdDevSeconds,
 # outboundOffsetAverageSeconds, outboundOffsetStdDevSeconds are all used to
 # control how much offset from the arrival time at the franklin MBTA station we
 # need. See "Computing arrival time offsets" in README.md for details.
-train_predictor = TrainPredictor(TrainPredictorDependencies(matrix_portal.network, datetime, timedelta, datetime.now, mbta_api_key, logger), 
+train_predictor = TrainPredictor(TrainPredictorDependencies(matrix_portal.network, datetime, timedelta, datetime.now, mbta_api_key, logger, StreamingScheduleReader(), profiler=profiler), 
     trainWarningSeconds=60,
     inboundOffsetAverageSeconds=-63, inboundOffsetStdDevSeconds=9,
     outboundOffsetAverageSeconds=93, outboundOffsetStdDevSeconds=9)
@@ -32,6 +64,12 @@ train_predictor = TrainPredictor(TrainPredictorDependencies(matrix_portal.networ
 time_conversion = TimeConversion(TimeConversionDependencies(datetime.now))
 display = Display(DisplayDependencies(matrix_portal, time_conversion, logger), text_scroll_delay=0.1, train_frame_duration=0.08)
 
-app = Application(ApplicationDependencies(matrix_portal, train_predictor, time_conversion, display, datetime.now, logger))
+poll_scheduler = AdaptivePollScheduler(PollSchedulerDependencies(train_predictor.warning_start_time))
+
+train_fetcher = None
+if BackgroundFetcher is not None:
+    train_fetcher = BackgroundFetcher(BackgroundFetcherDependencies(train_predictor, datetime.now, logger, poll_scheduler))
+
+app = Application(ApplicationDependencies(matrix_portal, train_predictor, time_conversion, display, datetime.now, logger, poll_scheduler, train_fetcher, aio_handler.flush, crash_log.dump, profiler))
 
 app.run()
\ No newline at end of file
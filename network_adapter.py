@@ -0,0 +1,44 @@
+import asyncio
+
+# A network adapter lets AsyncApplication await calls that make network
+# requests, like TrainPredictor.next_trains.
+#
+# await adapter.call(fcn, *args) calls fcn(*args) and returns the result (or
+# raises the exception that fcn raised). While the call is in progress the
+# adapter should let the other asyncio tasks run if it can.
+
+# BlockingNetworkAdapter just calls the function. This is what we have to use
+# on the board today since adafruit_requests doesn't have a way to wait for a
+# response without blocking (see the comment in Application._run_loop). The
+# other tasks are stalled for the duration of the request, but they all pick
+# right back up once it finishes.
+class BlockingNetworkAdapter:
+    async def call(self, fcn, *args):
+        return fcn(*args)
+
+# ThreadNetworkAdapter calls the function on a background thread and polls
+# for it to finish, letting other tasks run in the meantime. CircuitPython
+# doesn't have threads so this is only for CPython (for example running the
+# application against a fake display in tests).
+class ThreadNetworkAdapter:
+    def __init__(self, pollSeconds=0.01):
+        self._pollSeconds = pollSeconds
+
+    async def call(self, fcn, *args):
+        import threading
+
+        result = {}
+        def run():
+            try:
+                result["value"] = fcn(*args)
+            except Exception as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while thread.is_alive():
+            await asyncio.sleep(self._pollSeconds)
+
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
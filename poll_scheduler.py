@@ -0,0 +1,67 @@
+from time_conversion import seconds_from_datetime
+
+# A poll scheduler decides how long the application should wait before asking
+# the train predictor for updated train arrival times.
+#
+# next_poll_delay(trains, now) is passed the list of trains from the last call
+# to TrainPredictor.next_trains along with the current time (a datetime from
+# nowFcn) and returns the number of seconds to wait before the next call.
+
+# FixedPollScheduler polls at a fixed interval no matter when the next train is
+# coming.
+class FixedPollScheduler:
+    def __init__(self, intervalSeconds=5):
+        self._intervalSeconds = intervalSeconds
+
+    def next_poll_delay(self, trains, now):
+        return self._intervalSeconds
+
+# warningStartFcn is called with a TrainArrival and returns the time (in
+# seconds) that we will start showing the train warning for it, see
+# TrainPredictor.warning_start_time.
+class PollSchedulerDependencies:
+    def __init__(self, warningStartFcn):
+        self.warningStartFcn = warningStartFcn
+
+# AdaptivePollScheduler polls more often the closer we get to needing to show
+# the train warning for the next train.
+#
+# The only time that we really need up to date predictions is right before the
+# train warning starts so we start it at the correct time. When the next train
+# is hours away there is no point in asking the MBTA API every 5 seconds, the
+# prediction isn't going to change enough to matter and every request means
+# waking up the WiFi and stalling the display while we wait for the response.
+#
+# So we wait for half of the remaining time until the warning starts. Each
+# poll halves the time to the warning until we hit minIntervalSeconds right
+# before the warning starts. This also means that if the prediction moves
+# earlier we will notice well before the warning needs to start.
+#
+# The delay is always between minIntervalSeconds and maxIntervalSeconds,
+# except when the next train is more than overnightAfterSeconds away (or there
+# is no next train at all) when we allow waiting up to
+# overnightIntervalSeconds. That way the board is mostly idle overnight but
+# still picks up the first train of the morning in plenty of time.
+class AdaptivePollScheduler:
+    def __init__(self, dependencies: PollSchedulerDependencies, minIntervalSeconds=5, maxIntervalSeconds=300, overnightIntervalSeconds=1800, overnightAfterSeconds=7200):
+        self._warningStartFcn = dependencies.warningStartFcn
+        self._minIntervalSeconds = minIntervalSeconds
+        self._maxIntervalSeconds = maxIntervalSeconds
+        self._overnightIntervalSeconds = overnightIntervalSeconds
+        self._overnightAfterSeconds = overnightAfterSeconds
+
+    def next_poll_delay(self, trains, now):
+        train = trains[0] if trains else None
+        if train is None:
+            return self._overnightIntervalSeconds
+
+        seconds_until_warning = self._warningStartFcn(train) - seconds_from_datetime(now)
+        if seconds_until_warning <= 0:
+            return self._minIntervalSeconds
+
+        max_interval = self._maxIntervalSeconds
+        if seconds_until_warning > self._overnightAfterSeconds:
+            max_interval = self._overnightIntervalSeconds
+
+        delay = seconds_until_warning / 2
+        return max(self._minIntervalSeconds, min(max_interval, delay))
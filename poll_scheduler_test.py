@@ -0,0 +1,164 @@
+from poll_scheduler import FixedPollScheduler, AdaptivePollScheduler, PollSchedulerDependencies
+from train_predictor import TrainPredictor, TrainPredictorDependencies, TrainArrival
+from testing_extra import synthetic_schedule_json
+from time_conversion import seconds_from_datetime, datetime_from_seconds
+from datetime import datetime, timedelta
+import unittest
+import logging
+
+mock_logger = logging.getLogger("mock")
+
+STD_DEV = 9
+
+def create_predictor():
+    # The train predictor is only used for warning_start_time, so it doesn't
+    # need a network.
+    deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=None, mbta_api_key=None, logger=mock_logger)
+    return TrainPredictor(deps, trainWarningSeconds=60, inboundOffsetStdDevSeconds=9, outboundOffsetStdDevSeconds=9)
+
+def train_at(time):
+    return TrainArrival("schedule", seconds_from_datetime(time), 1, STD_DEV)
+
+class Test_AdaptivePollScheduler(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.fromisoformat('2025-10-22T12:00:00')
+        predictor = create_predictor()
+        self.scheduler = AdaptivePollScheduler(PollSchedulerDependencies(predictor.warning_start_time), minIntervalSeconds=5, maxIntervalSeconds=300, overnightIntervalSeconds=1800, overnightAfterSeconds=7200)
+
+    def delay_for_train_in(self, seconds):
+        # The warning starts 60 seconds plus two standard deviations before
+        # the train.
+        return self.scheduler.next_poll_delay([train_at(self.now + timedelta(seconds=seconds)), None, None], self.now)
+
+    def test_no_trains(self):
+        self.assertEqual(self.scheduler.next_poll_delay([None, None, None], self.now), 1800)
+        self.assertEqual(self.scheduler.next_poll_delay([], self.now), 1800)
+
+    def test_train_far_away(self):
+        self.assertEqual(self.delay_for_train_in(5 * 3600), 1800)
+        self.assertEqual(self.delay_for_train_in(3 * 3600), 1800)
+
+    def test_train_within_overnight_threshold(self):
+        self.assertEqual(self.delay_for_train_in(3600), 300)
+
+    def test_train_approaching(self):
+        self.assertEqual(self.delay_for_train_in(78 + 400), 200)
+        self.assertEqual(self.delay_for_train_in(78 + 40), 20)
+
+    def test_warning_started(self):
+        self.assertEqual(self.delay_for_train_in(78 + 6), 5)
+        self.assertEqual(self.delay_for_train_in(78), 5)
+        self.assertEqual(self.delay_for_train_in(-10), 5)
+
+class SimulatedTrain:
+    def __init__(self, schedule_id, scheduled_time, actual_time, direction):
+        self.schedule_id = schedule_id
+        self.scheduled_time = scheduled_time
+        self.actual_time = actual_time
+        self.direction = direction
+
+    # predicted_time is what the MBTA API would tell us about the train at a
+    # given time. Like the real API we only get a prediction once the train
+    # is getting close, until then all we have is the schedule.
+    def predicted_time(self, now):
+        if now >= self.actual_time - timedelta(minutes=30):
+            return self.actual_time
+        return self.scheduled_time
+
+# SimulatedTrainArrival is a TrainArrival that remembers which SimulatedTrain
+# it came from.
+class SimulatedTrainArrival(TrainArrival):
+    pass
+
+# DaySimulation replays a full service day of trains against a poll scheduler,
+# following the same logic as Application._run_loop. Rather than stepping
+# through every loop of the application we jump straight from one poll to the
+# next, or to the train warning if the application would start one before the
+# next poll.
+class DaySimulation:
+    def __init__(self, trains, start, end):
+        self._trains = trains
+        self._start = start
+        self._end = end
+        self._predictor = create_predictor()
+
+    def run(self, scheduler):
+        self.request_count = 0
+        # warning_errors is how many seconds early (negative) or late
+        # (positive) the warning for each train started compared to when it
+        # should have started based on when the train actually arrived.
+        self.warning_errors = []
+
+        arrived = set()
+        now = self._start
+        while now < self._end:
+            trains = self._next_trains(now, arrived)
+            self.request_count += 1
+            next_poll = now + timedelta(seconds=scheduler.next_poll_delay(trains, now))
+
+            train = trains[0]
+            if train is not None and self._predictor.warning_start_time(train) <= seconds_from_datetime(next_poll):
+                warning_start = max(now, datetime_from_seconds(self._predictor.warning_start_time(train), datetime))
+                actual = train_at(train.simulated.actual_time)
+                self.warning_errors.append(seconds_from_datetime(warning_start) - self._predictor.warning_start_time(actual))
+
+                # The application plays the warning until the train has passed
+                # by and then fetches trains again right away.
+                arrived.add(train.schedule_id)
+                now = max(now, datetime_from_seconds(train.time + 3 * train.std_dev, datetime))
+                continue
+
+            now = next_poll
+
+    def _next_trains(self, now, arrived):
+        trains = []
+        for simulated in self._trains:
+            if simulated.schedule_id in arrived:
+                continue
+            time = simulated.predicted_time(now)
+            if (time - now).total_seconds() < -30:
+                continue
+            train = SimulatedTrainArrival(simulated.schedule_id, seconds_from_datetime(time), simulated.direction, STD_DEV)
+            train.simulated = simulated
+            trains.append(train)
+        trains.sort(key=TrainArrival.sort_by_time)
+        while len(trains) < 3:
+            trains.append(None)
+        return trains[:3]
+
+class Test_day_simulation(unittest.TestCase):
+    def create_simulation(self):
+        # A weekday on the Franklin line has about 40 trains passing by. Some of
+        # them run a few minutes late.
+        day = synthetic_schedule_json(40, service_date="2025-10-22", first_train="05:00", last_train="25:00", predicted_count=0)
+        trains = []
+        for index, item in enumerate(day["data"]):
+            attributes = item["attributes"]
+            scheduled_time = datetime.fromisoformat(attributes["arrival_time"]).replace(tzinfo=None)
+            actual_time = scheduled_time + timedelta(minutes=index % 4)
+            trains.append(SimulatedTrain(item["id"], scheduled_time, actual_time, attributes["direction_id"]))
+
+        start = datetime.fromisoformat('2025-10-22T03:00:00')
+        return DaySimulation(trains, start, start + timedelta(days=1))
+
+    def test_adaptive_vs_fixed(self):
+        fixed = self.create_simulation()
+        fixed.run(FixedPollScheduler(5))
+
+        adaptive = self.create_simulation()
+        predictor = create_predictor()
+        adaptive.run(AdaptivePollScheduler(PollSchedulerDependencies(predictor.warning_start_time)))
+
+        # Every train should get a warning and it should start right on time,
+        # since we are polling often right before the warning starts.
+        for simulation in [fixed, adaptive]:
+            self.assertEqual(len(simulation.warning_errors), 40)
+            for error in simulation.warning_errors:
+                self.assertLessEqual(abs(error), 1)
+
+        report = f"requests per day: fixed={fixed.request_count} adaptive={adaptive.request_count}"
+        self.assertGreater(fixed.request_count, 15000, report)
+        self.assertLess(adaptive.request_count, fixed.request_count / 20, report)
+
+if __name__ == '__main__':
+    unittest.main()
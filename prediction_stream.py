@@ -0,0 +1,236 @@
+import json
+import time
+from schedule_reader import SCHEDULE_ATTRIBUTES
+
+# PREDICTIONS_STREAM_SOURCE is the URL for the MBTA API predictions at the
+# Franklin station. When requested with an "accept: text/event-stream" header the
+# MBTA API keeps the connection open and sends Server-Sent Events as predictions
+# change rather than a single response. See
+# https://www.mbta.com/developers/v3-api/streaming
+#
+# We don't use a sparse fieldset here because we need the trip relationship of
+# each prediction to join it up with a schedule, and individual prediction
+# events are small anyway.
+PREDICTIONS_STREAM_SOURCE="https://api-v3.mbta.com/predictions?" \
+  "filter[stop]=place-FB-0275&" \
+  "filter[route]=CR-Franklin"
+
+# ServerSentEventParser parses a text/event-stream into (event, data) tuples.
+#
+# Bytes are passed to feed() in arbitrarily sized chunks, it returns the list of
+# events that were completed by that chunk. See
+# https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+# for the format, we only care about the "event" and "data" fields. Everything
+# else (including ":" comment lines the MBTA API sends as keep alives) is
+# ignored.
+class ServerSentEventParser:
+    def __init__(self):
+        self._line = bytearray()
+        self._event = None
+        self._data = None
+
+    def feed(self, chunk):
+        events = []
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end == -1:
+                self._line.extend(chunk[start:])
+                return events
+            self._line.extend(chunk[start:end])
+            start = end + 1
+
+            line = self._line.decode()
+            self._line = bytearray()
+            if line.endswith("\r"):
+                line = line[:-1]
+
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+
+    def _process_line(self, line):
+        if line == "":
+            # A blank line dispatches the event
+            if self._data is None:
+                self._event = None
+                return None
+            event = (self._event or "message", self._data)
+            self._event = None
+            self._data = None
+            return event
+
+        if line.startswith(":"):
+            return None
+
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+
+        if field == "event":
+            self._event = value
+        elif field == "data":
+            self._data = value if self._data is None else self._data + "\n" + value
+        return None
+
+# PredictionTable is an in-memory copy of the predictions for the Franklin
+# station, kept up to date by applying the events from the MBTA streaming API.
+#
+# We only keep the SCHEDULE_ATTRIBUTES of each prediction along with the trip it
+# is for. Predictions are keyed by prediction id (which is what the events
+# refer to) but are looked up by trip id since that is how we join a
+# prediction up with a schedule.
+class PredictionTable:
+    def __init__(self):
+        self._predictions = {}
+        self._trips = {}
+        self.synced = False
+
+    def apply(self, event, data):
+        if event == "reset":
+            self._predictions.clear()
+            self._trips.clear()
+            for resource in json.loads(data):
+                self._add(resource)
+            self.synced = True
+        elif event == "add" or event == "update":
+            self._add(json.loads(data))
+        elif event == "remove":
+            self._remove(json.loads(data).get("id"))
+
+    # load replaces the contents of the table with the predictions read from a
+    # polled /predictions response (see TrainPredictor.next_trains). Each
+    # ScheduleItem is a prediction, with the prediction attributes in
+    # item.schedule.
+    def load(self, items):
+        self._predictions.clear()
+        self._trips.clear()
+        for item in items:
+            self._predictions[item.schedule_id] = (item.trip_id, item.schedule)
+            if item.trip_id is not None:
+                self._trips[item.trip_id] = item.schedule_id
+        self.synced = True
+
+    def clear(self):
+        self._predictions.clear()
+        self._trips.clear()
+        self.synced = False
+
+    def prediction_for_trip(self, trip_id):
+        prediction_id = self._trips.get(trip_id)
+        if prediction_id is None:
+            return None
+        return self._predictions[prediction_id][1]
+
+    def __len__(self):
+        return len(self._predictions)
+
+    def _add(self, resource):
+        prediction_id = resource.get("id")
+        self._remove(prediction_id)
+
+        trip_ref = resource.get("relationships", {}).get("trip", {}).get("data")
+        trip_id = trip_ref.get("id") if trip_ref else None
+        attributes = resource.get("attributes", {})
+        self._predictions[prediction_id] = (trip_id, {k: attributes.get(k) for k in SCHEDULE_ATTRIBUTES})
+        if trip_id is not None:
+            self._trips[trip_id] = prediction_id
+
+    def _remove(self, prediction_id):
+        existing = self._predictions.pop(prediction_id, None)
+        if existing is not None and self._trips.get(existing[0]) == prediction_id:
+            del self._trips[existing[0]]
+
+# PredictionStream subscribes to the MBTA streaming API and keeps a
+# PredictionTable up to date.
+#
+# The actual connection is made by the open_stream function that is passed in.
+# open_stream(url, headers) must return a connection object with:
+#
+#  * read_available() - returns whatever bytes have been received since the
+#    last call (b"" if nothing new) WITHOUT blocking. Raises an OSError if the
+#    connection has been lost.
+#  * close()
+#
+# This lets us keep the main loop running while waiting for events on the
+# board (where this needs a non-blocking socket) and on CPython where we can
+# just use a thread.
+#
+# poll() must be called regularly to apply any new events. If the connection is
+# lost poll() closes it and the table is marked as not synced, the caller
+# should fall back to polling the MBTA API until poll() manages to reconnect.
+# We wait at least reconnect_seconds between connection attempts.
+class PredictionStream:
+    def __init__(self, open_stream, logger, mbta_api_key=None, url=PREDICTIONS_STREAM_SOURCE, reconnect_seconds=60, monotonicFcn=time.monotonic):
+        self._open_stream = open_stream
+        self._logger = logger
+        self._url = url
+        self._reconnect_seconds = reconnect_seconds
+        self._monotonicFcn = monotonicFcn
+
+        self._headers = {
+            "accept": "text/event-stream"
+        }
+        if mbta_api_key is not None:
+            self._headers["x-api-key"] = mbta_api_key
+
+        self.table = PredictionTable()
+        self._connection = None
+        self._parser = None
+        self._last_connect_attempt = None
+
+        self.connect_count = 0
+        self.disconnect_count = 0
+        self.event_count = 0
+
+    @property
+    def connected(self):
+        return self._connection is not None
+
+    # poll applies any events that have been received and returns True if the
+    # table is up to date with the MBTA API.
+    def poll(self):
+        if self._connection is None and not self._connect():
+            return False
+
+        try:
+            chunk = self._connection.read_available()
+            if chunk:
+                for event, data in self._parser.feed(chunk):
+                    self.event_count += 1
+                    self.table.apply(event, data)
+        except Exception as e:
+            self._logger.warning("prediction stream disconnected: %s", e)
+            self.disconnect_count += 1
+            self.close()
+            return False
+
+        return self.table.synced
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+        self._connection = None
+        self._parser = None
+        self.table.clear()
+
+    def _connect(self):
+        now = self._monotonicFcn()
+        if self._last_connect_attempt is not None and now < self._last_connect_attempt + self._reconnect_seconds:
+            return False
+        self._last_connect_attempt = now
+
+        try:
+            self._logger.debug("connecting to prediction stream")
+            self._connection = self._open_stream(self._url, self._headers)
+        except Exception as e:
+            self._logger.warning("failed to connect to prediction stream: %s", e)
+            self._connection = None
+            return False
+
+        self.connect_count += 1
+        self._parser = ServerSentEventParser()
+        return True
@@ -0,0 +1,246 @@
+from prediction_stream import ServerSentEventParser, PredictionTable, PredictionStream
+from train_predictor import TrainPredictor, TrainPredictorDependencies, Direction
+from testing_extra import MockNetwork, StubMBTAServer, StubEventStreamServer, ThreadedStreamOpener, synthetic_schedule_json, chunked
+from time_conversion import parse_mbta_time
+from datetime import datetime, timedelta
+import json
+import os
+import time
+import unittest
+import logging
+
+mock_logger = logging.getLogger("mock")
+
+def stream_path(file):
+    current_file_directory = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_file_directory, 'testdata', 'streams', file)
+
+def load_test_stream(file):
+    with open(stream_path(file), 'rb') as file:
+        return file.read()
+
+def prediction_event_data(trip_id, time):
+    return json.dumps({
+        "attributes": {"arrival_time": time, "departure_time": time, "direction_id": 1},
+        "id": f"prediction-{trip_id}",
+        "relationships": {"trip": {"data": {"id": trip_id, "type": "trip"}}},
+        "type": "prediction",
+    })
+
+# wait_until keeps calling fcn until it returns True. This is needed because
+# events from the stub server are received on a background thread.
+def wait_until(fcn, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if fcn():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timed out waiting for condition")
+
+class Test_ServerSentEventParser(unittest.TestCase):
+    def test_recorded_stream(self):
+        data = load_test_stream('predictions.txt')
+        for chunk_size in [1, 5, 64, 4096]:
+            with self.subTest(chunk_size=chunk_size):
+                parser = ServerSentEventParser()
+                events = []
+                for chunk in chunked(data, chunk_size):
+                    events.extend(parser.feed(chunk))
+                self.assertEqual([event for event, _ in events], ["reset", "update", "add", "add", "remove"])
+                self.assertEqual(json.loads(events[0][1])[0]["id"], "prediction-Synthetic-100000-700-FB-0275-S-10-CR-Franklin")
+
+    def test_multiline_data_and_crlf(self):
+        parser = ServerSentEventParser()
+        events = parser.feed(b"event: add\r\ndata: line1\r\ndata:line2\r\n\r\ndata: no event name\n\n")
+        self.assertEqual(events, [("add", "line1\nline2"), ("message", "no event name")])
+
+    def test_comment_only(self):
+        parser = ServerSentEventParser()
+        self.assertEqual(parser.feed(b": keep-alive\n\n"), [])
+
+class Test_PredictionTable(unittest.TestCase):
+    def test_recorded_stream(self):
+        table = PredictionTable()
+        self.assertFalse(table.synced)
+
+        parser = ServerSentEventParser()
+        events = parser.feed(load_test_stream('predictions.txt'))
+
+        table.apply(*events[0])
+        self.assertTrue(table.synced)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.prediction_for_trip("Synthetic-100000-700")["arrival_time"], "2025-10-22T05:02:00-04:00")
+        self.assertEqual(table.prediction_for_trip("Synthetic-100000-700")["direction_id"], Direction.IN_BOUND)
+
+        table.apply(*events[1])
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.prediction_for_trip("Synthetic-100000-700")["arrival_time"], "2025-10-22T05:04:00-04:00")
+
+        for event in events[2:]:
+            table.apply(*event)
+        self.assertEqual(len(table), 2)
+        self.assertIsNone(table.prediction_for_trip("Synthetic-100000-700"))
+        self.assertEqual(table.prediction_for_trip("Synthetic-100001-701")["departure_time"], "2025-10-22T05:25:00-04:00")
+        self.assertEqual(table.prediction_for_trip("Synthetic-100002-702")["arrival_time"], "2025-10-22T05:43:00-04:00")
+
+    def test_reset_replaces_everything(self):
+        table = PredictionTable()
+        table.apply("reset", "[" + prediction_event_data("a", "2025-10-22T05:00:00-04:00") + "]")
+        table.apply("reset", "[" + prediction_event_data("b", "2025-10-22T06:00:00-04:00") + "]")
+        self.assertEqual(len(table), 1)
+        self.assertIsNone(table.prediction_for_trip("a"))
+        self.assertIsNotNone(table.prediction_for_trip("b"))
+
+# MockConnection is a scripted connection for PredictionStream. Each call to
+# read_available returns the next chunk, an Exception in the script is raised.
+class MockConnection:
+    def __init__(self, script):
+        self._script = list(script)
+        self.closed = False
+
+    def read_available(self):
+        if not self._script:
+            return b""
+        chunk = self._script.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        return chunk
+
+    def close(self):
+        self.closed = True
+
+class Test_PredictionStream(unittest.TestCase):
+    def test_reconnect_backoff(self):
+        monotonic = [0]
+        connections = []
+        def open_stream(url, headers):
+            self.assertEqual(headers["accept"], "text/event-stream")
+            connection = MockConnection([
+                b"event: reset\ndata: [" + prediction_event_data("a", "2025-10-22T05:00:00-04:00").encode() + b"]\n\n",
+                OSError("connection reset"),
+            ])
+            connections.append(connection)
+            return connection
+
+        stream = PredictionStream(open_stream, mock_logger, reconnect_seconds=60, monotonicFcn=lambda: monotonic[0])
+        self.assertTrue(stream.poll())
+        self.assertTrue(stream.connected)
+        self.assertEqual(len(stream.table), 1)
+
+        # Losing the connection should mark the table as not synced so callers
+        # fall back to polling.
+        self.assertFalse(stream.poll())
+        self.assertFalse(stream.connected)
+        self.assertTrue(connections[0].closed)
+        self.assertFalse(stream.table.synced)
+        self.assertEqual(len(stream.table), 0)
+
+        # We shouldn't try to reconnect right away.
+        monotonic[0] = 30
+        self.assertFalse(stream.poll())
+        self.assertEqual(len(connections), 1)
+
+        monotonic[0] = 61
+        self.assertTrue(stream.poll())
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(stream.connect_count, 2)
+        self.assertEqual(stream.disconnect_count, 1)
+
+    def test_failed_connect(self):
+        def open_stream(url, headers):
+            raise OSError("no network")
+        stream = PredictionStream(open_stream, mock_logger, monotonicFcn=lambda: 0)
+        self.assertFalse(stream.poll())
+        self.assertFalse(stream.connected)
+
+class Test_next_trains_streaming(unittest.TestCase):
+    # These tests run TrainPredictor against StubEventStreamServer for
+    # predictions and StubMBTAServer for schedules (and polled predictions
+    # when the stream isn't available).
+    def setUp(self):
+        self.now = datetime.fromisoformat('2025-10-22T04:50:00')
+        self.monotonic = 0
+
+    def create_predictor(self, schedules, predictions):
+        self.network = MockNetwork()
+        self.stream = PredictionStream(ThreadedStreamOpener(), mock_logger, url=predictions.url, reconnect_seconds=60, monotonicFcn=lambda: self.monotonic)
+        deps = TrainPredictorDependencies(self.network, datetime, timedelta, lambda: self.now, mbta_api_key=None, logger=mock_logger, prediction_stream=self.stream)
+        return TrainPredictor(deps, schedulesSource=schedules.url, predictionsSource=schedules.predictions_url)
+
+    def schedule_requests(self, server):
+        return [p for p in server.paths if p == "/schedules"]
+
+    def poll_requests(self, server):
+        return [p for p in server.paths if p == "/predictions"]
+
+    def test_stream(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22", predicted_count=0)}
+        with StubMBTAServer(days) as schedules, StubEventStreamServer() as predictions:
+            train_predictor = self.create_predictor(schedules, predictions)
+
+            # Until the stream has sent us a reset we fall back to polling.
+            results = train_predictor.next_trains(count=3)
+            self.assertEqual(len(self.schedule_requests(schedules)), 1)
+            self.assertEqual(len(self.poll_requests(schedules)), 1)
+            self.assertEqual(results[0].time, parse_mbta_time('2025-10-22T05:00:00-04:00'))
+
+            predictions.wait_for_connection()
+            self.assertEqual(predictions.request_headers[0]["accept"], "text/event-stream")
+            predictions.replay(stream_path('predictions.txt'))
+            wait_until(lambda: self.stream.poll() and len(self.stream.table) == 2)
+
+            # Now that the stream is synced next_trains is a purely local query
+            # using the schedule we already have.
+            results = train_predictor.next_trains(count=3)
+            self.assertEqual(len(self.schedule_requests(schedules)), 1)
+            self.assertEqual(results[0].schedule_id, "schedule-Synthetic-100000-700-FB-0275-S-10")
+            self.assertEqual(results[0].time, parse_mbta_time('2025-10-22T05:00:00-04:00'))
+            self.assertEqual(results[1].schedule_id, "schedule-Synthetic-100001-701-FB-0275-S-130")
+            self.assertEqual(results[1].time, parse_mbta_time('2025-10-22T05:25:00-04:00'))
+            self.assertEqual(results[2].time, parse_mbta_time('2025-10-22T05:43:00-04:00'))
+
+            request_count = len(schedules.requests)
+            for _ in range(10):
+                train_predictor.next_trains(count=3)
+            self.assertEqual(len(schedules.requests), request_count)
+
+            # Updates from the stream show up in the next query
+            predictions.send("update", prediction_event_data("Synthetic-100001-701", "2025-10-22T05:30:00-04:00"))
+            wait_until(lambda: train_predictor.next_trains(count=3)[1].time == parse_mbta_time('2025-10-22T05:30:00-04:00'))
+            self.assertEqual(len(schedules.requests), request_count)
+
+    def test_fallback_on_disconnect(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22", predicted_count=0)}
+        with StubMBTAServer(days) as schedules, StubEventStreamServer() as predictions:
+            train_predictor = self.create_predictor(schedules, predictions)
+            train_predictor.next_trains(count=3)
+            predictions.wait_for_connection()
+            predictions.replay(stream_path('predictions.txt'))
+            wait_until(lambda: self.stream.poll() and len(self.stream.table) == 2)
+            train_predictor.next_trains(count=3)
+            poll_count = len(self.poll_requests(schedules))
+
+            # When the stream disconnects we go back to polling until we are
+            # able to reconnect.
+            predictions.disconnect()
+            wait_until(lambda: not self.stream.poll())
+            self.assertFalse(self.stream.connected)
+            train_predictor.next_trains(count=3)
+            self.assertEqual(len(self.poll_requests(schedules)), poll_count + 1)
+            self.assertEqual(self.stream.disconnect_count, 1)
+
+            self.monotonic += 61
+            train_predictor.next_trains(count=3)
+            self.assertEqual(len(self.poll_requests(schedules)), poll_count + 2)
+            self.assertEqual(predictions.wait_for_connection(), 2)
+
+            # Once we are synced again we stop polling. The schedule for the day
+            # is only ever fetched once.
+            predictions.replay(stream_path('predictions.txt'))
+            wait_until(lambda: self.stream.poll() and len(self.stream.table) == 2)
+            train_predictor.next_trains(count=3)
+            self.assertEqual(len(self.schedule_requests(schedules)), 1)
+            self.assertEqual(len(self.poll_requests(schedules)), poll_count + 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+# RenderCache sits in front of matrix_portal.set_text and only passes along
+# text that is different from what the label is already showing.
+#
+# Every call to set_text makes the label lay out and render its text all over
+# again, even when the text hasn't changed. The arrival times are rendered
+# every time through the main loop but only change once a minute, so almost
+# all of those calls are wasted. updated_count and skipped_count keep track of
+# how many calls were passed along to the matrix portal and how many were
+# skipped.
+#
+# If anything other than RenderCache changes the text of a label call
+# invalidate so that the next set_text for that label is always passed along.
+class RenderCache:
+    def __init__(self, matrix_portal):
+        self._matrix_portal = matrix_portal
+        self._texts = {}
+        self.updated_count = 0
+        self.skipped_count = 0
+
+    def set_text(self, text, index):
+        if self._texts.get(index) == text:
+            self.skipped_count += 1
+            return
+        self._matrix_portal.set_text(text, index)
+        self._texts[index] = text
+        self.updated_count += 1
+
+    def invalidate(self, index=None):
+        if index is None:
+            self._texts.clear()
+        else:
+            self._texts.pop(index, None)
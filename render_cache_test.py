@@ -0,0 +1,74 @@
+from render_cache import RenderCache
+from time_conversion import TimeConversion, TimeConversionDependencies, seconds_from_datetime
+from datetime import datetime, timedelta
+import unittest
+
+# FakeMatrixPortal records every call to set_text, each of which would make
+# the label lay out its text again on the board.
+class FakeMatrixPortal:
+    def __init__(self):
+        self.set_text_calls = []
+
+    def set_text(self, text, index):
+        self.set_text_calls.append((text, index))
+
+class Test_RenderCache(unittest.TestCase):
+    def test_skips_unchanged_text(self):
+        portal = FakeMatrixPortal()
+        cache = RenderCache(portal)
+        cache.set_text("5min", 1)
+        cache.set_text("5min", 1)
+        cache.set_text("6min", 2)
+        cache.set_text("4min", 1)
+        self.assertEqual(portal.set_text_calls, [("5min", 1), ("6min", 2), ("4min", 1)])
+        self.assertEqual(cache.updated_count, 3)
+        self.assertEqual(cache.skipped_count, 1)
+
+    def test_invalidate(self):
+        portal = FakeMatrixPortal()
+        cache = RenderCache(portal)
+        cache.set_text("5min", 1)
+        cache.set_text("6min", 2)
+        cache.invalidate(1)
+        cache.set_text("5min", 1)
+        cache.set_text("6min", 2)
+        cache.invalidate()
+        cache.set_text("6min", 2)
+        self.assertEqual(portal.set_text_calls, [("5min", 1), ("6min", 2), ("5min", 1), ("6min", 2)])
+
+    def test_steady_state_loop(self):
+        # Render the arrival times once a second for 10 minutes, like the main
+        # loop does, and check that labels are only updated when the minutes
+        # change.
+        start = datetime.fromisoformat('2025-10-22T12:00:00')
+        now = [start]
+        time_conversion = TimeConversion(TimeConversionDependencies(lambda: now[0]))
+        start_seconds = seconds_from_datetime(start)
+        trains = [start_seconds + 600, start_seconds + 1215, start_seconds + 4000]
+
+        portal = FakeMatrixPortal()
+        cache = RenderCache(portal)
+        updates_per_second = []
+        for second in range(600):
+            now[0] = start + timedelta(seconds=second)
+            before = len(portal.set_text_calls)
+            for index, train in enumerate(trains):
+                cache.set_text(time_conversion.relative_time_from_now(train), index)
+            updates_per_second.append(len(portal.set_text_calls) - before)
+
+        self.assertEqual(updates_per_second[0], 3)
+
+        # Each train's time changes once a minute, so there are at most three
+        # seconds a minute where anything is updated and every other second
+        # does nothing at all.
+        seconds_with_updates = [second for second, updates in enumerate(updates_per_second) if updates > 0]
+        self.assertLessEqual(len(seconds_with_updates), 1 + 3 * 10)
+        for first, second in zip(seconds_with_updates, seconds_with_updates[1:]):
+            self.assertGreater(second - first, 1)
+
+        self.assertEqual(cache.updated_count, len(portal.set_text_calls))
+        self.assertEqual(cache.updated_count + cache.skipped_count, 3 * 600)
+        self.assertLess(cache.updated_count, 3 * 600 / 50)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+import json
+
+# SCHEDULE_ATTRIBUTES are the only schedule / prediction attributes that
+# TrainPredictor looks at. Anything else in the MBTA API response is ignored.
+SCHEDULE_ATTRIBUTES = ("arrival_time", "departure_time", "direction_id")
+
+# ScheduleItem is a single schedule from the MBTA API along with the prediction
+# associated with that schedule.
+#
+# schedule and prediction are dicts of the schedule / prediction attributes (see
+# SCHEDULE_ATTRIBUTES). prediction is None if the MBTA API doesn't have a
+# prediction for the schedule yet.
+#
+# trip_id is the id of the trip the schedule is for, if the response included
+# the trip relationship. It is used to join up schedules with predictions from
+# the prediction stream.
+class ScheduleItem:
+    def __init__(self, schedule_id, schedule, prediction, trip_id=None):
+        self.schedule_id = schedule_id
+        self.schedule = schedule
+        self.prediction = prediction
+        self.trip_id = trip_id
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return f"ScheduleItem(schedule_id={self.schedule_id}, schedule={self.schedule}, prediction={self.prediction}, trip_id={self.trip_id})"
+
+# JsonScheduleReader reads a response from the MBTA API by parsing the entire
+# response into JSON and then joining schedules up with their predictions.
+#
+# This is the simplest approach but it means that the entire JSON tree for the
+# response needs to fit in memory.
+class JsonScheduleReader:
+    def read(self, response):
+        return self.items(response.json())
+
+    @staticmethod
+    def items(schedule_json):
+        items = []
+        included = {item["id"]: item for item in schedule_json.get("included", [])}
+
+        for item in schedule_json.get("data", []):
+
+            relationships = item.get("relationships", {})
+
+            # Get prediction if available
+            prediction = None
+            prediction_ref = relationships.get("prediction", {}).get("data")
+            if prediction_ref and prediction_ref.get("id") in included:
+                prediction = included[prediction_ref["id"]]["attributes"]
+
+            trip_ref = relationships.get("trip", {}).get("data")
+            trip_id = trip_ref.get("id") if trip_ref else None
+
+            items.append(ScheduleItem(item.get("id"), item.get("attributes", {}), prediction, trip_id))
+
+        return items
+
+# StreamingScheduleReader reads a response from the MBTA API one chunk at a time
+# without ever building the JSON tree for the response.
+#
+# A full day of schedules for the Franklin station is a fairly large response
+# and parsing it into JSON means the whole thing sits in the ESP32 heap at once
+# (and then again when we build the lookup of included predictions). Instead we
+# walk the bytes of the response once and only hold onto the handful of fields
+# we actually need: the schedule id, SCHEDULE_ATTRIBUTES and the ids of the
+# related prediction and trip.
+#
+# The one thing we can't avoid holding onto is the compact schedule data until
+# we get to the end of the response. JSON:API puts the "included" predictions
+# AFTER the "data" schedules so we can't join a schedule to its prediction until
+# we have read the whole response.
+class StreamingScheduleReader:
+    def __init__(self, chunk_size=512):
+        self._chunk_size = chunk_size
+
+    def read(self, response):
+        try:
+            return self.read_chunks(response.iter_content(chunk_size=self._chunk_size))
+        finally:
+            response.close()
+
+    def read_chunks(self, chunks):
+        parser = JsonApiStreamParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.finish()
+
+_QUOTE = ord('"')
+_OPEN_OBJECT = ord('{')
+_CLOSE_OBJECT = ord('}')
+_OPEN_ARRAY = ord('[')
+_CLOSE_ARRAY = ord(']')
+_COMMA = ord(',')
+_WHITESPACE = b' \t\r\n:'
+_LITERAL_END = b',}] \t\r\n'
+
+_TOKEN_NONE = 0
+_TOKEN_STRING = 1
+_TOKEN_LITERAL = 2
+
+# JsonApiStreamParser is a minimal incremental JSON parser that understands
+# just enough of the JSON:API structure returned by the MBTA API to pull out
+# schedules and the predictions that are included with them.
+#
+# Bytes are passed in with feed() in arbitrarily sized chunks and finish() is
+# called at the end to get the list of ScheduleItem.
+#
+# The parser tracks where it is in the document with a stack of object keys
+# (None for arrays). For example the id of a schedule is at the path ["data",
+# None, "id"]. Strings and literals are only copied out of the response if they
+# are at a path we care about, everything else is skipped over.
+class JsonApiStreamParser:
+    def __init__(self):
+        self._path = []
+        self._is_object = []
+        self._expect_key = False
+
+        self._token = _TOKEN_NONE
+        self._keep_token = False
+        self._token_has_escape = False
+        self._pending_escape = False
+        self._buffer = bytearray()
+
+        self._record_id = None
+        self._record_attributes = None
+        self._record_prediction_id = None
+        self._record_trip_id = None
+
+        self._schedules = []
+        self._predictions = {}
+
+    def feed(self, chunk):
+        i = 0
+        n = len(chunk)
+        while i < n:
+            if self._token == _TOKEN_STRING:
+                i = self._feed_string(chunk, i, n)
+                continue
+            if self._token == _TOKEN_LITERAL:
+                i = self._feed_literal(chunk, i, n)
+                continue
+
+            c = chunk[i]
+            if c == _QUOTE:
+                self._start_token(_TOKEN_STRING, self._expect_key or self._is_wanted())
+                i += 1
+            elif c == _OPEN_OBJECT:
+                self._open(True)
+                i += 1
+            elif c == _OPEN_ARRAY:
+                self._open(False)
+                i += 1
+            elif c == _CLOSE_OBJECT or c == _CLOSE_ARRAY:
+                self._close()
+                i += 1
+            elif c == _COMMA:
+                self._expect_key = len(self._is_object) > 0 and self._is_object[-1]
+                i += 1
+            elif c in _WHITESPACE:
+                i += 1
+            else:
+                # Start of a number, true, false or null. Don't advance i so
+                # _feed_literal sees the first character of the literal.
+                self._start_token(_TOKEN_LITERAL, self._is_wanted())
+
+    def finish(self):
+        items = []
+        for schedule_id, schedule, prediction_id, trip_id in self._schedules:
+            items.append(ScheduleItem(schedule_id, schedule, self._predictions.get(prediction_id), trip_id))
+        self._schedules = []
+        self._predictions = {}
+        return items
+
+    def _start_token(self, token, keep):
+        self._token = token
+        self._keep_token = keep
+        self._token_has_escape = False
+        if keep:
+            self._buffer = bytearray()
+
+    def _feed_string(self, chunk, i, n):
+        if self._pending_escape:
+            # The previous chunk ended with a backslash so this character is
+            # escaped and can't end the string.
+            if self._keep_token:
+                self._buffer.append(chunk[i])
+            self._pending_escape = False
+            return i + 1
+
+        quote = chunk.find(b'"', i)
+        backslash = chunk.find(b'\\', i, n if quote == -1 else quote)
+        if backslash != -1:
+            self._token_has_escape = True
+            if self._keep_token:
+                self._buffer.extend(chunk[i:backslash + 1])
+            if backslash + 1 >= n:
+                self._pending_escape = True
+                return n
+            if self._keep_token:
+                self._buffer.append(chunk[backslash + 1])
+            return backslash + 2
+
+        if quote == -1:
+            if self._keep_token:
+                self._buffer.extend(chunk[i:])
+            return n
+
+        if self._keep_token:
+            self._buffer.extend(chunk[i:quote])
+        self._token = _TOKEN_NONE
+        self._end_string()
+        return quote + 1
+
+    def _end_string(self):
+        value = None
+        if self._keep_token:
+            if self._token_has_escape:
+                value = json.loads(b'"' + self._buffer + b'"')
+            else:
+                value = self._buffer.decode()
+
+        if self._expect_key:
+            self._path[-1] = value
+            self._expect_key = False
+        elif self._keep_token:
+            self._set_value(value)
+
+    def _feed_literal(self, chunk, i, n):
+        start = i
+        while i < n and chunk[i] not in _LITERAL_END:
+            i += 1
+        if self._keep_token:
+            self._buffer.extend(chunk[start:i])
+        if i < n:
+            self._token = _TOKEN_NONE
+            if self._keep_token:
+                self._set_value(self._decode_literal())
+        return i
+
+    def _decode_literal(self):
+        text = self._buffer.decode()
+        if text == "null":
+            return None
+        if text == "true":
+            return True
+        if text == "false":
+            return False
+        if "." in text or "e" in text or "E" in text:
+            return float(text)
+        return int(text)
+
+    def _is_record_path(self):
+        # True if we are directly inside one of the schedule / prediction
+        # objects in the top level "data" or "included" arrays.
+        path = self._path
+        return len(path) >= 2 and path[1] is None and (path[0] == "data" or path[0] == "included")
+
+    def _is_wanted(self):
+        if not self._is_record_path():
+            return False
+        path = self._path
+        depth = len(path)
+        if depth == 3:
+            return path[2] == "id"
+        if depth == 4:
+            return path[2] == "attributes" and path[3] in SCHEDULE_ATTRIBUTES
+        if depth == 6:
+            return path[0] == "data" and path[2] == "relationships" and (path[3] == "prediction" or path[3] == "trip") and path[4] == "data" and path[5] == "id"
+        return False
+
+    def _set_value(self, value):
+        path = self._path
+        depth = len(path)
+        if depth == 3:
+            self._record_id = value
+        elif depth == 4:
+            self._record_attributes[path[3]] = value
+        elif depth == 6:
+            if path[3] == "prediction":
+                self._record_prediction_id = value
+            else:
+                self._record_trip_id = value
+
+    def _open(self, is_object):
+        if is_object and len(self._path) == 2 and self._is_record_path():
+            self._record_id = None
+            self._record_attributes = {}
+            self._record_prediction_id = None
+            self._record_trip_id = None
+        self._path.append(None)
+        self._is_object.append(is_object)
+        self._expect_key = is_object
+
+    def _close(self):
+        self._path.pop()
+        self._is_object.pop()
+        self._expect_key = False
+        if len(self._path) == 2 and self._is_record_path() and self._record_attributes is not None:
+            if self._path[0] == "data":
+                self._schedules.append((self._record_id, self._record_attributes, self._record_prediction_id, self._record_trip_id))
+            else:
+                self._predictions[self._record_id] = self._record_attributes
+            self._record_attributes = None
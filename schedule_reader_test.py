@@ -0,0 +1,181 @@
+from schedule_reader import JsonScheduleReader, StreamingScheduleReader, JsonApiStreamParser, SCHEDULE_ATTRIBUTES
+from train_predictor import TrainPredictor, TrainPredictorDependencies, Direction
+from testing_extra import synthetic_schedule_bytes, chunked
+from time_conversion import datetime_from_seconds
+from datetime import datetime, timedelta
+import json
+import os
+import tracemalloc
+import unittest
+import logging
+
+mock_logger = logging.getLogger("mock")
+
+FIXTURES = [
+    'data_array_empty.json',
+    'multiple_results.json',
+    'no_data_property.json',
+    'simple_inbound.json',
+    'simple_no_arrival_inbound.json',
+    'simple_no_departure_outbound.json',
+    'simple_no_prediction_inbound.json',
+    'simple_no_prediction_outbound.json',
+    'simple_outbound.json',
+    'simple_sparse.json',
+]
+
+def load_test_schedule_bytes(file):
+    current_file_directory = os.path.dirname(os.path.abspath(__file__))
+    file_path = os.path.join(current_file_directory, 'testdata', 'schedules', file)
+    with open(file_path, 'rb') as file:
+        return file.read()
+
+def mock_now_func(timeOfNow):
+    return lambda : datetime.fromisoformat(timeOfNow).replace(tzinfo=None)
+
+class MockStreamResponse:
+    def __init__(self, data):
+        self.status_code = 200
+        self.headers = {}
+        self.text = data.decode()
+        self._data = data
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        return iter(chunked(self._data, chunk_size))
+
+    def json(self):
+        return json.loads(self._data)
+
+    def close(self):
+        self.closed = True
+
+class MockStreamNetwork:
+    def __init__(self, data):
+        self._data = data
+
+    def add_json_content_type(self, type):
+        return
+
+    def fetch(self, url, headers = {}, timeout=30):
+        return MockStreamResponse(self._data)
+
+# comparable converts a list of ScheduleItem into something we can easily
+# compare. We only compare SCHEDULE_ATTRIBUTES because the JsonScheduleReader
+# keeps all of the attributes in the response.
+def comparable(items):
+    def attrs(a):
+        if a is None:
+            return None
+        return {k: a.get(k) for k in SCHEDULE_ATTRIBUTES}
+    return [(item.schedule_id, attrs(item.schedule), attrs(item.prediction), item.trip_id) for item in items]
+
+class Test_StreamingScheduleReader(unittest.TestCase):
+    def assert_same_as_json(self, data):
+        expected = comparable(JsonScheduleReader.items(json.loads(data)))
+
+        # Use a few different chunk sizes to make sure we correctly handle
+        # tokens that are split across chunks, including the worst case of
+        # every byte being its own chunk.
+        for chunk_size in [1, 7, 64, 512]:
+            with self.subTest(chunk_size=chunk_size):
+                actual = comparable(StreamingScheduleReader().read_chunks(chunked(data, chunk_size)))
+                self.assertEqual(actual, expected)
+
+    def test_fixtures(self):
+        for fixture in FIXTURES:
+            with self.subTest(fixture=fixture):
+                self.assert_same_as_json(load_test_schedule_bytes(fixture))
+
+    def test_synthetic_day(self):
+        self.assert_same_as_json(synthetic_schedule_bytes(200))
+
+    def test_escaped_strings(self):
+        data = json.dumps({
+            "data": [{
+                "attributes": {"arrival_time": "2025-10-22T05:06:00-04:00", "direction_id": 1, "stop_headsign": "a \"quoted\" \\ headsign"},
+                "id": "schedule-\"odd\"-\\id-é",
+                "relationships": {"prediction": {"data": None}},
+                "type": "schedule",
+            }],
+        }).encode()
+        self.assert_same_as_json(data)
+
+    def test_read_closes_response(self):
+        response = MockStreamResponse(load_test_schedule_bytes('simple_inbound.json'))
+        items = StreamingScheduleReader().read(response)
+        self.assertTrue(response.closed)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0].schedule_id, "schedule-Sept8Read-768162-787-FB-0275-S-130")
+        self.assertEqual(items[0].prediction["arrival_time"], "2025-10-22T23:04:53-04:00")
+        self.assertEqual(items[0].trip_id, "Sept8Read-768162-787")
+
+    def test_only_wanted_fields_kept(self):
+        parser = JsonApiStreamParser()
+        parser.feed(load_test_schedule_bytes('simple_inbound.json'))
+        items = parser.finish()
+        self.assertEqual(len(items), 1)
+        self.assertEqual(sorted(items[0].schedule.keys()), sorted(SCHEDULE_ATTRIBUTES))
+        self.assertEqual(sorted(items[0].prediction.keys()), sorted(SCHEDULE_ATTRIBUTES))
+
+class Test_next_trains_streaming(unittest.TestCase):
+    def test_next_trains(self):
+        mock_now = mock_now_func('2025-10-22T04:06:00-04:00')
+        network = MockStreamNetwork(load_test_schedule_bytes('multiple_results.json'))
+        deps = TrainPredictorDependencies(network, datetime, timedelta, mock_now, mbta_api_key=None, logger=mock_logger, schedule_reader=StreamingScheduleReader())
+        train_predictor = TrainPredictor(deps, predictionsSource=None)
+
+        result = train_predictor.next_trains(count=3)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0].direction, Direction.IN_BOUND)
+        self.assertEqual(datetime_from_seconds(result[0].time, datetime).isoformat(), "2025-10-22T05:06:00")
+        self.assertEqual(result[1].direction, Direction.OUT_BOUND)
+        self.assertEqual(datetime_from_seconds(result[1].time, datetime).isoformat(), "2025-10-22T06:06:00")
+        self.assertEqual(result[2], None)
+
+class Test_peak_memory(unittest.TestCase):
+    # These tests use tracemalloc to measure the peak memory used while going
+    # from the raw bytes of a response to the list of trains. The raw bytes
+    # themselves are allocated before we start tracing, on the board they are
+    # read off of the socket a chunk at a time.
+    def create_predictor(self):
+        mock_now = mock_now_func('2025-10-22T04:06:00-04:00')
+        deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=mock_now, mbta_api_key=None, logger=mock_logger)
+        return TrainPredictor(deps)
+
+    def peak_memory(self, fcn):
+        tracemalloc.start()
+        try:
+            tracemalloc.reset_peak()
+            fcn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peak
+
+    def measure(self, data):
+        train_predictor = self.create_predictor()
+        chunks = chunked(data, 512)
+
+        json_peak = self.peak_memory(lambda: train_predictor._analyze_items(3, JsonScheduleReader.items(json.loads(data))))
+        streaming_peak = self.peak_memory(lambda: train_predictor._analyze_items(3, StreamingScheduleReader().read_chunks(chunks)))
+        return json_peak, streaming_peak
+
+    def test_fixtures(self):
+        # The fixtures are all tiny responses so we don't expect a big
+        # difference here, but streaming should still come out ahead.
+        for fixture in FIXTURES:
+            with self.subTest(fixture=fixture):
+                json_peak, streaming_peak = self.measure(load_test_schedule_bytes(fixture))
+                self.assertLess(streaming_peak, json_peak)
+
+    def test_synthetic_day(self):
+        data = synthetic_schedule_bytes(200)
+        json_peak, streaming_peak = self.measure(data)
+
+        # A full day of trains is where streaming really pays off since we
+        # never hold the JSON tree for the whole response.
+        self.assertLess(streaming_peak, json_peak / 2)
+
+if __name__ == '__main__':
+    unittest.main()
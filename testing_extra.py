@@ -0,0 +1,425 @@
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import hashlib
+import json
+import os
+import queue
+import threading
+import urllib.request
+
+# testing_extra contains helpers that are shared between tests. It is not
+# installed onto the board.
+
+# BENCHMARK is set when the tests that check how fast something runs should
+# run. Timings depend on the machine running the tests so they are skipped
+# unless the BENCHMARK environment variable is set (see "Running tests" in
+# README.md).
+BENCHMARK = bool(os.environ.get("BENCHMARK"))
+
+class MockResponse:
+    def __init__(self, status_code, jsonResponse, textResponse, headers = {}):
+        self.status_code = status_code
+        self._jsonResponse = jsonResponse
+        self.text = textResponse
+        self.headers = headers
+
+    def json(self):
+        return self._jsonResponse
+
+    def iter_content(self, chunk_size=1):
+        return iter(chunked(self.text.encode(), chunk_size))
+
+    def close(self):
+        return
+
+class MockNetwork:
+    def __init__(self):
+        self.fetch_count = 0
+        self.bytes_received = 0
+
+    def add_json_content_type(self, type):
+        return
+    
+    # This fetch method is a test double that attempts to replicate the behavior
+    # of the circuit python portal base fetch method as so we can test out our
+    # code in CPython.
+    def fetch(self, url, headers = {}, timeout=30):
+        self.fetch_count += 1
+        req = urllib.request.Request(url, headers=headers)
+
+        try:
+            with urllib.request.urlopen(req) as response:
+                return self._mock_response(response.status, response.read(), response.headers)
+        except urllib.error.HTTPError as e:
+            return self._mock_response(e.code, e.read(), e.headers)
+
+    def _mock_response(self, status_code, data, headers):
+        self.bytes_received += len(data)
+        text = data.decode('utf-8')
+        jsonData = json.loads(text) if text else None
+        return MockResponse(status_code, jsonData, text, {k.lower(): v for k, v in headers.items()})
+
+# StubMBTAServer is a local HTTP server that stands in for the MBTA API
+# /schedules and /predictions endpoints.
+#
+# It serves synthetic_schedule_json days and honors the filter[date],
+# filter[min_time], filter[max_time] and page[limit] query parameters in the
+# same way as the real API (including "service day" times past 24:00). Every
+# other query parameter is ignored.
+#
+# /predictions serves the included predictions of the predictions_date day
+# (the first day if not set). The real API only has predictions for the
+# current day and ignores the date and time filters.
+#
+# It also supports conditional requests. Every response has a Last-Modified
+# header (last_modified) and an ETag header (a hash of the body). If a request
+# has a matching If-Modified-Since or If-None-Match header the server responds
+# with a 304 and no body. Tests that change days should also update
+# last_modified.
+#
+# Use it as a context manager, url is the base URL to pass to TrainPredictor as
+# dataSource or schedulesSource and predictions_url is the base URL to pass as
+# predictionsSource. paths records the path of every request.
+class StubMBTAServer:
+    def __init__(self, days):
+        # days maps a service date string (ex "2025-10-22") to a
+        # synthetic_schedule_json response for that day.
+        self.days = days
+        self.predictions_date = None
+        self.last_modified = "Wed, 22 Oct 2025 09:00:00 GMT"
+        self.paths = []
+        self.requests = []
+        self.request_headers = []
+        self.bytes_sent = 0
+        self.full_response_count = 0
+        self.not_modified_response_count = 0
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, format, *args):
+                return
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/schedules?filter[stop]=place-FB-0275"
+
+    @property
+    def predictions_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/predictions?filter[stop]=place-FB-0275"
+
+    def _handle(self, request):
+        url = urlsplit(request.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        self.paths.append(url.path)
+        self.requests.append(query)
+        self.request_headers.append({k.lower(): v for k, v in request.headers.items()})
+        if url.path == "/predictions":
+            response = self._predictions_response()
+        else:
+            response = self._filtered_response(query)
+        body = json.dumps(response, separators=(",", ":")).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+
+        # Like real HTTP servers If-None-Match takes precedence over
+        # If-Modified-Since when both are sent.
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            not_modified = if_none_match == etag
+        else:
+            not_modified = request.headers.get("If-Modified-Since") == self.last_modified
+
+        if not_modified:
+            self.not_modified_response_count += 1
+            request.send_response(304)
+            request.send_header("Last-Modified", self.last_modified)
+            request.send_header("ETag", etag)
+            request.end_headers()
+            return
+
+        self.full_response_count += 1
+        self.bytes_sent += len(body)
+        request.send_response(200)
+        request.send_header("Content-Type", "application/vnd.api+json")
+        request.send_header("Content-Length", str(len(body)))
+        request.send_header("Last-Modified", self.last_modified)
+        request.send_header("ETag", etag)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _filtered_response(self, query):
+        service_date = query.get("filter[date]")
+        day = self.days.get(service_date) if service_date is not None else next(iter(self.days.values()))
+        if day is None:
+            return {"data": [], "jsonapi": {"version": "1.0"}}
+
+        min_minutes = _minutes_after_midnight(query["filter[min_time]"]) if "filter[min_time]" in query else None
+        max_minutes = _minutes_after_midnight(query["filter[max_time]"]) if "filter[max_time]" in query else None
+        day_start = datetime.fromisoformat(service_date or day["data"][0]["attributes"]["arrival_time"][:10])
+
+        data = []
+        for item in day["data"]:
+            attributes = item["attributes"]
+            time = datetime.fromisoformat(attributes["arrival_time"] or attributes["departure_time"]).replace(tzinfo=None)
+            minutes = (time - day_start) // timedelta(minutes=1)
+            if min_minutes is not None and minutes < min_minutes:
+                continue
+            if max_minutes is not None and minutes > max_minutes:
+                continue
+            data.append(item)
+
+        if "page[limit]" in query:
+            data = data[:int(query["page[limit]"])]
+
+        prediction_ids = set()
+        for item in data:
+            prediction_ref = item["relationships"]["prediction"]["data"]
+            if prediction_ref is not None:
+                prediction_ids.add(prediction_ref["id"])
+        included = [item for item in day["included"] if item["id"] in prediction_ids]
+
+        return {"data": data, "included": included, "jsonapi": {"version": "1.0"}}
+
+    def _predictions_response(self):
+        day = self.days.get(self.predictions_date) if self.predictions_date is not None else next(iter(self.days.values()))
+        return {"data": day["included"], "jsonapi": {"version": "1.0"}}
+
+# StubEventStreamServer is a local HTTP server that stands in for the MBTA
+# streaming API. Every request gets a text/event-stream response that stays open
+# until disconnect() is called.
+#
+# Events are sent to the currently connected client with send() (a single event)
+# or replay() (a recorded event stream, see testdata/streams).
+class StubEventStreamServer:
+    def __init__(self):
+        self.requests = []
+        self.request_headers = []
+        self._connections = queue.Queue()
+        self._current = None
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.0"
+
+            def do_GET(self):
+                stub._handle(self)
+
+            def log_message(self, format, *args):
+                return
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        if self._current is not None:
+            self._current.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/predictions?filter[stop]=place-FB-0275"
+
+    # wait_for_connection blocks until a client has connected and returns the
+    # number of connections so far.
+    def wait_for_connection(self, timeout=5):
+        self._current = self._connections.get(timeout=timeout)
+        return len(self.requests)
+
+    def send(self, event, data):
+        self.send_raw(f"event: {event}\ndata: {data}\n\n".encode())
+
+    def send_raw(self, data):
+        self._current.put(data)
+
+    def replay(self, path):
+        with open(path, 'rb') as file:
+            self.send_raw(file.read())
+
+    def disconnect(self):
+        self._current.put(None)
+        self._current = None
+
+    def _handle(self, request):
+        self.requests.append(request.path)
+        self.request_headers.append({k.lower(): v for k, v in request.headers.items()})
+
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.end_headers()
+        request.wfile.flush()
+
+        events = queue.Queue()
+        self._connections.put(events)
+        while True:
+            data = events.get()
+            if data is None:
+                return
+            request.wfile.write(data)
+            request.wfile.flush()
+
+# ThreadedStreamOpener opens event streams for PredictionStream on CPython. The
+# response is read on a background thread so read_available never blocks.
+class ThreadedStreamOpener:
+    def __call__(self, url, headers):
+        return ThreadedStreamConnection(url, headers)
+
+class ThreadedStreamConnection:
+    def __init__(self, url, headers):
+        self._chunks = queue.Queue()
+        self._closed = False
+        self._response = urllib.request.urlopen(urllib.request.Request(url, headers=headers))
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        try:
+            while True:
+                chunk = self._response.read1(1024)
+                if not chunk:
+                    break
+                self._chunks.put(chunk)
+        except Exception:
+            pass
+        self._chunks.put(None)
+
+    def read_available(self):
+        if self._closed:
+            raise ConnectionError("stream closed")
+        data = bytearray()
+        while True:
+            try:
+                chunk = self._chunks.get_nowait()
+            except queue.Empty:
+                return bytes(data)
+            if chunk is None:
+                self._closed = True
+                if data:
+                    return bytes(data)
+                raise ConnectionError("stream closed")
+            data.extend(chunk)
+
+    def close(self):
+        self._closed = True
+        self._response.close()
+
+# synthetic_schedule_json builds a MBTA API /schedules response (in the same
+# shape as the responses we get back from DATA_SOURCE) for a full day of trains
+# at the Franklin station.
+#
+# Trains alternate between inbound and outbound and are evenly spaced between
+# first_train and last_train. The first predicted_count trains also get an
+# included prediction that is one minute later than the schedule.
+def synthetic_schedule_json(trip_count, service_date="2025-10-22", first_train="05:00", last_train="25:00", predicted_count=3):
+    day_start = datetime.fromisoformat(service_date)
+    first_minutes = _minutes_after_midnight(first_train)
+    last_minutes = _minutes_after_midnight(last_train)
+    spacing = (last_minutes - first_minutes) / max(trip_count - 1, 1)
+
+    data = []
+    included = []
+    for index in range(trip_count):
+        trip_id = f"Synthetic-{100000 + index}-{700 + index}"
+        direction = 1 if index % 2 == 0 else 0
+        stop_sequence = 10 if direction == 1 else 130
+        schedule_time = day_start + timedelta(minutes=round(first_minutes + index * spacing))
+        schedule_time_str = _iso(schedule_time)
+
+        prediction_ref = None
+        if index < predicted_count:
+            prediction_id = f"prediction-{trip_id}-FB-0275-S-{stop_sequence}-CR-Franklin"
+            prediction_ref = {"id": prediction_id, "type": "prediction"}
+            prediction_time_str = _iso(schedule_time + timedelta(minutes=1))
+            included.append({
+                "attributes": {
+                    "arrival_time": prediction_time_str,
+                    "arrival_uncertainty": None,
+                    "departure_time": prediction_time_str,
+                    "departure_uncertainty": None,
+                    "direction_id": direction,
+                    "last_trip": False,
+                    "revenue": "REVENUE",
+                    "schedule_relationship": None,
+                    "status": None,
+                    "stop_sequence": stop_sequence,
+                    "update_type": None,
+                },
+                "id": prediction_id,
+                "relationships": {
+                    "route": {"data": {"id": "CR-Franklin", "type": "route"}},
+                    "stop": {"data": {"id": "FB-0275-S", "type": "stop"}},
+                    "trip": {"data": {"id": trip_id, "type": "trip"}},
+                    "vehicle": {"data": {"id": "1813", "type": "vehicle"}},
+                },
+                "type": "prediction",
+            })
+
+        data.append({
+            "attributes": {
+                "arrival_time": schedule_time_str,
+                "departure_time": schedule_time_str,
+                "direction_id": direction,
+                "drop_off_type": 0,
+                "pickup_type": 0,
+                "stop_headsign": "South Station via Back Bay" if direction == 1 else None,
+                "stop_sequence": stop_sequence,
+                "timepoint": True,
+            },
+            "id": f"schedule-{trip_id}-FB-0275-S-{stop_sequence}",
+            "relationships": {
+                "prediction": {"data": prediction_ref},
+                "route": {"data": {"id": "CR-Franklin", "type": "route"}},
+                "stop": {"data": {"id": "FB-0275-S", "type": "stop"}},
+                "trip": {"data": {"id": trip_id, "type": "trip"}},
+            },
+            "type": "schedule",
+        })
+
+    return {"data": data, "included": included, "jsonapi": {"version": "1.0"}}
+
+# synthetic_schedule_bytes is synthetic_schedule_json encoded the same compact
+# way the MBTA API encodes its responses.
+def synthetic_schedule_bytes(trip_count, **kwargs):
+    return json.dumps(synthetic_schedule_json(trip_count, **kwargs), separators=(",", ":")).encode()
+
+# chunked splits data up into chunks in the same way that iter_content would
+# when reading a response.
+def chunked(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+def _minutes_after_midnight(time_str):
+    hours, minutes = time_str.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def _iso(time):
+    # The MBTA API always gives times with the local UTC offset. For the
+    # purposes of tests we will just always use EDT.
+    return time.isoformat() + "-04:00"
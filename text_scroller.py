@@ -0,0 +1,64 @@
+# TextScroller scrolls a label across the display one pixel at a time without
+# ever sleeping itself, the same way TrainAnimation plays the train animation.
+#
+# matrix_portal.scroll_text scrolls the text all the way across the display
+# before it returns, so nothing else can happen until the text is gone. Instead
+# call tick(now) regularly (at the latest by next_deadline) and it moves the
+# text one pixel whenever a step is due.
+#
+# The text of the label is rendered into a bitmap once when it is created (the
+# matrix portal uses a bitmap_label) so all a step needs to do is move the
+# label. We look up the width of the text once up front so each step is just
+# setting label.x, we never touch the text or ask the label to measure itself
+# again.
+class TextScroller:
+    def __init__(self, label, display_width, stepDelay):
+        self._label = label
+        self._display_width = display_width
+        self._text_width = label.bounding_box[2]
+        self._stepDelay = stepDelay
+        self._x = display_width
+        self.next_deadline = None
+
+    # start moves the text just off the right side of the display so that it
+    # scrolls in from the right.
+    def start(self, now):
+        self._x = self._display_width
+        self._label.x = self._x
+        self.next_deadline = now + self._stepDelay
+
+    # text_visible is False while the text is completely off the display.
+    @property
+    def text_visible(self):
+        return -self._text_width <= self._x < self._display_width
+
+    # step moves the text one pixel to the left right away. Once the text has
+    # scrolled off the left side of the display it is moved back to the right
+    # side and step returns True.
+    def step(self):
+        self._x -= 1
+        wrapped = self._x < -self._text_width
+        if wrapped:
+            self._x = self._display_width
+        self._label.x = self._x
+        return wrapped
+
+    # tick takes a step if one is due. Returns True if the text just finished
+    # scrolling all the way across the display.
+    #
+    # Like TrainAnimation the next deadline is computed from the last one so
+    # that being a little late for one step doesn't slow down the scrolling,
+    # but if we are more than a whole step behind (for example after showing
+    # the train animation) we carry on from now.
+    def tick(self, now):
+        if self.next_deadline is None:
+            self.next_deadline = now
+        if now < self.next_deadline:
+            return False
+
+        wrapped = self.step()
+
+        self.next_deadline += self._stepDelay
+        if self.next_deadline <= now:
+            self.next_deadline = now + self._stepDelay
+        return wrapped
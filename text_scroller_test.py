@@ -0,0 +1,102 @@
+from text_scroller import TextScroller
+import unittest
+
+# FakeLabel stands in for the bitmap_label the matrix portal creates for the
+# title. It counts everything that would make the label redo its layout
+# (changing the text or measuring it) separately from moving it.
+class FakeLabel:
+    def __init__(self, width):
+        self._width = width
+        self._text = "Children's Museum of Franklin"
+        self.x = 0
+        self.x_sets = 0
+        self.text_sets = 0
+        self.bounding_box_reads = 0
+
+    def __setattr__(self, name, value):
+        if name == "x" and hasattr(self, "x_sets"):
+            self.__dict__["x_sets"] += 1
+        super().__setattr__(name, value)
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self.text_sets += 1
+        self._text = value
+
+    @property
+    def bounding_box(self):
+        self.bounding_box_reads += 1
+        return (0, 0, self._width, 10)
+
+class Test_TextScroller(unittest.TestCase):
+    def test_full_pass(self):
+        # A full pass takes the same number of steps as
+        # matrix_portal.scroll_text.
+        label = FakeLabel(100)
+        scroller = TextScroller(label, 64, 0.1)
+        scroller.start(0)
+        self.assertEqual(label.x, 64)
+        self.assertFalse(scroller.text_visible)
+
+        positions = []
+        now = 0
+        while True:
+            now += 0.1
+            wrapped = scroller.tick(now)
+            positions.append(label.x)
+            if wrapped:
+                break
+        self.assertEqual(len(positions), 64 + 100 + 1)
+        self.assertEqual(positions[:3], [63, 62, 61])
+        self.assertEqual(positions[-2], -100)
+        self.assertEqual(positions[-1], 64)
+
+    def test_tick_waits_for_deadline(self):
+        label = FakeLabel(10)
+        scroller = TextScroller(label, 64, 0.1)
+        scroller.start(0)
+        scroller.tick(0.05)
+        self.assertEqual(label.x, 64)
+        scroller.tick(0.1)
+        self.assertEqual(label.x, 63)
+        self.assertTrue(scroller.text_visible)
+
+    def test_resumes_after_falling_behind(self):
+        # After the train animation has been playing for a while we carry on
+        # from where we were, one step at a time.
+        label = FakeLabel(10)
+        scroller = TextScroller(label, 64, 0.1)
+        scroller.start(0)
+        scroller.tick(30)
+        self.assertEqual(label.x, 63)
+        self.assertAlmostEqual(scroller.next_deadline, 30.1)
+
+    def test_constant_cost_per_tick(self):
+        # Every step does exactly the same thing, moves the label. The label
+        # is only measured once when the scroller is created and the text is
+        # never touched.
+        for width in [10, 100, 1000]:
+            with self.subTest(width=width):
+                label = FakeLabel(width)
+                scroller = TextScroller(label, 64, 0.1)
+                scroller.start(0)
+                self.assertEqual(label.bounding_box_reads, 1)
+
+                costs = set()
+                now = 0
+                for _ in range(3 * (64 + width + 1)):
+                    now += 0.1
+                    before = label.x_sets
+                    scroller.tick(now)
+                    costs.add(label.x_sets - before)
+
+                self.assertEqual(costs, {1})
+                self.assertEqual(label.bounding_box_reads, 1)
+                self.assertEqual(label.text_sets, 0)
+
+if __name__ == '__main__':
+    unittest.main()
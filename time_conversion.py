@@ -1,39 +1,225 @@
+from collections_extra import LimitedSizeOrderedDict
+
+# Times
+# 
+# Arrival times are kept as plain integer seconds since 1970-01-01T00:00:00 in
+# local time (see parse_mbta_time), and durations are integer seconds. Doing
+# arithmetic on datetime and timedelta objects on CircuitPython allocates new
+# objects for every operation, and we do a lot of it every time through the
+# main loop. So the only place we use a datetime is at the boundary where we get
+# the current time from nowFcn, which is immediately converted with
+# seconds_from_datetime.
+
 class TimeConversionDependencies:
     def __init__(self, nowFcn):
         self.nowFcn = nowFcn
 
 
+# _TABLE_MINUTES is how many minutes ahead TimeConversion keeps the text for in
+# a table. The trains we show are almost always less than three hours away.
+_TABLE_MINUTES = 180
+
 class TimeConversion:
     def __init__(self, dependencies: TimeConversionDependencies):
         self._nowFcn = dependencies.nowFcn
 
-    # relative_time_from_now converts a datetime into a human readable time
-    # relative to the current time. For example "1h 25min".
-    def relative_time_from_now(self, train_time):
+        # Building these strings every time we render the arrival times
+        # allocates new strings every time through the main loop, so we build
+        # them all once up front. Times further out than the table are
+        # formatted when they are needed.
+        self._minutes_text = [_format_minutes(m) for m in range(_TABLE_MINUTES + 1)]
 
-        # When we look at times we need to make sure we remove any time zone
-        # information or else we get "CircuitPython does not currently implement
-        # time.gmtime" errors.
-        now = self._nowFcn()
-        time_in_seconds = (train_time-now).total_seconds()
+    # relative_time_from_now converts a time in seconds (see "Times" above)
+    # into a human readable time relative to the current time. For example "1h
+    # 25min".
+    def relative_time_from_now(self, train_time):
+        return self.relative_time_and_next_change(train_time)[0]
 
+    # relative_time_and_next_change is the same as relative_time_from_now but
+    # also returns how many seconds from now the text will change, or None if
+    # it won't change (it will keep saying "Arriving"). Since the text is only
+    # shown in minutes the caller can skip rendering it again until then.
+    def relative_time_and_next_change(self, train_time):
+        time_in_seconds = train_time - seconds_from_datetime(self._nowFcn())
         if time_in_seconds <= 60:
-            return "Arriving"
-
-        # I debated if I should use round, floor or ceil here. The MBTA best
-        # practices page https://www.mbta.com/developers/v3-api/best-practices
-        # says that for countdown display guide lines:
-        #
-        #    Round the seconds value to the nearest whole number of minutes,
-        #    rounding up if exactly in-between; call this value "minutes."
-        #
-        # So we will use round here.
-        time_in_minutes = round(time_in_seconds/60)
-        if time_in_minutes < 60:
-            return  f"{time_in_minutes}min"
-
-        time_in_hours, extra_minutes = divmod(time_in_minutes, 60.0)
-        if extra_minutes == 0:
-            return f"{int(time_in_hours)}h"
-        else:
-            return f"{int(time_in_hours)}h {int(extra_minutes)}min"
\ No newline at end of file
+            return ("Arriving", None)
+        minutes = _round_minutes(time_in_seconds)
+        return (self._text_for_minutes(minutes), _seconds_until_change(time_in_seconds, minutes))
+
+    # relative_times_from_now does the same as relative_time_and_next_change
+    # for a whole list of trains at once, using a single current time. The text
+    # for each train is written into texts (which must be the same length as
+    # trains) and trains that are None get empty_text. Returns the number of
+    # seconds until the first of the texts changes, or None.
+    #
+    # This is what we use every time we render the arrival times, so in the
+    # usual case it doesn't allocate anything: the texts come from the table
+    # and everything else is a small int.
+    def relative_times_from_now(self, trains, texts, empty_text=" ", now=None):
+        if now is None:
+            now = seconds_from_datetime(self._nowFcn())
+
+        next_change = None
+        for i in range(len(trains)):
+            train = trains[i]
+            if train is None:
+                texts[i] = empty_text
+                continue
+
+            time_in_seconds = train.time - now
+            if time_in_seconds <= 60:
+                texts[i] = "Arriving"
+                continue
+
+            minutes = _round_minutes(time_in_seconds)
+            texts[i] = self._text_for_minutes(minutes)
+            change = _seconds_until_change(time_in_seconds, minutes)
+            if next_change is None or change < next_change:
+                next_change = change
+        return next_change
+
+    def _text_for_minutes(self, minutes):
+        if minutes <= _TABLE_MINUTES:
+            return self._minutes_text[minutes]
+        return _format_minutes(minutes)
+
+# _round_minutes rounds a number of seconds to the nearest minute.
+#
+# I debated if I should use round, floor or ceil here. The MBTA best practices
+# page https://www.mbta.com/developers/v3-api/best-practices says that for
+# countdown display guide lines:
+#
+#    Round the seconds value to the nearest whole number of minutes, rounding
+#    up if exactly in-between; call this value "minutes."
+#
+# So we round, but this is the same as round(seconds/60) which rounds halves to
+# the even number. It is done with integers since dividing makes a float, which
+# allocates on the board.
+def _round_minutes(seconds):
+    minutes = seconds // 60
+    remainder = seconds - minutes * 60
+    if remainder > 30 or (remainder == 30 and minutes % 2 == 1):
+        minutes += 1
+    return minutes
+
+# _seconds_until_change returns how many seconds from now the minutes shown for
+# a train time_in_seconds away will change.
+#
+# The text stays the same as long as time_in_seconds is at least keep_until.
+# Halves are rounded to the even number (see _round_minutes) so whether we are
+# still showing minutes when we are exactly half way to the next minute down
+# depends on minutes being even. Once we are down to 60 seconds we show
+# "Arriving" instead.
+def _seconds_until_change(time_in_seconds, minutes):
+    keep_until = 60 * minutes - 30
+    if minutes % 2 == 1:
+        keep_until += 1
+    if keep_until < 61:
+        keep_until = 61
+    return time_in_seconds - keep_until + 1
+
+# _format_minutes formats a number of minutes for the display, for example
+# "1h 25min".
+def _format_minutes(minutes):
+    if minutes < 60:
+        return f"{minutes}min"
+    hours = minutes // 60
+    extra_minutes = minutes - hours * 60
+    if extra_minutes == 0:
+        return f"{hours}h"
+    return f"{hours}h {extra_minutes}min"
+
+# _DAYS_BEFORE_MONTH is the number of days in a (non leap) year before the
+# start of each month.
+_DAYS_BEFORE_MONTH = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+
+# _LEAP_DAYS_BEFORE_1970 is the number of leap days from year 0 up to 1970, see
+# _leap_days_before.
+_LEAP_DAYS_BEFORE_1970 = 1969 // 4 - 1969 // 100 + 1969 // 400
+
+def _leap_days_before(year):
+    previous = year - 1
+    return previous // 4 - previous // 100 + previous // 400
+
+def _seconds_from_fields(year, month, day, hour, minute, second):
+    days = (year - 1970) * 365 + _leap_days_before(year) - _LEAP_DAYS_BEFORE_1970 + _DAYS_BEFORE_MONTH[month - 1] + day - 1
+    if month > 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        days += 1
+    return ((days * 24 + hour) * 60 + minute) * 60 + second
+
+# seconds_from_datetime converts a time zone naive datetime into seconds, see
+# "Times" above.
+def seconds_from_datetime(time):
+    return _seconds_from_fields(time.year, time.month, time.day, time.hour, time.minute, time.second)
+
+# datetime_from_seconds converts seconds back into a time zone naive datetime.
+# The datetime class is passed in since on the board this is the
+# adafruit_datetime version of datetime. This is only needed for logging and
+# tests, nothing in the main loop should need it.
+def datetime_from_seconds(seconds, datetime):
+    days, seconds = divmod(seconds, 86400)
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+
+    # See http://howardhinnant.github.io/date_algorithms.html#civil_from_days
+    days += 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    month_index = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * month_index + 2) // 5 + 1
+    month = month_index + 3 if month_index < 10 else month_index - 9
+    year = year_of_era + era * 400 + (1 if month <= 2 else 0)
+
+    return datetime(year, month, day, hour, minute, second)
+
+# parse_mbta_time converts a timestamp from the MBTA API into integer seconds.
+# 
+# The MBTA API always gives times in exactly the same format, for example
+# "2025-10-22T05:06:00-04:00". Parsing that with datetime.fromisoformat is
+# pretty slow on CircuitPython because adafruit_datetime has to handle every
+# possible ISO 8601 format and builds a handful of objects along the way. Since
+# we know exactly where every field is we can just pull out the numbers.
+# 
+# The result is the number of seconds since 1970-01-01T00:00:00 in the local
+# time of the timestamp. In other words we ignore the UTC offset, the same as
+# when we do datetime.fromisoformat(...).replace(tzinfo=None), so the result
+# can be compared with the (local) time from the board's clock.
+# 
+# Raises a ValueError if time_str isn't in the format we expect.
+def parse_mbta_time(time_str):
+    if len(time_str) != 25 or time_str[4] != "-" or time_str[7] != "-" or time_str[10] != "T" or \
+            time_str[13] != ":" or time_str[16] != ":" or time_str[22] != ":" or time_str[19] not in "+-":
+        raise ValueError(f"unexpected MBTA time format: '{time_str}'")
+
+    year = int(time_str[0:4])
+    month = int(time_str[5:7])
+    day = int(time_str[8:10])
+    hour = int(time_str[11:13])
+    minute = int(time_str[14:16])
+    second = int(time_str[17:19])
+    if month < 1 or month > 12:
+        raise ValueError(f"unexpected MBTA time format: '{time_str}'")
+
+    return _seconds_from_fields(year, month, day, hour, minute, second)
+
+# MBTATimeParser is parse_mbta_time with a cache.
+# 
+# We see the same timestamps poll after poll (a schedule time doesn't change
+# and a prediction only changes every so often) so we keep the results for the
+# last cache_size timestamps we have parsed.
+class MBTATimeParser:
+    def __init__(self, cache_size=64):
+        self._cache = LimitedSizeOrderedDict(cache_size)
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def seconds(self, time_str):
+        if time_str in self._cache:
+            self.hit_count += 1
+            return self._cache[time_str]
+        self.miss_count += 1
+        result = parse_mbta_time(time_str)
+        self._cache[time_str] = result
+        return result
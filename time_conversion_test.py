@@ -1,7 +1,21 @@
-from time_conversion import TimeConversion, TimeConversionDependencies
-from datetime import datetime
+from time_conversion import TimeConversion, TimeConversionDependencies, parse_mbta_time, MBTATimeParser, seconds_from_datetime, datetime_from_seconds
+from train_predictor import TrainPredictor, TrainPredictorDependencies, TrainArrival, Direction
+from testing_extra import synthetic_schedule_json
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import random
+import time
 import unittest
 
+# adafruit_datetime is what we use on the board. It is pure Python so it can be
+# installed to compare against, but it isn't required to run the tests.
+try:
+    import adafruit_datetime
+except ImportError:
+    adafruit_datetime = None
+
 
 def mock_now_func(timeOfNow):
     return lambda : datetime.fromisoformat(timeOfNow).replace(tzinfo=None)
@@ -11,10 +25,15 @@ class Test_relative_time_from_now(unittest.TestCase):
         now_func = mock_now_func(now)
         deps = TimeConversionDependencies(nowFcn=now_func)
         time_conv = TimeConversion(deps)
-        train_time = datetime.fromisoformat(time_str).replace(tzinfo=None)
+        train_time = seconds_from_datetime(datetime.fromisoformat(time_str).replace(tzinfo=None))
         act_result = time_conv.relative_time_from_now(train_time)
         self.assertEqual(act_result, exp_result)
 
+        # The batch version used by the display gives the same result.
+        texts = [None, None]
+        time_conv.relative_times_from_now([TrainArrival("a", train_time, Direction.IN_BOUND, 0), None], texts)
+        self.assertEqual(texts, [exp_result, " "])
+
     def test_time_already_gone_past(self):
         self.run_test(now="2025-10-22T05:07:00", time_str="2025-10-22T05:06:00", exp_result="Arriving")
 
@@ -39,8 +58,296 @@ class Test_relative_time_from_now(unittest.TestCase):
     def test_1h_1min_10s(self):
         self.run_test(now="2025-10-22T05:06:00", time_str="2025-10-22T06:07:10", exp_result="1h 1min")
 
+class Test_relative_time_and_next_change(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.fromisoformat('2025-10-22T05:06:00')
+        self.time_conv = TimeConversion(TimeConversionDependencies(nowFcn=lambda: self.now))
+        self.now_seconds = seconds_from_datetime(self.now)
+
+    def text_in(self, train_time, seconds):
+        self.now = datetime.fromisoformat('2025-10-22T05:06:00') + timedelta(seconds=seconds)
+        return self.time_conv.relative_time_from_now(train_time)
+
+    def test_examples(self):
+        self.assertEqual(self.time_conv.relative_time_and_next_change(self.now_seconds + 30), ("Arriving", None))
+        self.assertEqual(self.time_conv.relative_time_and_next_change(self.now_seconds + 70), ("1min", 10))
+        self.assertEqual(self.time_conv.relative_time_and_next_change(self.now_seconds + 150), ("2min", 61))
+        self.assertEqual(self.time_conv.relative_time_and_next_change(self.now_seconds + 3630), ("1h", 61))
+
+    def test_next_change_is_exact(self):
+        # The text stays the same right up until the next change and is
+        # different right at the next change.
+        for offset in range(-60, 3 * 3600, 7):
+            train_time = self.now_seconds + offset
+            self.now = datetime.fromisoformat('2025-10-22T05:06:00')
+            text, next_change = self.time_conv.relative_time_and_next_change(train_time)
+            if next_change is None:
+                self.assertEqual(self.text_in(train_time, 600), text)
+                continue
+            self.assertEqual(self.text_in(train_time, next_change - 1), text, offset)
+            self.assertNotEqual(self.text_in(train_time, next_change), text, offset)
+
+    def test_simulate_hour(self):
+        # Simulate the main loop for an hour, checking every second. Without the
+        # next change we would render the arrival times every time through the
+        # loop, so at least once a second. With it we only render when one of
+        # the times changes, and what is shown is never out of date.
+        trains = [self.now_seconds + 5 * 60 + 13, self.now_seconds + 47 * 60, self.now_seconds + 2 * 3600 + 25]
+        shown = None
+        next_render = 0
+        render_count = 0
+        for second in range(3600):
+            self.now = datetime.fromisoformat('2025-10-22T05:06:00') + timedelta(seconds=second)
+            if next_render is not None and second >= next_render:
+                render_count += 1
+                results = [self.time_conv.relative_time_and_next_change(t) for t in trains]
+                shown = [text for text, _ in results]
+                changes = [change for _, change in results if change is not None]
+                next_render = second + min(changes) if changes else None
+            self.assertEqual(shown, [self.time_conv.relative_time_from_now(t) for t in trains], second)
+
+        # Each train ticks over once a minute until it is arriving.
+        self.assertLessEqual(render_count, 1 + 5 + 47 + 60)
+        self.assertLess(render_count, 3600 / 30)
+
+# reference_relative_time is how relative_time_from_now used to format times,
+# before it used a table.
+def reference_relative_time(time_in_seconds):
+    if time_in_seconds <= 60:
+        return "Arriving"
+    time_in_minutes = round(time_in_seconds/60)
+    if time_in_minutes < 60:
+        return  f"{time_in_minutes}min"
+    time_in_hours, extra_minutes = divmod(time_in_minutes, 60.0)
+    if extra_minutes == 0:
+        return f"{int(time_in_hours)}h"
+    else:
+        return f"{int(time_in_hours)}h {int(extra_minutes)}min"
+
+class Test_relative_times_from_now(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime.fromisoformat('2025-10-22T05:06:00')
+        self.now_seconds = seconds_from_datetime(self.now)
+        self.time_conv = TimeConversion(TimeConversionDependencies(nowFcn=lambda: self.now))
+
+    def test_matches_reference(self):
+        # Check every second out to past the end of the table.
+        for offset in range(-120, 5 * 3600):
+            train = TrainArrival("a", self.now_seconds + offset, Direction.IN_BOUND, 0)
+            texts = [None]
+            next_change = self.time_conv.relative_times_from_now([train], texts)
+            self.assertEqual(texts[0], reference_relative_time(offset), offset)
+            self.assertEqual((texts[0], next_change), self.time_conv.relative_time_and_next_change(train.time), offset)
+
+    def test_earliest_change(self):
+        trains = [
+            TrainArrival("a", self.now_seconds + 30, Direction.IN_BOUND, 0),
+            TrainArrival("b", self.now_seconds + 150, Direction.IN_BOUND, 0),
+            None,
+        ]
+        texts = [None, None, None]
+        next_change = self.time_conv.relative_times_from_now(trains, texts, empty_text="")
+        self.assertEqual(texts, ["Arriving", "2min", ""])
+        self.assertEqual(next_change, 61)
+
+    def test_single_now(self):
+        calls = []
+        def now_fcn():
+            calls.append(1)
+            return self.now
+        time_conv = TimeConversion(TimeConversionDependencies(nowFcn=now_fcn))
+        trains = [TrainArrival(str(i), self.now_seconds + 600 * i, Direction.IN_BOUND, 0) for i in range(3)]
+        time_conv.relative_times_from_now(trains, [None, None, None])
+        self.assertEqual(len(calls), 1)
+        time_conv.relative_times_from_now(trains, [None, None, None], now=self.now_seconds)
+        self.assertEqual(len(calls), 1)
+
+    def test_table_strings_are_reused(self):
+        # In the usual case we hand back the same string objects from the table
+        # every time rather than building new ones.
+        trains = [TrainArrival("a", self.now_seconds + 25 * 60, Direction.IN_BOUND, 0)]
+        first = [None]
+        second = [None]
+        self.time_conv.relative_times_from_now(trains, first)
+        self.time_conv.relative_times_from_now(trains, second)
+        self.assertIs(first[0], second[0])
+
+class Test_relative_time_benchmark(unittest.TestCase):
+    def time(self, fcn, repeat=2000):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fcn()
+        return time.perf_counter() - start
+
+    def test_batch_vs_separate(self):
+        now = datetime.fromisoformat('2025-10-22T05:06:00')
+        now_seconds = seconds_from_datetime(now)
+        time_conv = TimeConversion(TimeConversionDependencies(nowFcn=lambda: now))
+        trains = [TrainArrival(str(i), now_seconds + 17 * 60 + 3000 * i, Direction.IN_BOUND, 0) for i in range(3)]
+        texts = [None, None, None]
+
+        separate_seconds = min(self.time(lambda: [time_conv.relative_time_from_now(t.time) for t in trains]) for _ in range(3))
+        batch_seconds = min(self.time(lambda: time_conv.relative_times_from_now(trains, texts)) for _ in range(3))
+        self.assertLess(batch_seconds, separate_seconds)
+
+def fixture_times():
+    # Every arrival and departure time in the test fixtures.
+    times = []
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata', 'schedules')
+    for file in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, file), 'r') as f:
+            data = json.load(f)
+        for item in data.get("data", []) + data.get("included", []):
+            for key in ["arrival_time", "departure_time"]:
+                value = item.get("attributes", {}).get(key)
+                if value is not None:
+                    times.append(value)
+    return times
+
+def expected_seconds(time_str):
+    time = datetime.fromisoformat(time_str).replace(tzinfo=None)
+    return int((time - datetime(1970, 1, 1)).total_seconds())
+
+class Test_parse_mbta_time(unittest.TestCase):
+    def test_fixtures(self):
+        times = fixture_times()
+        self.assertGreater(len(times), 10)
+        for time_str in times:
+            with self.subTest(time_str=time_str):
+                self.assertEqual(parse_mbta_time(time_str), expected_seconds(time_str))
+
+    def test_edge_cases(self):
+        for time_str in [
+            "1970-01-01T00:00:00+00:00",
+            "2024-02-29T12:00:00-05:00",
+            "2024-03-01T00:00:00-05:00",
+            "2025-02-28T23:59:59-05:00",
+            "2025-03-01T00:00:00-05:00",
+            "2025-12-31T23:59:59-05:00",
+            "2026-01-01T00:00:00-05:00",
+            "2000-02-29T01:02:03-05:00",
+            "2100-03-01T00:00:00-05:00",
+        ]:
+            with self.subTest(time_str=time_str):
+                self.assertEqual(parse_mbta_time(time_str), expected_seconds(time_str))
+
+    def test_offset_is_ignored(self):
+        # Like datetime.fromisoformat(...).replace(tzinfo=None) we only care
+        # about the local time.
+        self.assertEqual(parse_mbta_time("2025-11-02T01:30:00-04:00") - parse_mbta_time("2025-11-02T01:30:00-05:00"), 0)
+
+    def test_bad_format(self):
+        for time_str in ["", "2025-10-22", "2025-10-22T05:06:00", "2025-10-22 05:06:00-04:00", "2025-13-22T05:06:00-04:00", "2025-10-22T05:06:00Z"]:
+            with self.subTest(time_str=time_str):
+                with self.assertRaises(ValueError):
+                    parse_mbta_time(time_str)
+
+class Test_MBTATimeParser(unittest.TestCase):
+    def test_cache(self):
+        parser = MBTATimeParser(cache_size=2)
+        self.assertEqual(parser.seconds("2025-10-22T05:06:00-04:00"), expected_seconds("2025-10-22T05:06:00-04:00"))
+        self.assertEqual(parser.seconds("2025-10-22T05:06:00-04:00"), expected_seconds("2025-10-22T05:06:00-04:00"))
+        self.assertEqual((parser.hit_count, parser.miss_count), (1, 1))
+
+        # The cache is bounded, the oldest timestamp is dropped first.
+        parser.seconds("2025-10-22T06:06:00-04:00")
+        parser.seconds("2025-10-22T07:06:00-04:00")
+        self.assertEqual(len(parser._cache), 2)
+        parser.seconds("2025-10-22T05:06:00-04:00")
+        self.assertEqual((parser.hit_count, parser.miss_count), (1, 4))
+
+    def test_polling_a_day(self):
+        # Polling the same day over and over should almost always hit the
+        # cache.
+        day = synthetic_schedule_json(40, service_date="2025-10-22")
+        times = [item["attributes"]["arrival_time"] for item in day["data"] + day["included"]]
+        parser = MBTATimeParser(cache_size=64)
+        for _ in range(10):
+            for time_str in times:
+                parser.seconds(time_str)
+        self.assertEqual(parser.miss_count, len(set(times)))
+        self.assertEqual(parser.hit_count, 10 * len(times) - len(set(times)))
+
+class Test_parse_benchmark(unittest.TestCase):
+    # These micro-benchmarks parse every timestamp in the fixtures many times
+    # over, like we do when polling the MBTA API.
+    def time(self, fcn, times, repeat=200):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for time_str in times:
+                fcn(time_str)
+        return time.perf_counter() - start
+
+    def test_cached_vs_fromisoformat(self):
+        times = fixture_times()
+        parser = MBTATimeParser(cache_size=64)
+        fromisoformat_seconds = min(self.time(lambda t: datetime.fromisoformat(t).replace(tzinfo=None), times) for _ in range(3))
+        cached_seconds = min(self.time(parser.seconds, times) for _ in range(3))
+        self.assertLess(cached_seconds, fromisoformat_seconds)
+
+    @unittest.skipIf(adafruit_datetime is None, "adafruit_datetime is not installed")
+    def test_uncached_vs_adafruit_datetime(self):
+        # CPython's datetime.fromisoformat is implemented in C so it is faster
+        # than parse_mbta_time, but on the board we use adafruit_datetime which
+        # is pure Python.
+        times = fixture_times()
+        fromisoformat_seconds = min(self.time(lambda t: adafruit_datetime.datetime.fromisoformat(t).replace(tzinfo=None), times, repeat=20) for _ in range(3))
+        parse_seconds = min(self.time(parse_mbta_time, times, repeat=20) for _ in range(3))
+        self.assertLess(parse_seconds, fromisoformat_seconds / 3)
+
+class Test_seconds_from_datetime(unittest.TestCase):
+    def test_epoch(self):
+        self.assertEqual(seconds_from_datetime(datetime(1970, 1, 1)), 0)
+        self.assertEqual(datetime_from_seconds(0, datetime), datetime(1970, 1, 1))
+
+    def test_matches_timedelta(self):
+        for time in [datetime(2025, 10, 22, 5, 6, 7), datetime(2024, 2, 29, 23, 59, 59), datetime(2000, 3, 1), datetime(2100, 12, 31, 12)]:
+            with self.subTest(time=time):
+                self.assertEqual(seconds_from_datetime(time), int((time - datetime(1970, 1, 1)).total_seconds()))
+
+    def test_round_trip(self):
+        rng = random.Random(1234)
+        start = seconds_from_datetime(datetime(1990, 1, 1))
+        end = seconds_from_datetime(datetime(2100, 1, 1))
+        for _ in range(2000):
+            seconds = rng.randrange(start, end)
+            time = datetime_from_seconds(seconds, datetime)
+            self.assertEqual(time, datetime(1970, 1, 1) + timedelta(seconds=seconds))
+            self.assertEqual(seconds_from_datetime(time), seconds)
+
+# CountingDatetime counts every bit of arithmetic done on it. On CircuitPython
+# each of these allocates a new datetime or timedelta object.
+class CountingDatetime(datetime):
+    operation_count = 0
+
+    def __add__(self, other):
+        CountingDatetime.operation_count += 1
+        return super().__add__(other)
+
+    def __sub__(self, other):
+        CountingDatetime.operation_count += 1
+        return super().__sub__(other)
 
+class Test_main_loop_datetime_arithmetic(unittest.TestCase):
+    # Every time through the main loop the application checks if it needs to
+    # show a warning for the next train and the display updates the relative
+    # time for each of the next 3 trains. None of that should need any datetime
+    # arithmetic now that times are seconds, the only datetime is the one we
+    # get from nowFcn.
+    def setUp(self):
+        CountingDatetime.operation_count = 0
+        self.now = CountingDatetime(2025, 10, 22, 12, 0, 0)
+        self.now_fcn = lambda: self.now
+        deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=self.now_fcn, mbta_api_key=None, logger=logging.getLogger("mock"))
+        self.predictor = TrainPredictor(deps, trainWarningSeconds=60)
+        self.time_conversion = TimeConversion(TimeConversionDependencies(nowFcn=self.now_fcn))
+        self.train_times = [datetime(2025, 10, 22, 12, 0, 10) + timedelta(minutes=minutes) for minutes in [12, 47, 95]]
 
+    def test_seconds(self):
+        trains = [TrainArrival("schedule", seconds_from_datetime(t), Direction.IN_BOUND, 10) for t in self.train_times]
+        self.assertIsNone(self.predictor.train_passing_warning(trains[0]))
+        self.assertEqual([self.time_conversion.relative_time_from_now(t.time) for t in trains], ["12min", "47min", "1h 35min"])
+        self.assertEqual(CountingDatetime.operation_count, 0)
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,58 @@
+# TrainAnimation keeps track of which frame of the train animation should be
+# showing, without ever sleeping itself.
+#
+# start(now) shows the first frame and tick(now) shows the next frame once its
+# deadline has passed. tick returns False once the last frame has been shown
+# for its full frame_duration, meaning the animation is done. The caller decides
+# how to wait between ticks, next_deadline is when the next frame is due.
+#
+# Frame deadlines are computed from the previous deadline rather than from when
+# tick happened to be called, so if we are a little late showing one frame we
+# make up for it on the next one rather than the animation slowly drifting
+# longer and longer. If we ever fall more than a whole frame behind (for
+# example if we were stuck waiting on a network request) we don't try to catch
+# up by flashing through frames, we just carry on from now.
+#
+# showFrameFcn is called with the frame number to show, see
+# Display.render_train_frame.
+class TrainAnimation:
+    def __init__(self, frame_count, frame_duration, showFrameFcn):
+        self._frame_count = frame_count
+        self._frame_duration = frame_duration
+        self._showFrameFcn = showFrameFcn
+        self._frame = None
+        self.next_deadline = None
+
+    @property
+    def running(self):
+        return self._frame is not None
+
+    @property
+    def frame(self):
+        return self._frame
+
+    def start(self, now):
+        self._frame = 0
+        self._showFrameFcn(0)
+        self.next_deadline = now + self._frame_duration
+
+    def stop(self):
+        self._frame = None
+        self.next_deadline = None
+
+    def tick(self, now):
+        if self._frame is None:
+            return False
+        if now < self.next_deadline:
+            return True
+
+        self._frame += 1
+        if self._frame >= self._frame_count:
+            self.stop()
+            return False
+        self._showFrameFcn(self._frame)
+
+        self.next_deadline += self._frame_duration
+        if self.next_deadline <= now:
+            self.next_deadline = now + self._frame_duration
+        return True
@@ -0,0 +1,98 @@
+from train_animation import TrainAnimation
+import random
+import unittest
+
+# FakeClock is a monotonic clock that only moves when we sleep. Every sleep
+# oversleeps by a random amount of up to maxOversleep seconds, like
+# time.sleep does on the board.
+class FakeClock:
+    def __init__(self, maxOversleep=0.005, seed=0):
+        self.now = 0.0
+        self._maxOversleep = maxOversleep
+        self._random = random.Random(seed)
+
+    def sleep(self, seconds):
+        self.now += max(0, seconds) + self._random.uniform(0, self._maxOversleep)
+
+class Test_TrainAnimation(unittest.TestCase):
+    def test_plays_every_frame_once(self):
+        shown = []
+        animation = TrainAnimation(3, 1, shown.append)
+        self.assertFalse(animation.running)
+
+        animation.start(10)
+        self.assertEqual(shown, [0])
+        self.assertEqual(animation.next_deadline, 11)
+
+        # Nothing happens before the deadline.
+        self.assertTrue(animation.tick(10.5))
+        self.assertEqual(shown, [0])
+
+        self.assertTrue(animation.tick(11))
+        self.assertTrue(animation.tick(12))
+        self.assertEqual(shown, [0, 1, 2])
+
+        # The last frame is shown for a full frame before we are done.
+        self.assertFalse(animation.tick(13))
+        self.assertEqual(shown, [0, 1, 2])
+        self.assertFalse(animation.running)
+        self.assertIsNone(animation.next_deadline)
+
+    def test_late_tick_is_made_up(self):
+        animation = TrainAnimation(10, 1, lambda frame: None)
+        animation.start(0)
+        animation.tick(1.25)
+        self.assertEqual(animation.next_deadline, 2)
+
+    def test_very_late_tick_does_not_skip_frames(self):
+        # If we fall more than a whole frame behind we carry on from now
+        # rather than rushing through frames to catch up.
+        shown = []
+        animation = TrainAnimation(10, 1, shown.append)
+        animation.start(0)
+        animation.tick(5)
+        self.assertEqual(shown, [0, 1])
+        self.assertEqual(animation.next_deadline, 6)
+        self.assertTrue(animation.tick(5.5))
+        self.assertEqual(shown, [0, 1])
+
+class Test_frame_timing(unittest.TestCase):
+    FRAME_COUNT = 1000
+    FRAME_DURATION = 0.05
+    MAX_OVERSLEEP = 0.005
+
+    # frame_errors returns how far from its ideal time each frame was shown,
+    # frame i should be shown at start + i * FRAME_DURATION.
+    def frame_errors(self, times):
+        return [abs(t - (times[0] + i * self.FRAME_DURATION)) for i, t in enumerate(times)]
+
+    def test_deadline_timing(self):
+        clock = FakeClock(self.MAX_OVERSLEEP)
+        times = []
+        animation = TrainAnimation(self.FRAME_COUNT, self.FRAME_DURATION, lambda frame: times.append(clock.now))
+
+        animation.start(clock.now)
+        while animation.running:
+            clock.sleep(animation.next_deadline - clock.now)
+            animation.tick(clock.now)
+
+        self.assertEqual(len(times), self.FRAME_COUNT)
+        errors = self.frame_errors(times)
+        # Each frame is at most one oversleep late, the error doesn't add up.
+        self.assertLessEqual(max(errors), self.MAX_OVERSLEEP)
+        self.assertLessEqual(max(errors[-100:]), self.MAX_OVERSLEEP)
+
+    def test_sleep_timing_drifts(self):
+        # This is how Display.render_train used to work, sleeping for a whole
+        # frame between frames. Every oversleep adds up.
+        clock = FakeClock(self.MAX_OVERSLEEP)
+        times = []
+        for _ in range(self.FRAME_COUNT):
+            times.append(clock.now)
+            clock.sleep(self.FRAME_DURATION)
+
+        errors = self.frame_errors(times)
+        self.assertGreater(errors[-1], 100 * self.MAX_OVERSLEEP)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,15 @@
 import gc
 import time
-from collections_extra import LimitedSizeOrderedSet, LimitedSizeOrderedDict
+from collections_extra import HashedLimitedSizeOrderedSet, ExpiringLimitedSizeOrderedDict
+from schedule_reader import JsonScheduleReader
+from prediction_stream import PredictionTable
+from time_conversion import MBTATimeParser, seconds_from_datetime
+from warning_timeline import WarningTimeline, TimelineEvent
+from loop_profiler import NULL_PROFILER
+
+# _LOG_DEBUG is the debug log level, it is the same for adafruit_logging and
+# the logging module in the standard library.
+_LOG_DEBUG = 10
 
 # DATA_SOURCE is the URL for the MBTA API that we query to get data about
 # trains.
@@ -23,17 +32,12 @@ from collections_extra import LimitedSizeOrderedSet, LimitedSizeOrderedDict
 # that we need to process. See
 # https://www.mbta.com/developers/v3-api/best-practices#sparse-fieldsets
 # 
-# One main disadvantage to this approach is the
-# https://api-v3.mbta.com/schedules API will by default give us the schedule for
-# ALL trains for today, even ones that have passed by. There are some "filter"
-# options to filter by date and by time but it seems that this needs to be
-# specified as an absolute date / time which means we would need to deal with
-# updating the URL with the current date/time every time we make a request.
-# There is also some tricky logic with how the consider times due to the
-# "service date" of trains ( see
-# https://api-v3.mbta.com/docs/swagger/index.html#/Schedule/ApiWeb_ScheduleController_index
-# ). So for now we will just request ALL the trains for today and filter them
-# when we get the data back. 
+# By default the https://api-v3.mbta.com/schedules API will give us the
+# schedule for ALL trains for today, even ones that have passed by. So rather
+# than using DATA_SOURCE as is TrainPredictor adds "filter[date]",
+# "filter[min_time]", "filter[max_time]" and "page[limit]" query parameters
+# every time it makes a request so late in the day we only download the handful
+# of trains that are left. See TrainPredictor._data_source_url for details.
 DATA_SOURCE="https://api-v3.mbta.com/schedules?" \
   "filter[stop]=place-FB-0275&" \
   "filter[route]=CR-Franklin&" \
@@ -42,6 +46,40 @@ DATA_SOURCE="https://api-v3.mbta.com/schedules?" \
   "fields[schedule]=arrival_time,departure_time,direction_id&" \
   "fields[prediction]=arrival_time,departure_time,direction_id" 
 
+# SCHEDULES_SOURCE is the URL for the MBTA API that we query for just the
+# schedules (without predictions) at the Franklin station. Schedules change at
+# most once a day so TrainPredictor only fetches this once per service day and
+# gets predictions separately, see PREDICTIONS_SOURCE and PredictionStream.
+# 
+# Unlike DATA_SOURCE we don't use a sparse fieldset here because we need the
+# trip relationship of each schedule to join it up with a prediction. We don't
+# fetch this very often and StreamingScheduleReader throws away everything we
+# don't need so the extra data isn't a big deal.
+SCHEDULES_SOURCE="https://api-v3.mbta.com/schedules?" \
+  "filter[stop]=place-FB-0275&" \
+  "filter[route]=CR-Franklin&" \
+  "sort=arrival_time"
+
+# PREDICTIONS_SOURCE is the URL for the MBTA API that we poll for predictions
+# at the Franklin station. The MBTA API only has predictions for trains that are
+# coming up soon so this response is much smaller than DATA_SOURCE.
+# 
+# The sparse fieldset needs to list the trip relationship as well as the
+# attributes, otherwise the MBTA API leaves it out and we have no way to join
+# the prediction up with a schedule.
+PREDICTIONS_SOURCE="https://api-v3.mbta.com/predictions?" \
+  "filter[stop]=place-FB-0275&" \
+  "filter[route]=CR-Franklin&" \
+  "fields[prediction]=arrival_time,departure_time,direction_id,trip"
+
+# SERVICE_DAY_START_HOUR is the hour that the MBTA "service day" starts. Trips
+# that run between midnight and this hour are considered part of the previous
+# day's service. For these trips the MBTA API represents times as hours past
+# midnight of the service date, for example 12:30am is "24:30". See the
+# filter[date] and filter[min_time] documentation in
+# https://api-v3.mbta.com/docs/swagger/index.html#/Schedule/ApiWeb_ScheduleController_index
+SERVICE_DAY_START_HOUR = 3
+
 # Direction Enum
 # 
 # WARNING: this enum is specific to the Franklin MBTA station. From
@@ -75,8 +113,16 @@ def direction_str(direction):
 # unique for a given day. It IS reused from dat to day. See
 # TrainPredictor.clear_cache for details.
 # 
-# std_dev is the standard deviation of arrival times in this direction.
+# time is the arrival time in seconds (see "Times" in time_conversion.py) and
+# std_dev is the standard deviation of arrival times in this direction in
+# seconds.
+# 
+# We use __slots__ so each TrainArrival doesn't need its own __dict__. That
+# said, TrainPredictor only creates TrainArrival objects for the trains it
+# returns, see _analyze_items.
 class TrainArrival:
+    __slots__ = ("schedule_id", "time", "direction", "std_dev")
+
     def __init__(self, schedule_id, time, direction, std_dev):
         self.schedule_id = schedule_id
         self.time = time
@@ -105,23 +151,37 @@ class TrainWarning:
     def should_stop(self) -> bool:
         return time.monotonic() > self._end_monotonic
 
+# schedule_reader is used to read the response from the MBTA API into a list
+# of ScheduleItem. If it isn't provided then a JsonScheduleReader is used. See
+# schedule_reader.py for details.
+# 
+# prediction_stream is an optional PredictionStream, see
+# TrainPredictor.next_trains.
+#
+# profiler is an optional LoopProfiler used to time parsing the responses from
+# the MBTA API ("parse"), computing the trains ("analyze") and collecting
+# garbage ("gc"), see loop_profiler.py.
 class TrainPredictorDependencies:
-    def __init__(self, network, datetime, timedelta, nowFcn, mbta_api_key, logger):
+    def __init__(self, network, datetime, timedelta, nowFcn, mbta_api_key, logger, schedule_reader=None, prediction_stream=None, profiler=None):
         self.network = network 
         self.datetime = datetime 
         self.timedelta = timedelta
         self.nowFcn = nowFcn
         self.mbta_api_key = mbta_api_key
         self.logger = logger
+        self.schedule_reader = schedule_reader
+        self.prediction_stream = prediction_stream
+        self.profiler = profiler
 
 # TrainPredictor is a class for predicting when trains will pass by the
 # Children's Museum of Franklin.
 # 
 # In general the way this works is we query the MBTA API for a schedule of train
-# arrivals at the Franklin MBTA station and also ask it for any more detailed
-# predicted arrival times that it might also have. See DATA_SOURCE . Then apply
-# some offsets to account for the fact that the Children's Museum of Franklin is
-# a minute or so away from the Franklin MBTA station.
+# arrivals at the Franklin MBTA station once a day and then regularly poll for
+# any more detailed predicted arrival times that it might also have. See
+# SCHEDULES_SOURCE and PREDICTIONS_SOURCE . Then apply some offsets to account
+# for the fact that the Children's Museum of Franklin is a minute or so away
+# from the Franklin MBTA station.
 # 
 # It is worth mentioning that the MBTA API best practices page has some nice
 # guidance on how to setup an arrival time board like this:
@@ -142,32 +202,95 @@ class TrainPredictorDependencies:
 # our existing query for schedules by asking it to include "prediction.vehicles"
 # like this:
 # https://api-v3.mbta.com/schedules?filter%5Bstop%5D=place-FB-0275&filter%5Broute%5D=CR-Franklin&sort=arrival_time&include=prediction.vehicles
+# 
+# schedulesSource and predictionsSource are the MBTA API URLs for the daily
+# schedule and the predictions we poll, see next_trains. If predictionsSource
+# is None then we instead poll dataSource for schedules and predictions
+# together. queryLookbackSeconds, queryWindowSeconds and queryPageLimit control
+# which trains we look at, see _data_source_url.
+# 
+# maxPredictionSkewSeconds is how much earlier than its schedule we expect a
+# train could ever be predicted to arrive, see _analyze_items. None means we
+# always compute every train.
+# 
+# predictionCacheSize and predictionCacheExpirySeconds control the cache of
+# predicted arrival times, see _compute_train_time.
 class TrainPredictor:
-    def __init__(self, dependencies: TrainPredictorDependencies, filterResultsAfterSeconds = 30, trainWarningSeconds = 0, inboundOffsetAverageSeconds=0, inboundOffsetStdDevSeconds=0, outboundOffsetAverageSeconds=0, outboundOffsetStdDevSeconds=0):
+    def __init__(self, dependencies: TrainPredictorDependencies, filterResultsAfterSeconds = 30, trainWarningSeconds = 0, inboundOffsetAverageSeconds=0, inboundOffsetStdDevSeconds=0, outboundOffsetAverageSeconds=0, outboundOffsetStdDevSeconds=0, dataSource=DATA_SOURCE, queryLookbackSeconds=3600, queryWindowSeconds=None, queryPageLimit=20, schedulesSource=SCHEDULES_SOURCE, predictionsSource=PREDICTIONS_SOURCE, maxPredictionSkewSeconds=600, predictionCacheExpirySeconds=600, predictionCacheSize=20):
         self._network = dependencies.network
         self._datetime = dependencies.datetime
         self._timedelta = dependencies.timedelta
         self._nowFcn = dependencies.nowFcn
         self._logger = dependencies.logger
 
-        self._filterResultsAfterSeconds = filterResultsAfterSeconds
-        self._trainWarningOffset = self._timedelta(seconds=trainWarningSeconds)
+        self._schedule_reader = dependencies.schedule_reader
+        if self._schedule_reader is None:
+            self._schedule_reader = JsonScheduleReader()
 
-        self._inboundOffsetAverage = self._timedelta(seconds = inboundOffsetAverageSeconds)
-        self._inboundOffsetStdDev = self._timedelta(seconds = inboundOffsetStdDevSeconds)
-        self._outboundOffsetAverage = self._timedelta(seconds = outboundOffsetAverageSeconds)
-        self._outboundOffsetStdDev = self._timedelta(seconds = outboundOffsetStdDevSeconds)
+        self._profiler = dependencies.profiler
+        if self._profiler is None:
+            self._profiler = NULL_PROFILER
+
+        self._filterResultsAfterSeconds = filterResultsAfterSeconds
+        self._trainWarningSeconds = trainWarningSeconds
+
+        self._dataSource = dataSource
+        self._queryLookbackSeconds = queryLookbackSeconds
+        self._queryWindowSeconds = queryWindowSeconds
+        self._queryPageLimit = queryPageLimit
+
+        self._prediction_stream = dependencies.prediction_stream
+        self._schedulesSource = schedulesSource
+        self._predictionsSource = predictionsSource
+
+        # The schedule for the current service day, see refresh_schedule.
+        # _daily_schedule_start is the index of the first schedule that we
+        # haven't skipped over yet, see _daily_schedule_items.
+        self._daily_schedule = None
+        self._daily_schedule_date = None
+        self._daily_schedule_start = 0
+        self._polled_predictions = PredictionTable()
+
+        self._inboundOffsetAverageSeconds = inboundOffsetAverageSeconds
+        self._inboundOffsetStdDevSeconds = inboundOffsetStdDevSeconds
+        self._outboundOffsetAverageSeconds = outboundOffsetAverageSeconds
+        self._outboundOffsetStdDevSeconds = outboundOffsetStdDevSeconds
+        self._minOffsetAverageSeconds = min(inboundOffsetAverageSeconds, outboundOffsetAverageSeconds)
+        self._maxPredictionSkewSeconds = maxPredictionSkewSeconds
+
+        # Times from the MBTA API are parsed with _time_parser into seconds,
+        # see MBTATimeParser.
+        self._time_parser = MBTATimeParser()
     
-        self._arrived_trains = LimitedSizeOrderedSet(100)
+        self._arrived_trains = HashedLimitedSizeOrderedSet(100)
+
+        # _log_debug is checked before each of the debug log messages in
+        # _compute_train_time, which runs for every schedule on every poll, so
+        # that we don't even make the logging calls unless something is logging
+        # at the debug level. It is updated at the start of _analyze_items.
+        self._log_debug = self._logger.isEnabledFor(_LOG_DEBUG)
 
         # Needed to make sure we don't get arrival time messed up when prediction goes away
-        self._train_prediction_cache = LimitedSizeOrderedDict(10)
+        self._predictionCacheExpirySeconds = predictionCacheExpirySeconds
+        self._train_prediction_cache = ExpiringLimitedSizeOrderedDict(predictionCacheSize, self._now_seconds)
 
         self._mbta_api_headers = {
             "accept":  "application/vnd.api+json"
         }
         if dependencies.mbta_api_key is not None:
             self._mbta_api_headers["x-api-key"] = dependencies.mbta_api_key
+
+        # State for making conditional requests to the MBTA API, see
+        # _fetch_schedules_and_predictions.
+        self._cached_url = None
+        self._cached_schedule_items = None
+        self._conditional_headers = None
+
+        # Counts of full (200) and not modified (304) responses from the MBTA
+        # API. These are only used for monitoring how well conditional
+        # requests are working.
+        self.full_response_count = 0
+        self.not_modified_response_count = 0
         
         # The MBTA API responds with a content type header of
         # "application/vnd.api+json". When the matrix portal looks at the
@@ -186,12 +309,57 @@ class TrainPredictor:
     # next_trains will always return a list of length count. If it can not
     # determine when that many trains will pass by then the elements in the list
     # will be None.
+    # 
+    # Schedules for the Franklin line change at most once a day so we keep the
+    # schedule for the whole service day (see refresh_schedule) and join it up
+    # with predictions by trip. If we have a prediction stream that is
+    # connected and up to date then next_trains doesn't need to make a request
+    # to the MBTA API at all, it just uses the latest predictions from the
+    # stream. Otherwise we poll the much smaller predictions endpoint.
     def next_trains(self, count):
-        schedule_json = self._fetch_schedules_and_predictions()
-        results =  self._analyze_data(count, schedule_json)
-        gc.collect()
+        prediction_table = None
+        if self._prediction_stream is not None and self._prediction_stream.poll():
+            schedule_items = self._daily_schedule_items()
+            prediction_table = self._prediction_stream.table
+        elif self._predictionsSource is not None:
+            schedule_items = self._daily_schedule_items()
+            self._polled_predictions.load(self._fetch_items(self._predictionsSource))
+            prediction_table = self._polled_predictions
+        else:
+            schedule_items = self._fetch_schedules_and_predictions()
+
+        with self._profiler.phase("analyze"):
+            results = self._analyze_items(count, schedule_items, prediction_table)
+        with self._profiler.phase("gc"):
+            gc.collect()
         return results
 
+    # refresh_schedule fetches the schedule for the current MBTA service day.
+    # This is called at startup and as part of the application's nightly tasks,
+    # but next_trains will also call it if the service day has changed since
+    # the schedule was fetched.
+    def refresh_schedule(self):
+        service_date = self._service_date_str()
+        self._logger.debug("fetching schedule for %s", service_date)
+
+        # Drop the old schedule before reading the new one so we don't have
+        # both in memory at the same time.
+        self._daily_schedule = None
+        self._daily_schedule_date = None
+        self._daily_schedule_start = 0
+
+        url = f"{self._schedulesSource}&filter[date]={service_date}"
+        response = self._network.fetch(url, headers=self._mbta_api_headers, timeout=10)
+        if response.status_code is not 200:
+            raise RuntimeError(f"Failed to fetch data from MBTA API. status_code: {response.status_code} response: {response.text}")
+
+        # The schedule readers only keep the schedule id, trip id and
+        # SCHEDULE_ATTRIBUTES of each schedule, so this is small even for a
+        # full day of trains.
+        with self._profiler.phase("parse"):
+            self._daily_schedule = self._schedule_reader.read(response)
+        self._daily_schedule_date = service_date
+
     def train_passing_warning(self, train: TrainArrival):
         if train is None:
             return None
@@ -200,7 +368,7 @@ class TrainPredictor:
         # train.
         # 
         # We know that we want to start showing the warning at least
-        # _trainWarningOffset before the train passes by. We also know that
+        # _trainWarningSeconds before the train passes by. We also know that
         # there is some variability in when trains pass by. I did some data
         # analysis using the MBTA APIs determined a standard deviation of
         # arrival time. See
@@ -212,22 +380,45 @@ class TrainPredictor:
         # We want to stop the animation once we know for sure the train has
         # passed by. So the end time of the warning is the arrival time of the
         # train plus three standard deviations.
-        now = self._nowFcn()
-        warning_start_time = train.time - self._trainWarningOffset -  (2 * train.std_dev)
+        now = seconds_from_datetime(self._nowFcn())
+        warning_start_time = self.warning_start_time(train)
         if warning_start_time > now:
             return None
         warning_stop_time = train.time + (3 * train.std_dev)
-        remaining_seconds = (warning_stop_time - now).total_seconds()
+        remaining_seconds = warning_stop_time - now
         now_monatomic = time.monotonic()
         end_monatomic = now_monatomic + remaining_seconds
         
         return TrainWarning(end_monatomic, train.direction)
+
+    # warning_start_time is the time that train_passing_warning will start
+    # returning a warning for the train. See train_passing_warning for details.
+    def warning_start_time(self, train: TrainArrival):
+        return train.time - self._trainWarningSeconds -  (2 * train.std_dev)
+
+    # warning_timeline returns a WarningTimeline with the warning start,
+    # arrival and warning end events for all of the trains (the result of
+    # next_trains), with the same times as train_passing_warning but converted
+    # into time.monotonic() deadlines.
+    def warning_timeline(self, trains, monotonic_now=None):
+        if monotonic_now is None:
+            monotonic_now = time.monotonic()
+        offset = monotonic_now - self._now_seconds()
+
+        events = []
+        for train in trains:
+            if train is None:
+                continue
+            events.append((offset + self.warning_start_time(train), TimelineEvent.WARNING_START, train))
+            events.append((offset + train.time, TimelineEvent.ARRIVAL, train))
+            events.append((offset + train.time + (3 * train.std_dev), TimelineEvent.WARNING_END, train))
+        return WarningTimeline(events)
         
     # mark_train_arrived marks the train as arrived to ensure that it is
     # correctly filtered out from future next_trains calls and won't show up on
     # the board after we know it has arrived.
     def mark_train_arrived(self, train):
-        self._logger.debug(f"marking '{train.schedule_id}' as arrived")
+        self._logger.debug("marking '%s' as arrived", train.schedule_id)
         self._arrived_trains.add(train.schedule_id)
 
     # We use the MBTA schedule ID for a train arrival ID for simplicity.
@@ -244,31 +435,176 @@ class TrainPredictor:
     def clear_cache(self):
         self._arrived_trains.clear()
         self._train_prediction_cache.clear()
+        self._clear_conditional_request_cache()
+        self._daily_schedule = None
+        self._daily_schedule_date = None
+        self._daily_schedule_start = 0
 
 
     def _fetch_schedules_and_predictions(self):
+        return self._fetch_items(self._data_source_url())
+
+    # _fetch_items makes a request to the MBTA API and reads the response into
+    # a list of ScheduleItem. The schedule readers don't care what type of
+    # resource is in the response, for a /predictions response each item is a
+    # prediction (with the prediction attributes in item.schedule).
+    def _fetch_items(self, url):
         # When doing data analysis I ran into a few cases where the request to
         # the MBTA API appeared to stall and time out forever. So we want to
         # make sure we have a timeout here to make sure the request doesn't
         # totally stall.
         timeout = 10
-        response = self._network.fetch(DATA_SOURCE, headers=self._mbta_api_headers, timeout=timeout)
+        # Most of the time when we poll the MBTA API nothing has changed since
+        # the last time we asked. The MBTA API supports conditional requests
+        # (see https://www.mbta.com/developers/v3-api/best-practices#caching )
+        # so if we are asking for the same URL as last time we send along the
+        # Last-Modified / ETag validators from the last response. If nothing
+        # has changed the MBTA API responds with a 304 and an empty body and we
+        # can skip parsing entirely and just reuse the schedule items from last
+        # time. _compute_train still gets re-run on those items so trains that
+        # have passed by are still filtered out.
+        headers = self._mbta_api_headers
+        if url == self._cached_url and self._conditional_headers is not None:
+            headers = self._conditional_headers
+
+        response = self._network.fetch(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and self._cached_url == url:
+            self.not_modified_response_count += 1
+            response.close()
+            return self._cached_schedule_items
         if response.status_code is not 200:
             raise RuntimeError(f"Failed to fetch data from MBTA API. status_code: {response.status_code} response: {response.text}")
-        return response.json()
+
+        self.full_response_count += 1
+
+        # We need to grab the validators before reading the response because
+        # the reader closes the response when it is done.
+        last_modified = response.headers.get("last-modified")
+        etag = response.headers.get("etag")
+
+        # Drop the previous schedule items before reading the new response so
+        # we don't have both in memory at the same time.
+        self._clear_conditional_request_cache()
+        with self._profiler.phase("parse"):
+            schedule_items = self._schedule_reader.read(response)
+
+        if last_modified is not None or etag is not None:
+            self._cached_url = url
+            self._cached_schedule_items = schedule_items
+            self._conditional_headers = dict(self._mbta_api_headers)
+            if last_modified is not None:
+                self._conditional_headers["if-modified-since"] = last_modified
+            if etag is not None:
+                self._conditional_headers["if-none-match"] = etag
+
+        return schedule_items
+
+    # _daily_schedule_items returns the schedules from the daily schedule that
+    # we might care about, fetching the schedule first if we don't have one for
+    # the current service day.
+    # 
+    # We apply the same queryLookbackSeconds and queryPageLimit filters that
+    # _data_source_url asks the MBTA API to apply, so we don't compute trains
+    # for the whole day on every poll. Schedules are sorted by time so we can
+    # just skip over the ones at the start that are more than
+    # queryLookbackSeconds in the past, and we remember where we got to so we
+    # only ever look at each of them once.
+    def _daily_schedule_items(self):
+        if self._daily_schedule is None or self._daily_schedule_date != self._service_date_str():
+            self.refresh_schedule()
+
+        schedule = self._daily_schedule
+        earliest = seconds_from_datetime(self._nowFcn()) - self._queryLookbackSeconds
+        start = self._daily_schedule_start
+        while start < len(schedule):
+            scheduled_time = schedule[start].schedule.get("arrival_time") or schedule[start].schedule.get("departure_time")
+            if scheduled_time is not None and self._time_parser.seconds(scheduled_time) >= earliest:
+                break
+            start += 1
+        self._daily_schedule_start = start
+
+        if self._queryPageLimit is None:
+            return schedule[start:]
+        return schedule[start:start + self._queryPageLimit]
+
+    def _clear_conditional_request_cache(self):
+        self._cached_url = None
+        self._cached_schedule_items = None
+        self._conditional_headers = None
     
-    def _compute_train(self, schedule_id, schedule, prediction):
-        self._logger.debug(f"Computing '{schedule_id}'")
+    # _data_source_url builds the URL for the MBTA API request by adding filters
+    # to DATA_SOURCE so we only get back trains that we might care about.
+    # 
+    # The date and times that we filter on are in terms of the MBTA service
+    # day, see SERVICE_DAY_START_HOUR. So at 12:30am on 2025-10-23 we ask for
+    # filter[date]=2025-10-22 and times after "24:30". 
+    # 
+    # The schedule time filter applies to the SCHEDULED time of the train, but
+    # a train that is running late could still be on its way well after its
+    # scheduled time. So the min time is queryLookbackSeconds before now rather
+    # than now, _compute_train will filter out anything that has actually
+    # passed by.
+    # 
+    # queryWindowSeconds limits how far in the future we ask for trains, None
+    # means the rest of the service day. queryPageLimit limits the total number
+    # of trains returned, None means no limit.
+    def _data_source_url(self):
+        service_now = self._service_now()
+        service_minutes = (service_now.hour + SERVICE_DAY_START_HOUR) * 60 + service_now.minute
+
+        min_minutes = max(service_minutes - self._queryLookbackSeconds // 60, 0)
+        url = f"{self._dataSource}&" \
+            f"filter[date]={self._service_date_str(service_now)}&" \
+            f"filter[min_time]={self._service_time_str(min_minutes)}"
+
+        if self._queryWindowSeconds is not None:
+            # The window ends queryWindowSeconds after now (including the
+            # seconds that service_minutes leaves off), rounded up to the next
+            # minute so we don't miss a train in the last partial minute.
+            window_end_seconds = service_minutes * 60 + service_now.second + self._queryWindowSeconds
+            max_minutes = (window_end_seconds + 59) // 60
+            url += f"&filter[max_time]={self._service_time_str(max_minutes)}"
+
+        if self._queryPageLimit is not None:
+            url += f"&page[limit]={self._queryPageLimit}"
+
+        return url
+
+    def _service_now(self):
+        return self._nowFcn() - self._timedelta(hours=SERVICE_DAY_START_HOUR)
+
+    def _service_date_str(self, service_now=None):
+        if service_now is None:
+            service_now = self._service_now()
+        return f"{service_now.year:04d}-{service_now.month:02d}-{service_now.day:02d}"
+
+    @staticmethod
+    def _service_time_str(minutes):
+        hours, minutes = divmod(minutes, 60)
+        return f"{hours:02d}:{minutes:02d}"
+
+    def _now_seconds(self):
+        return seconds_from_datetime(self._nowFcn())
+
+    # _compute_train_time computes the arrival time (in seconds) at the
+    # Children's Museum of Franklin for a schedule, or None if it should be
+    # filtered out. now is the current time in seconds.
+    def _compute_train_time(self, schedule_id, schedule, prediction, now):
+        log_debug = self._log_debug
+        if log_debug:
+            self._logger.debug("Computing '%s'", schedule_id)
 
         # If we know the train has already arrived then ignore it
         if schedule_id in self._arrived_trains:
-            self._logger.debug(f"Filtering '{schedule_id}'. marked as arrived")
+            if log_debug:
+                self._logger.debug("Filtering '%s'. marked as arrived", schedule_id)
             return None
 
         direction = schedule.get("direction_id")
         cmf_arrival_time, time_is_from_prediction = self._get_estimated_cmf_arrival_time(schedule, prediction, direction)
         if cmf_arrival_time is None:
-            self._logger.debug(f"Filtering '{schedule_id}'. arrival not computed")
+            if log_debug:
+                self._logger.debug("Filtering '%s'. arrival not computed", schedule_id)
             return None
         
         # Remove any times more than self._filterResultsAfterSeconds (by default
@@ -277,15 +613,11 @@ class TrainPredictor:
         # mark_train_arrived to mark the train as already arrived, so we really
         # just need to deal with filtering out old trains from before the board
         # first starts up.
-        now = self._nowFcn()
-        if (cmf_arrival_time - now).total_seconds() < (-1 * self._filterResultsAfterSeconds):
-            self._logger.debug(f"Filtering '{schedule_id}'. arrival time ({cmf_arrival_time}) is in the past")
+        if cmf_arrival_time - now < (-1 * self._filterResultsAfterSeconds):
+            if log_debug:
+                self._logger.debug("Filtering '%s'. arrival time (%d) is in the past", schedule_id, cmf_arrival_time)
             return None
 
-        std_dev = self._inboundOffsetStdDev if direction == Direction.IN_BOUND else self._outboundOffsetStdDev
-
-        train = TrainArrival(schedule_id, cmf_arrival_time, direction, std_dev)
-
         # Outbound trains have a prediction time to arrive at the Children's
         # Museum of Franklin after it leaves the Franklin station. Unfortunately
         # as we noticed when analyzing data (see
@@ -301,22 +633,32 @@ class TrainPredictor:
         # I think that the Children's Museum of Franklin is close enough that
         # the time offsets won't ever have this happen. But just to be on the
         # safe side we will do some caching to prevent it. For a given schedule
-        # we will cache the train arrival object if the train arrival object was
-        # crated using prediction data.
+        # we will cache the arrival time if it was computed using prediction
+        # data.
         # 
-        # Then later if we see that the train arrival data is no logger from a
-        # prediction we will used the cached copy from the prediction if we have
+        # Then later if we see that the arrival time is no longer from a
+        # prediction we will use the cached time from the prediction if we have
         # it.
+        # 
+        # Once the predicted time is more than predictionCacheExpirySeconds in
+        # the past the train is long gone and the cached prediction expires.
+        # Otherwise on a busy day a cached prediction for a train that is still
+        # coming could get pushed out by predictions for trains that have
+        # already passed by.
         if time_is_from_prediction:
-            self._logger.debug(f"Inserting prediction for '{schedule_id}' into cache")
-            self._train_prediction_cache[schedule_id] = train
-        elif schedule_id in self._train_prediction_cache:
-            cached_train = self._train_prediction_cache[schedule_id]
-            self._logger.debug(f"Using cached prediction for '{schedule_id}'")
-            return cached_train
-
-        self._logger.debug(f"Using computed prediction for '{schedule_id}'")
-        return train
+            if log_debug:
+                self._logger.debug("Inserting prediction for '%s' into cache", schedule_id)
+            self._train_prediction_cache.set(schedule_id, cmf_arrival_time, cmf_arrival_time + self._predictionCacheExpirySeconds)
+        else:
+            cached_time = self._train_prediction_cache.get(schedule_id)
+            if cached_time is not None:
+                if log_debug:
+                    self._logger.debug("Using cached prediction for '%s'", schedule_id)
+                return cached_time
+
+        if log_debug:
+            self._logger.debug("Using computed prediction for '%s'", schedule_id)
+        return cmf_arrival_time
 
     def _get_estimated_cmf_arrival_time(self, schedule, prediction, direction):
         # Prefer using prediction data if possible
@@ -343,49 +685,92 @@ class TrainPredictor:
         # other time. This is since we still want to use prediction data over
         # using schedule or not coming up with an answer at all.
         #
-        # The values of _inboundOffsetAverage and _outboundOffsetAverage come
-        # from some data analysis that I did recording data from the MBTA API.
-        # See
+        # The values of _inboundOffsetAverageSeconds and
+        # _outboundOffsetAverageSeconds come from some data analysis that I did
+        # recording data from the MBTA API. See
         # https://github.com/anitschke/childrens-museum-franklin-train-board-data-analysis
         # for details.
 
         station_time_str = (arrival_time or departure_time) if direction == Direction.IN_BOUND else (departure_time or arrival_time)
-        station_time = self._datetime.fromisoformat(station_time_str).replace(tzinfo=None)
+        station_time = self._time_parser.seconds(station_time_str)
 
         # Since the Children's Museum of Franklin isn't exactly at the Franklin
         # station we need to apply an offset to station time to give a better
         # estimate of when the train will pass by Children's Museum of Franklin.
-        offset = self._inboundOffsetAverage if direction == Direction.IN_BOUND else self._outboundOffsetAverage
+        offset = self._inboundOffsetAverageSeconds if direction == Direction.IN_BOUND else self._outboundOffsetAverageSeconds
         cmf_time = station_time + offset
         return cmf_time
 
     def _analyze_data(self, count, schedule_json):
+        return self._analyze_items(count, JsonScheduleReader.items(schedule_json))
+
+    # _analyze_items computes the next count trains from a list of
+    # ScheduleItem. If prediction_table is provided then predictions are looked
+    # up in the table by trip rather than using the prediction in each item.
+    # 
+    # We only ever need the first count trains (and count is small) so rather
+    # than computing a train for every schedule and sorting them all we keep a
+    # small sorted buffer of the best count trains so far. The schedules are
+    # sorted by arrival time (see the sort query parameter of DATA_SOURCE and
+    # SCHEDULES_SOURCE) so once the buffer is full and we get to a schedule that
+    # arrives after the last train in the buffer (allowing for the prediction
+    # to be up to maxPredictionSkewSeconds earlier than the schedule, and for
+    # the offset to the Children's Museum of Franklin) then none of the
+    # remaining schedules can make it into the buffer either and we can stop
+    # computing trains.
+    # 
+    # The one exception is schedules without an arrival time (trains that
+    # start at the Franklin station). We don't know where the MBTA API sorts
+    # those so we still compute trains for them.
+    # 
+    # The buffer holds (time, schedule_id, direction) tuples, which are much
+    # smaller than a TrainArrival, and we only create TrainArrival objects for
+    # the trains that we return.
+    def _analyze_items(self, count, schedule_items, prediction_table=None):
         trains = []
-        included = {item["id"]: item for item in schedule_json.get("included", [])}
+        past_buffer = False
+        now = seconds_from_datetime(self._nowFcn())
+        self._log_debug = self._logger.isEnabledFor(_LOG_DEBUG)
 
-        # Build trains list
-        for item in schedule_json.get("data", []):
+        for item in schedule_items:
+            arrival_time = item.schedule.get("arrival_time")
+            if past_buffer and arrival_time is not None:
+                continue
 
-            # Get prediction if available
-            perdition = None 
-            prediction_ref = item.get("relationships", {}).get("prediction", {}).get("data")
-            if prediction_ref and prediction_ref.get("id") in included:
-                perdition = included[prediction_ref["id"]]["attributes"]
+            if not past_buffer and arrival_time is not None and count > 0 and len(trains) >= count and self._maxPredictionSkewSeconds is not None:
+                earliest_cmf_seconds = self._time_parser.seconds(arrival_time) - self._maxPredictionSkewSeconds + self._minOffsetAverageSeconds
+                if earliest_cmf_seconds > trains[-1][0]:
+                    past_buffer = True
+                    continue
 
-            # Compute the train object
-            schedule_attrs = item.get("attributes", {})
-            train = self._compute_train(item.get("id"), schedule_attrs, perdition)
-            if train is not None:
-                trains.append(train)
+            prediction = item.prediction if prediction_table is None else prediction_table.prediction_for_trip(item.trip_id)
+            train_time = self._compute_train_time(item.schedule_id, item.schedule, prediction, now)
+            if train_time is not None:
+                self._insert_train(trains, train_time, item.schedule_id, item.schedule.get("direction_id"), count)
 
-        # Sort the list
-        trains.sort(key=TrainArrival.sort_by_time)
+        trains = [self._train_arrival(*train) for train in trains]
 
         # We only need "count" times as we only display that many on the board. So we
-        # will trim or pad the array so we always have "count" values:
+        # will pad the array so we always have "count" values:
         while len(trains) < count:
             trains.append(None)
-        trains = trains[:count]
 
         return trains
-    
\ No newline at end of file
+
+    def _train_arrival(self, train_time, schedule_id, direction):
+        std_dev = self._inboundOffsetStdDevSeconds if direction == Direction.IN_BOUND else self._outboundOffsetStdDevSeconds
+        return TrainArrival(schedule_id, train_time, direction, std_dev)
+
+    # _insert_train inserts a train into the sorted list trains, keeping at
+    # most count trains. Trains with the same time stay in the order they were
+    # inserted in, the same as a stable sort.
+    @staticmethod
+    def _insert_train(trains, train_time, schedule_id, direction, count):
+        index = len(trains)
+        while index > 0 and trains[index - 1][0] > train_time:
+            index -= 1
+        if index >= count:
+            return
+        trains.insert(index, (train_time, schedule_id, direction))
+        if len(trains) > count:
+            trains.pop()
@@ -1,10 +1,13 @@
 from train_predictor import TrainPredictor, TrainPredictorDependencies, Direction, TrainWarning, TrainArrival
+from schedule_reader import JsonScheduleReader, StreamingScheduleReader
+from testing_extra import MockNetwork, StubMBTAServer, synthetic_schedule_json
+from time_conversion import seconds_from_datetime, datetime_from_seconds
 from datetime import datetime, timedelta
 import time
+import tracemalloc
 import json
 import os
 import unittest
-import urllib.request
 import logging
 
 mock_logger = logging.getLogger("mock")
@@ -12,6 +15,14 @@ mock_logger = logging.getLogger("mock")
 def datetime_from_iso_format(iso):
     return datetime.fromisoformat(iso).replace(tzinfo=None)
 
+def seconds_from_iso_format(iso):
+    return seconds_from_datetime(datetime_from_iso_format(iso))
+
+# as_datetime converts a TrainArrival time in seconds back into a datetime so
+# it is easier to read in assertions.
+def as_datetime(seconds):
+    return datetime_from_seconds(seconds, datetime)
+
 def mock_now_func(timeOfNow):
     return lambda : datetime_from_iso_format(timeOfNow)
 
@@ -21,37 +32,6 @@ def load_test_schedule_json(file):
     with open(file_path, 'r') as file:
         return json.load(file)
 
-class MockResponse:
-    def __init__(self, status_code, jsonResponse, textResponse):
-        self.status_code = status_code
-        self._jsonResponse = jsonResponse
-        self.text = textResponse
-
-    def json(self):
-        return self._jsonResponse
-
-class MockNetwork:
-    def add_json_content_type(self, type):
-        return
-    
-    # This fetch method is a test double that attempts to replicate the behavior
-    # of the circuit python portal base fetch method as so we can test out our
-    # code in CPython.
-    def fetch(self, url, headers = {}, timeout=30):
-        req = urllib.request.Request(url, headers=headers)
-
-        try:
-            with urllib.request.urlopen(req) as response:
-                data = response.read()
-                text = data.decode('utf-8')
-                jsonData = json.loads(text)
-                return MockResponse(response.status, jsonData, text)
-        except urllib.error.HTTPError as e:
-            data = e.read()
-            text = data.decode('utf-8')
-            jsonData = json.loads(text)
-            return MockResponse(e.code, jsonData, text)
-    
 class Test_next_trains(unittest.TestCase):
     def test_next_trains(self):
         # The goal of this test is to be a system level test that actually calls
@@ -60,13 +40,15 @@ class Test_next_trains(unittest.TestCase):
         # sure we can really analyze that real data.
 
         # When we provide the timestamp for "now" we will give the timestamp of
-        # 1am on the current morning. We will do this because if the test is
+        # 4am on the current morning. We will do this because if the test is
         # running late at night there is a chance that there are no more trains
         # tonight and the test expects that we will get some results back for
-        # the train. So setting the current time to 1am should ensure that we
-        # don't filter out trains that have already happened.
+        # the train. So setting the current time to 4am should ensure that we
+        # don't filter out trains that have already happened. Note that this
+        # needs to be after the start of the MBTA service day (3am) or else we
+        # would be asking for what is left of yesterday's trains.
         now = datetime.now()
-        mock_now = lambda : now.replace(tzinfo=None, hour=1)
+        mock_now = lambda : now.replace(tzinfo=None, hour=4, minute=0)
 
         deps = TrainPredictorDependencies(MockNetwork(), datetime, timedelta, mock_now, mbta_api_key=None, logger=mock_logger)
         train_predictor = TrainPredictor(deps)
@@ -75,14 +57,14 @@ class Test_next_trains(unittest.TestCase):
         self.assertEqual(len(results), 1)
         self.assertNotEqual(results[0], None)
         
-        # Since we said that we will test as if it is 1am we should be getting
+        # Since we said that we will test as if it is 4am we should be getting
         # the first train of the day. This is ALMOST always an inbound train
         # that happens a 5am. So lets verify it is inbound and happens before 8
         # am.
         self.assertEqual(results[0].direction, Direction.IN_BOUND)
 
         expected_time = now.replace(hour=8)
-        self.assertLess(results[0].time, expected_time)
+        self.assertLess(results[0].time, seconds_from_datetime(expected_time))
 
 class Test_fetch_schedules_and_predictions(unittest.TestCase):
     def test_fetch(self):
@@ -93,7 +75,7 @@ class Test_fetch_schedules_and_predictions(unittest.TestCase):
         # We will use Test_next_trains to connect together testing for
         # _fetch_schedules_and_predictions and _analyze_data to make sure we can
         # actually analyze data that is currently coming out of the API.
-        deps = TrainPredictorDependencies(MockNetwork(), datetime=None, timedelta=timedelta, nowFcn=None, mbta_api_key=None, logger=mock_logger)
+        deps = TrainPredictorDependencies(MockNetwork(), datetime=datetime, timedelta=timedelta, nowFcn=mock_now_func('2025-10-22T12:00:00'), mbta_api_key=None, logger=mock_logger)
         train_predictor = TrainPredictor(deps)
         train_predictor._fetch_schedules_and_predictions()
         
@@ -103,11 +85,501 @@ class Test_fetch_schedules_and_predictions(unittest.TestCase):
         # response that would be interpreted by the rest of the code as there
         # being no trains coming. This resulted in the board being blank.
         # Instead we should throw an error in this case.
-        deps = TrainPredictorDependencies(MockNetwork(), datetime=None, timedelta=timedelta, nowFcn=None, mbta_api_key="this_is_a_bad_API_key", logger=mock_logger)
+        deps = TrainPredictorDependencies(MockNetwork(), datetime=datetime, timedelta=timedelta, nowFcn=mock_now_func('2025-10-22T12:00:00'), mbta_api_key="this_is_a_bad_API_key", logger=mock_logger)
         train_predictor = TrainPredictor(deps)
         with self.assertRaisesRegex(RuntimeError, "Failed to fetch data from MBTA API. status_code: 403 response:"):
             train_predictor._fetch_schedules_and_predictions()
 
+class Test_data_source_url(unittest.TestCase):
+    def create_predictor(self, now, **kwargs):
+        deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=mock_now_func(now), mbta_api_key=None, logger=mock_logger)
+        return TrainPredictor(deps, dataSource="https://example.com/schedules?filter[stop]=place-FB-0275", **kwargs)
+
+    def test_afternoon(self):
+        train_predictor = self.create_predictor('2025-10-22T14:05:30', queryLookbackSeconds=3600, queryPageLimit=10)
+        self.assertEqual(train_predictor._data_source_url(),
+            "https://example.com/schedules?filter[stop]=place-FB-0275&filter[date]=2025-10-22&filter[min_time]=13:05&page[limit]=10")
+
+    def test_after_midnight(self):
+        # Between midnight and 3am trains are part of the previous service day
+        # and times are represented as hours past midnight of that day.
+        train_predictor = self.create_predictor('2025-10-23T00:30:00', queryLookbackSeconds=0, queryPageLimit=None)
+        self.assertEqual(train_predictor._data_source_url(),
+            "https://example.com/schedules?filter[stop]=place-FB-0275&filter[date]=2025-10-22&filter[min_time]=24:30")
+
+        train_predictor = self.create_predictor('2025-10-23T02:59:00', queryLookbackSeconds=0, queryPageLimit=None)
+        self.assertEqual(train_predictor._data_source_url(),
+            "https://example.com/schedules?filter[stop]=place-FB-0275&filter[date]=2025-10-22&filter[min_time]=26:59")
+
+    def test_start_of_service_day(self):
+        train_predictor = self.create_predictor('2025-10-23T03:00:00', queryLookbackSeconds=0, queryPageLimit=None)
+        self.assertEqual(train_predictor._data_source_url(),
+            "https://example.com/schedules?filter[stop]=place-FB-0275&filter[date]=2025-10-23&filter[min_time]=03:00")
+
+    def test_lookback_crosses_month(self):
+        train_predictor = self.create_predictor('2025-11-01T01:10:00', queryLookbackSeconds=7200, queryPageLimit=None)
+        self.assertEqual(train_predictor._data_source_url(),
+            "https://example.com/schedules?filter[stop]=place-FB-0275&filter[date]=2025-10-31&filter[min_time]=23:10")
+
+    def test_max_time(self):
+        train_predictor = self.create_predictor('2025-10-22T23:30:20', queryLookbackSeconds=600, queryWindowSeconds=7200, queryPageLimit=5)
+        self.assertEqual(train_predictor._data_source_url(),
+            "https://example.com/schedules?filter[stop]=place-FB-0275&filter[date]=2025-10-22&filter[min_time]=23:20&filter[max_time]=25:31&page[limit]=5")
+
+    def test_max_time_rounds_up_once(self):
+        # A window that ends right on a minute isn't widened, a window that
+        # ends part way through a minute is rounded up to the next minute.
+        train_predictor = self.create_predictor('2025-10-22T23:30:00', queryLookbackSeconds=600, queryWindowSeconds=7200, queryPageLimit=None)
+        self.assertTrue(train_predictor._data_source_url().endswith("&filter[max_time]=25:30"))
+        train_predictor = self.create_predictor('2025-10-22T23:30:00', queryLookbackSeconds=600, queryWindowSeconds=90, queryPageLimit=None)
+        self.assertTrue(train_predictor._data_source_url().endswith("&filter[max_time]=23:32"))
+
+class Test_server_side_filtering(unittest.TestCase):
+    # These tests run against StubMBTAServer which applies the same filters as
+    # the MBTA API so we can see how much data the filters save us.
+    def fetch_at(self, server, now, **kwargs):
+        network = MockNetwork()
+        deps = TrainPredictorDependencies(network, datetime, timedelta, mock_now_func(now), mbta_api_key=None, logger=mock_logger)
+        train_predictor = TrainPredictor(deps, dataSource=server.url, predictionsSource=None, **kwargs)
+        results = train_predictor.next_trains(count=3)
+
+        bytes_received = network.bytes_received
+
+        # Time how long it takes to parse and analyze the response. The request
+        # itself is made outside of the timing so we only measure the work done
+        # on the board.
+        parse_seconds = min(self.time_parse(train_predictor, network) for _ in range(5))
+        return results, bytes_received, parse_seconds
+
+    def time_parse(self, train_predictor, network):
+        response = network.fetch(train_predictor._data_source_url())
+        start = time.perf_counter()
+        train_predictor._analyze_items(3, train_predictor._schedule_reader.read(response))
+        return time.perf_counter() - start
+
+    def test_payload_shrinks_through_the_day(self):
+        days = {
+            "2025-10-22": synthetic_schedule_json(200, service_date="2025-10-22"),
+            "2025-10-23": synthetic_schedule_json(200, service_date="2025-10-23"),
+        }
+        with StubMBTAServer(days) as server:
+            sizes = []
+            parse_times = []
+            for now in ['2025-10-22T05:30:00', '2025-10-22T12:00:00', '2025-10-22T18:00:00', '2025-10-22T23:45:00']:
+                results, size, parse_seconds = self.fetch_at(server, now, queryPageLimit=None)
+                sizes.append(size)
+                parse_times.append(parse_seconds)
+
+                # We should always get trains after now.
+                self.assertIsNotNone(results[0])
+                self.assertGreater(results[0].time, seconds_from_iso_format(now) - 30)
+
+            for earlier, later in zip(sizes, sizes[1:]):
+                self.assertLess(later, earlier)
+            self.assertLess(sizes[-1], sizes[0] / 5)
+            self.assertLess(parse_times[-1], parse_times[0])
+
+    def test_after_midnight_uses_previous_service_day(self):
+        days = {
+            "2025-10-22": synthetic_schedule_json(200, service_date="2025-10-22", last_train="25:00"),
+            "2025-10-23": synthetic_schedule_json(200, service_date="2025-10-23"),
+        }
+        with StubMBTAServer(days) as server:
+            results, _, _ = self.fetch_at(server, '2025-10-23T00:30:00', queryLookbackSeconds=0)
+            self.assertEqual(server.requests[0]["filter[date]"], "2025-10-22")
+            self.assertEqual(server.requests[0]["filter[min_time]"], "24:30")
+
+            # The last few trains of the 2025-10-22 service day run after
+            # midnight, up until 1am.
+            self.assertIsNotNone(results[0])
+            self.assertGreaterEqual(results[0].time, seconds_from_iso_format('2025-10-23T00:30:00'))
+            self.assertLessEqual(results[0].time, seconds_from_iso_format('2025-10-23T01:01:00'))
+
+    def test_page_limit(self):
+        days = {"2025-10-22": synthetic_schedule_json(200, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            _, limited_size, _ = self.fetch_at(server, '2025-10-22T05:30:00', queryPageLimit=5)
+            _, unlimited_size, _ = self.fetch_at(server, '2025-10-22T05:30:00', queryPageLimit=None)
+            self.assertEqual(server.requests[0]["page[limit]"], "5")
+            self.assertLess(limited_size, unlimited_size / 10)
+
+# CountingScheduleReader wraps another schedule reader and counts how many
+# responses it has been asked to read.
+class CountingScheduleReader:
+    def __init__(self, reader):
+        self._reader = reader
+        self.read_count = 0
+
+    def read(self, response):
+        self.read_count += 1
+        return self._reader.read(response)
+
+class Test_conditional_requests(unittest.TestCase):
+    def create_predictor(self, server, now):
+        self.now = datetime_from_iso_format(now)
+        self.reader = CountingScheduleReader(JsonScheduleReader())
+        deps = TrainPredictorDependencies(MockNetwork(), datetime, timedelta, lambda: self.now, mbta_api_key=None, logger=mock_logger, schedule_reader=self.reader)
+        return TrainPredictor(deps, dataSource=server.url, predictionsSource=None)
+
+    def test_not_modified_skips_parse(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00')
+
+            first = train_predictor.next_trains(count=3)
+            self.assertEqual(self.reader.read_count, 1)
+            self.assertEqual(train_predictor.full_response_count, 1)
+            self.assertEqual(train_predictor.not_modified_response_count, 0)
+            self.assertNotIn("if-none-match", server.request_headers[0])
+
+            # Polling again a few seconds later the data hasn't changed so we
+            # should get a 304 and reuse the schedule items we already parsed.
+            self.now += timedelta(seconds=5)
+            second = train_predictor.next_trains(count=3)
+            self.assertEqual(self.reader.read_count, 1)
+            self.assertEqual(train_predictor.full_response_count, 1)
+            self.assertEqual(train_predictor.not_modified_response_count, 1)
+            self.assertEqual(server.not_modified_response_count, 1)
+            self.assertIn("if-none-match", server.request_headers[1])
+            self.assertIn("if-modified-since", server.request_headers[1])
+            self.assertEqual([t.schedule_id for t in first], [t.schedule_id for t in second])
+
+    def test_not_modified_still_filters_passed_trains(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00')
+            upcoming = train_predictor.next_trains(count=3)
+
+            # Poll right as the next train is passing by.
+            self.now = as_datetime(upcoming[0].time)
+            first = train_predictor.next_trains(count=3)
+            self.assertEqual(first[0].schedule_id, upcoming[0].schedule_id)
+            read_count = self.reader.read_count
+
+            # Then poll again after the train has passed, but within the same
+            # minute so the URL doesn't change. We should get a 304 but still
+            # filter out the train that has passed.
+            self.now = as_datetime(first[0].time + 31)
+            second = train_predictor.next_trains(count=3)
+            self.assertEqual(train_predictor.not_modified_response_count, 1)
+            self.assertEqual(self.reader.read_count, read_count)
+            self.assertEqual(second[0].schedule_id, first[1].schedule_id)
+
+    def test_modified_data_is_parsed(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00')
+            first = train_predictor.next_trains(count=3)
+
+            # Delay the next train by 10 minutes.
+            for item in days["2025-10-22"]["data"]:
+                if item["id"] == first[0].schedule_id:
+                    item["attributes"]["arrival_time"] = as_datetime(first[0].time + 600).isoformat() + "-04:00"
+                    item["attributes"]["departure_time"] = item["attributes"]["arrival_time"]
+            server.last_modified = "Wed, 22 Oct 2025 16:00:00 GMT"
+
+            second = train_predictor.next_trains(count=3)
+            self.assertEqual(self.reader.read_count, 2)
+            self.assertEqual(train_predictor.full_response_count, 2)
+            self.assertEqual(train_predictor.not_modified_response_count, 0)
+            self.assertEqual(second[0].schedule_id, first[0].schedule_id)
+            self.assertEqual(second[0].time, first[0].time + 600)
+
+    def test_new_url_is_unconditional(self):
+        # When the URL changes (every minute because of filter[min_time]) the
+        # validators from the last response don't apply.
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00')
+            train_predictor.next_trains(count=3)
+
+            self.now += timedelta(minutes=1)
+            train_predictor.next_trains(count=3)
+            self.assertNotIn("if-none-match", server.request_headers[1])
+            self.assertNotIn("if-modified-since", server.request_headers[1])
+            self.assertEqual(self.reader.read_count, 2)
+            self.assertEqual(train_predictor.full_response_count, 2)
+
+    def test_clear_cache(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00')
+            train_predictor.next_trains(count=3)
+            train_predictor.clear_cache()
+            train_predictor.next_trains(count=3)
+            self.assertNotIn("if-none-match", server.request_headers[1])
+            self.assertEqual(self.reader.read_count, 2)
+
+class Test_predictions_polling(unittest.TestCase):
+    # These tests run against StubMBTAServer with TrainPredictor fetching the
+    # daily schedule once and then only polling for predictions.
+    def create_predictor(self, server, now, schedule_reader=None, **kwargs):
+        self.now = datetime_from_iso_format(now)
+        self.network = MockNetwork()
+        deps = TrainPredictorDependencies(self.network, datetime, timedelta, lambda: self.now, mbta_api_key=None, logger=mock_logger, schedule_reader=schedule_reader)
+        kwargs.setdefault("predictionsSource", server.predictions_url)
+        return TrainPredictor(deps, schedulesSource=server.url, **kwargs)
+
+    def test_schedule_fetched_once(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T04:50:00')
+            train_predictor.refresh_schedule()
+            self.assertEqual(server.paths, ["/schedules"])
+            self.assertEqual(server.requests[0]["filter[date]"], "2025-10-22")
+            self.assertNotIn("filter[min_time]", server.requests[0])
+
+            for _ in range(5):
+                results = train_predictor.next_trains(count=3)
+                self.now += timedelta(seconds=5)
+            self.assertEqual(server.paths, ["/schedules"] + ["/predictions"] * 5)
+
+            # The first three trains have predictions one minute after their
+            # schedule, those are joined up by trip.
+            self.assertEqual(results[0].schedule_id, days["2025-10-22"]["data"][0]["id"])
+            self.assertEqual(results[0].time, seconds_from_iso_format('2025-10-22T05:01:00'))
+            for result, prediction in zip(results, days["2025-10-22"]["included"]):
+                self.assertEqual(result.time, seconds_from_iso_format(prediction["attributes"]["arrival_time"]))
+            self.assertEqual(results[1].schedule_id, days["2025-10-22"]["data"][1]["id"])
+            self.assertEqual(results[2].schedule_id, days["2025-10-22"]["data"][2]["id"])
+
+            # Polling for predictions is a conditional request since the URL
+            # never changes.
+            self.assertEqual(train_predictor.full_response_count, 1)
+            self.assertEqual(train_predictor.not_modified_response_count, 4)
+
+    def test_schedule_fetched_on_first_poll(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00')
+            results = train_predictor.next_trains(count=3)
+            self.assertEqual(server.paths, ["/schedules", "/predictions"])
+            self.assertGreater(results[0].time, seconds_from_datetime(self.now))
+
+    def test_new_service_day(self):
+        days = {
+            "2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22"),
+            "2025-10-23": synthetic_schedule_json(60, service_date="2025-10-23"),
+        }
+        with StubMBTAServer(days) as server:
+            # Trains after midnight are still part of the previous service day.
+            train_predictor = self.create_predictor(server, '2025-10-23T00:30:00')
+            results = train_predictor.next_trains(count=3)
+            self.assertEqual(server.requests[0]["filter[date]"], "2025-10-22")
+            self.assertEqual(results[0].time, seconds_from_iso_format('2025-10-23T00:40:00'))
+
+            # Even if the nightly tasks don't run we fetch the new schedule once
+            # the service day changes.
+            self.now = datetime_from_iso_format('2025-10-23T04:00:00')
+            server.predictions_date = "2025-10-23"
+            results = train_predictor.next_trains(count=3)
+            self.assertEqual(server.paths.count("/schedules"), 2)
+            self.assertEqual(server.requests[-2]["filter[date]"], "2025-10-23")
+            self.assertEqual(results[0].time, seconds_from_iso_format('2025-10-23T05:01:00'))
+
+    def test_clear_cache(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00')
+            train_predictor.next_trains(count=3)
+            train_predictor.clear_cache()
+            train_predictor.next_trains(count=3)
+            self.assertEqual(server.paths.count("/schedules"), 2)
+
+    def test_passed_schedules_are_skipped(self):
+        days = {"2025-10-22": synthetic_schedule_json(60, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            reader = StreamingScheduleReader()
+            train_predictor = self.create_predictor(server, '2025-10-22T12:00:00', schedule_reader=reader, queryLookbackSeconds=600, queryPageLimit=5)
+            items = train_predictor._daily_schedule_items()
+
+            # Like filter[min_time] and page[limit] we only look at schedules
+            # from 10 minutes ago on, and only 5 of them.
+            self.assertEqual(len(items), 5)
+            first_time = datetime_from_iso_format(items[0].schedule["arrival_time"])
+            self.assertGreaterEqual(first_time, self.now - timedelta(minutes=10))
+            self.assertLess(first_time, self.now + timedelta(minutes=21))
+
+    def test_bytes_and_parse_time_per_poll(self):
+        # Compare how much data we download and how long it takes to parse
+        # and analyze it for each poll when polling schedules and predictions
+        # together vs polling only predictions. This uses the
+        # StreamingScheduleReader since that is what runs on the board.
+        days = {"2025-10-22": synthetic_schedule_json(200, service_date="2025-10-22")}
+        with StubMBTAServer(days) as server:
+            combined = self.create_predictor(server, '2025-10-22T04:50:00', schedule_reader=StreamingScheduleReader(), dataSource=server.url, predictionsSource=None)
+            combined.next_trains(count=3)
+            combined_bytes = self.network.bytes_received
+            combined_parse = min(self.time_parse(combined, combined._data_source_url(), None) for _ in range(5))
+
+            predictions_only = self.create_predictor(server, '2025-10-22T04:50:00', schedule_reader=StreamingScheduleReader())
+            predictions_only.refresh_schedule()
+            schedule_bytes = self.network.bytes_received
+            predictions_only.next_trains(count=3)
+            predictions_bytes = self.network.bytes_received - schedule_bytes
+            table = predictions_only._polled_predictions
+            predictions_parse = min(self.time_parse(predictions_only, server.predictions_url, table) for _ in range(5))
+
+            self.assertLess(predictions_bytes, combined_bytes / 4)
+            self.assertLess(predictions_parse, combined_parse)
+
+    def time_parse(self, train_predictor, url, table):
+        response = self.network.fetch(url)
+        start = time.perf_counter()
+        items = train_predictor._schedule_reader.read(response)
+        if table is None:
+            train_predictor._analyze_items(3, items)
+        else:
+            table.load(items)
+            train_predictor._analyze_items(3, train_predictor._daily_schedule_items(), table)
+        return time.perf_counter() - start
+
+# CountingTrainPredictor counts how many trains _analyze_items computes.
+class CountingTrainPredictor(TrainPredictor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compute_count = 0
+
+    def _compute_train_time(self, schedule_id, schedule, prediction, now):
+        self.compute_count += 1
+        return super()._compute_train_time(schedule_id, schedule, prediction, now)
+
+class Test_top_k_selection(unittest.TestCase):
+    def create_predictor(self, now, **kwargs):
+        deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=mock_now_func(now), mbta_api_key=None, logger=mock_logger)
+        return CountingTrainPredictor(deps, inboundOffsetAverageSeconds=-63, outboundOffsetAverageSeconds=93, **kwargs)
+
+    # expected_trains is what _analyze_items used to do, compute every train,
+    # sort them all and then truncate.
+    def expected_trains(self, now, count, items):
+        train_predictor = self.create_predictor(now)
+        trains = []
+        for item in items:
+            train_time = train_predictor._compute_train_time(item.schedule_id, item.schedule, item.prediction, seconds_from_iso_format(now))
+            if train_time is not None:
+                trains.append(TrainArrival(item.schedule_id, train_time, item.schedule.get("direction_id"), 0))
+        trains.sort(key=TrainArrival.sort_by_time)
+        trains = trains[:count]
+        return [(t.schedule_id, t.time) for t in trains] + [None] * (count - len(trains))
+
+    def actual_trains(self, now, count, items, **kwargs):
+        trains = self.create_predictor(now, **kwargs)._analyze_items(count, items)
+        return [(t.schedule_id, t.time) if t is not None else None for t in trains]
+
+    def test_same_as_full_sort(self):
+        day = synthetic_schedule_json(200, service_date="2025-10-22", predicted_count=200)
+
+        # Make some predictions early and some very late so the predictions are
+        # out of order compared to the schedules.
+        for index, prediction in enumerate(day["included"]):
+            shift = [0, -5, 30, 2][index % 4]
+            time = datetime_from_iso_format(prediction["attributes"]["arrival_time"]) + timedelta(minutes=shift)
+            prediction["attributes"]["arrival_time"] = time.isoformat() + "-04:00"
+            prediction["attributes"]["departure_time"] = time.isoformat() + "-04:00"
+        items = JsonScheduleReader.items(day)
+
+        for now in ['2025-10-22T04:00:00', '2025-10-22T12:00:00', '2025-10-23T00:55:00', '2025-10-23T02:00:00']:
+            for count in [1, 3, 10]:
+                with self.subTest(now=now, count=count):
+                    self.assertEqual(self.actual_trains(now, count, items), self.expected_trains(now, count, items))
+
+    def test_fixtures(self):
+        for fixture in ['multiple_results.json', 'simple_inbound.json', 'simple_no_arrival_inbound.json', 'simple_outbound.json', 'data_array_empty.json']:
+            items = JsonScheduleReader.items(load_test_schedule_json(fixture))
+            for count in [0, 1, 3]:
+                with self.subTest(fixture=fixture, count=count):
+                    self.assertEqual(self.actual_trains('2025-10-22T04:06:00', count, items), self.expected_trains('2025-10-22T04:06:00', count, items))
+
+    def test_no_arrival_time_is_always_computed(self):
+        # Trains that start at the Franklin station don't have an arrival time
+        # and might not be sorted with the others.
+        day = synthetic_schedule_json(20, service_date="2025-10-22", predicted_count=0)
+        first = day["data"][0]
+        first["attributes"]["arrival_time"] = None
+        day["data"].append(day["data"].pop(0))
+        items = JsonScheduleReader.items(day)
+
+        actual = self.actual_trains('2025-10-22T04:00:00', 3, items)
+        self.assertEqual(actual, self.expected_trains('2025-10-22T04:00:00', 3, items))
+        self.assertEqual(actual[0][0], first["id"])
+
+    def test_work_proportional_to_count(self):
+        # Benchmark how many trains get computed for the next 3 trains as the
+        # number of trips in the day grows. Without early termination we
+        # compute a train for every trip.
+        compute_counts = {}
+        for trip_count in [50, 200, 1000]:
+            items = JsonScheduleReader.items(synthetic_schedule_json(trip_count, service_date="2025-10-22"))
+
+            train_predictor = self.create_predictor('2025-10-22T04:00:00', maxPredictionSkewSeconds=None)
+            train_predictor._analyze_items(3, items)
+            self.assertEqual(train_predictor.compute_count, trip_count)
+
+            train_predictor = self.create_predictor('2025-10-22T04:00:00')
+            train_predictor._analyze_items(3, items)
+            compute_counts[trip_count] = train_predictor.compute_count
+
+        # With a maxPredictionSkewSeconds of 10 minutes we compute at most the
+        # trains scheduled within 10 minutes of the third train. Even for
+        # 1000 trips (a train every 72 seconds) that is only a handful.
+        for trip_count, compute_count in compute_counts.items():
+            self.assertLessEqual(compute_count, 15, compute_counts)
+        self.assertLessEqual(compute_counts[1000], 1000 / 50, compute_counts)
+
+        # And it goes up with the number of trains we ask for.
+        items = JsonScheduleReader.items(synthetic_schedule_json(1000, service_date="2025-10-22"))
+        train_predictor = self.create_predictor('2025-10-22T04:00:00')
+        train_predictor._analyze_items(30, items)
+        self.assertGreater(train_predictor.compute_count, 30)
+        self.assertLess(train_predictor.compute_count, 50)
+
+# DictTrainArrival is what TrainArrival used to look like, a regular class
+# with datetime and timedelta attributes.
+class DictTrainArrival:
+    def __init__(self, schedule_id, time, direction, std_dev):
+        self.schedule_id = schedule_id
+        self.time = time
+        self.direction = direction
+        self.std_dev = std_dev
+
+class Test_compact_storage(unittest.TestCase):
+    # allocated returns the number of bytes still allocated by the objects
+    # that fcn creates.
+    def allocated(self, fcn):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            result = fcn()
+            return tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_per_100_trips(self):
+        day = synthetic_schedule_json(100, service_date="2025-10-22", predicted_count=100)
+        items = JsonScheduleReader.items(day)
+        times = [datetime_from_iso_format(item.prediction["arrival_time"]) for item in items]
+
+        # The schedule ids are shared with the parsed schedule so they aren't
+        # counted against either version.
+        dict_trains = self.allocated(lambda: [DictTrainArrival(item.schedule_id, time + timedelta(seconds=0), Direction.IN_BOUND, timedelta(seconds=9)) for item, time in zip(items, times)])
+        slot_trains = self.allocated(lambda: [TrainArrival(item.schedule_id, seconds_from_datetime(time), Direction.IN_BOUND, 9) for item, time in zip(items, times)])
+        buffer_entries = self.allocated(lambda: [(seconds_from_datetime(time), item.schedule_id, Direction.IN_BOUND) for item, time in zip(items, times)])
+        report = f"bytes per 100 trips: dict TrainArrival={dict_trains} __slots__ TrainArrival={slot_trains} buffer tuples={buffer_entries}"
+        self.assertLess(slot_trains, dict_trains * 3 / 4, report)
+        self.assertLess(buffer_entries, slot_trains, report)
+
+    def test_prediction_cache(self):
+        # The prediction cache only needs to hold the predicted time.
+        deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=mock_now_func('2025-10-22T04:00:00'), mbta_api_key=None, logger=mock_logger)
+        train_predictor = TrainPredictor(deps)
+        day = synthetic_schedule_json(100, service_date="2025-10-22", predicted_count=100)
+        trains = train_predictor._analyze_data(3, day)
+        self.assertGreater(len(train_predictor._train_prediction_cache), 0)
+        for schedule_id in train_predictor._train_prediction_cache:
+            self.assertIsInstance(train_predictor._train_prediction_cache[schedule_id], int)
+        self.assertIsInstance(trains[0], TrainArrival)
+        self.assertFalse(hasattr(trains[0], "__dict__"))
+
 class Test_analyze_data(unittest.TestCase):
     def test_simple_outbound(self):
         # Simple test with best case where we have both the schedule data and
@@ -127,8 +599,8 @@ class Test_analyze_data(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].schedule_id, "schedule-Sept8Read-768162-787-FB-0275-S-130")
         self.assertEqual(result[0].direction, Direction.OUT_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:05:11")
-        self.assertEqual(result[0].std_dev, timedelta(seconds=4321))
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:05:11")
+        self.assertEqual(result[0].std_dev, 4321)
 
     def test_simple_inbound(self):
         # Simple test with best case where we have both the schedule data and
@@ -148,8 +620,8 @@ class Test_analyze_data(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].schedule_id, "schedule-Sept8Read-768162-787-FB-0275-S-130")
         self.assertEqual(result[0].direction, Direction.IN_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:04:53")
-        self.assertEqual(result[0].std_dev, timedelta(seconds=1234))
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:04:53")
+        self.assertEqual(result[0].std_dev, 1234)
 
     def test_simple_outbound_positive_offset(self):
         # Simple test with best case where we have both the schedule data and
@@ -170,7 +642,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.OUT_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:05:21")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:05:21")
 
     def test_simple_inbound_positive_offset(self):
         # Simple test with best case where we have both the schedule data and
@@ -191,7 +663,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.IN_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:05:03")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:05:03")
 
     def test_simple_outbound_negative_offset(self):
         # Simple test with best case where we have both the schedule data and
@@ -212,7 +684,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.OUT_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:05:01")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:05:01")
 
     def test_simple_inbound_negative_offset(self):
         # Simple test with best case where we have both the schedule data and
@@ -233,7 +705,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.IN_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:04:43")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:04:43")
 
     def test_simple_sparse(self):
         # This is the same as test_simple but uses a sparse dataset. The MBTA
@@ -250,7 +722,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.OUT_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:05:11")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:05:11")
     
     def test_no_prediction_data_outbound(self):
         # When there is no prediction data in the JSON from the MBTA we should
@@ -265,7 +737,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.OUT_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:06:01")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:06:01")
 
     def test_no_prediction_data_inbound(self):
         # When there is no prediction data in the JSON from the MBTA we should
@@ -280,7 +752,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.IN_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:06:00")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:06:00")
 
     def test_no_departure_outbound(self):
         # Simple test with best case where we have both the schedule data and
@@ -302,7 +774,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.OUT_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:04:53")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:04:53")
 
 
     def test_no_arrival_inbound(self):
@@ -325,7 +797,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.IN_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:05:11")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:05:11")
 
 
     def test_multiple_data_request_one_result(self):
@@ -341,7 +813,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].direction, Direction.IN_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T05:06:00")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T05:06:00")
 
     def test_multiple_data_request_more_results(self):
         # There are two possible results that could be returned but three are
@@ -356,9 +828,9 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 3)
         self.assertEqual(result[0].direction, Direction.IN_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T05:06:00")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T05:06:00")
         self.assertEqual(result[1].direction, 0)
-        self.assertEqual(result[1].time.isoformat(), "2025-10-22T06:06:00")
+        self.assertEqual(as_datetime(result[1].time).isoformat(), "2025-10-22T06:06:00")
         self.assertEqual(result[2], None)
 
     def old_results_filtered(self):
@@ -374,7 +846,7 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data)
         self.assertEqual(len(result), 3)
         self.assertEqual(result[0].direction, Direction.OUT_BOUND)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T06:06:00-04:00")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T06:06:00-04:00")
         self.assertEqual(result[1], None)
         self.assertEqual(result[2], None)
 
@@ -452,13 +924,13 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data_no_prediction)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].schedule_id, schedule_id)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:06:00")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:06:00")
 
         # Then the train gets close by and we get a prediction from the MBTA API
         result = train_predictor._analyze_data(count, data_with_prediction)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].schedule_id, schedule_id)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:04:53")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:04:53")
 
         # Then the train departs the station and the prediction is removed from
         # the MBTA API response. We should use the last predicted time that we
@@ -466,7 +938,24 @@ class Test_analyze_data(unittest.TestCase):
         result = train_predictor._analyze_data(count, data_no_prediction)
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].schedule_id, schedule_id)
-        self.assertEqual(result[0].time.isoformat(), "2025-10-22T23:04:53")
+        self.assertEqual(as_datetime(result[0].time).isoformat(), "2025-10-22T23:04:53")
+
+    def test_cache_prediction_expires(self):
+        # Cached predictions expire predictionCacheExpirySeconds after the
+        # predicted arrival time.
+        now = [datetime_from_iso_format('2025-10-22T23:04:00')]
+        deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=lambda: now[0], mbta_api_key=None, logger=mock_logger)
+        train_predictor = TrainPredictor(deps, predictionCacheExpirySeconds=300)
+
+        schedule_id = "schedule-Sept8Read-768162-787-FB-0275-S-130"
+        train_predictor._analyze_data(1, load_test_schedule_json('simple_inbound.json'))
+        self.assertIn(schedule_id, train_predictor._train_prediction_cache)
+
+        now[0] = datetime_from_iso_format('2025-10-22T23:09:00')
+        self.assertIn(schedule_id, train_predictor._train_prediction_cache)
+        now[0] = datetime_from_iso_format('2025-10-22T23:10:00')
+        self.assertNotIn(schedule_id, train_predictor._train_prediction_cache)
+        self.assertEqual(len(train_predictor._train_prediction_cache), 0)
 
 class Test_train_passing_warning(unittest.TestCase):
     # For simplicity in these tests we will always use a trainWarningSeconds of one minutes and set "now" = 2025-10-22T02:00:00
@@ -480,7 +969,7 @@ class Test_train_passing_warning(unittest.TestCase):
     def test_train_is_far(self):
         # When a train is far away we should not return a warning for the train
         train_predictor = self.create_predictor()
-        train = TrainArrival("mockId", datetime_from_iso_format("2025-10-22T03:00:00"), Direction.IN_BOUND, std_dev=timedelta(seconds = 10))
+        train = TrainArrival("mockId", seconds_from_iso_format("2025-10-22T03:00:00"), Direction.IN_BOUND, std_dev=10)
         warning = train_predictor.train_passing_warning(train)
         self.assertIsNone(warning)
 
@@ -489,7 +978,7 @@ class Test_train_passing_warning(unittest.TestCase):
         train_predictor = self.create_predictor()
 
         monotonic_now = time.monotonic()
-        train = TrainArrival("mockId", datetime_from_iso_format("2025-10-22T02:00:30"), Direction.IN_BOUND, std_dev=timedelta(seconds = 10))
+        train = TrainArrival("mockId", seconds_from_iso_format("2025-10-22T02:00:30"), Direction.IN_BOUND, std_dev=10)
         warning = train_predictor.train_passing_warning(train)
         self.assertIsNotNone(warning)
         self.assertEqual(warning.direction, Direction.IN_BOUND)
@@ -510,11 +999,11 @@ class Test_train_passing_warning(unittest.TestCase):
         # now is 2025-10-22T02:00:00, trainWarningSeconds = 60, we are using std_dev fo 10.
         # 
         # So we expect the warning should be shown for an arrival time of 2025-10-22T02:01:20
-        train = TrainArrival("mockId", datetime_from_iso_format("2025-10-22T02:01:19"), Direction.IN_BOUND, std_dev=timedelta(seconds = 10))
+        train = TrainArrival("mockId", seconds_from_iso_format("2025-10-22T02:01:19"), Direction.IN_BOUND, std_dev=10)
         warning = train_predictor.train_passing_warning(train)
         self.assertIsNotNone(warning)
 
-        train = TrainArrival("mockId", datetime_from_iso_format("2025-10-22T02:01:21"), Direction.IN_BOUND, std_dev=timedelta(seconds = 10))
+        train = TrainArrival("mockId", seconds_from_iso_format("2025-10-22T02:01:21"), Direction.IN_BOUND, std_dev=10)
         warning = train_predictor.train_passing_warning(train)
         self.assertIsNone(warning)
 class Test_TrainArrival(unittest.TestCase):
@@ -527,11 +1016,11 @@ class Test_TrainArrival(unittest.TestCase):
 
     def test_sort_by_time(self):
         trains = [
-            TrainArrival("0", datetime_from_iso_format("2025-10-22T05:00:00"), Direction.IN_BOUND, 0),
-            TrainArrival("1", datetime_from_iso_format("2025-10-22T01:00:00"), Direction.IN_BOUND, 0),
-            TrainArrival("2", datetime_from_iso_format("2025-10-22T03:00:00"), Direction.IN_BOUND, 0),
-            TrainArrival("3", datetime_from_iso_format("2025-10-22T02:00:00"), Direction.IN_BOUND, 0),
-            TrainArrival("4", datetime_from_iso_format("2025-10-22T04:00:00"), Direction.IN_BOUND, 0),
+            TrainArrival("0", seconds_from_iso_format("2025-10-22T05:00:00"), Direction.IN_BOUND, 0),
+            TrainArrival("1", seconds_from_iso_format("2025-10-22T01:00:00"), Direction.IN_BOUND, 0),
+            TrainArrival("2", seconds_from_iso_format("2025-10-22T03:00:00"), Direction.IN_BOUND, 0),
+            TrainArrival("3", seconds_from_iso_format("2025-10-22T02:00:00"), Direction.IN_BOUND, 0),
+            TrainArrival("4", seconds_from_iso_format("2025-10-22T04:00:00"), Direction.IN_BOUND, 0),
         ]
 
         trains.sort(key=TrainArrival.sort_by_time)
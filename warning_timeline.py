@@ -0,0 +1,80 @@
+# TimelineEvent is the kind of event in a WarningTimeline.
+#
+# WARNING_START is when we should start showing the train warning animation
+# for a train, ARRIVAL is when we expect the train to pass by and WARNING_END
+# is when we know for sure the train has passed by and can stop showing the
+# warning. See TrainPredictor.train_passing_warning for how these are
+# computed.
+class TimelineEvent:
+    WARNING_START = 0
+    ARRIVAL = 1
+    WARNING_END = 2
+
+def _event_deadline(event):
+    return event[0]
+
+# WarningTimeline is a list of (monotonic deadline, TimelineEvent, train)
+# tuples for the upcoming trains, sorted by deadline. It is created by
+# TrainPredictor.warning_timeline every time we fetch new train arrival times.
+#
+# The main loop calls update() every time through the loop. We only ever need to
+# look at the event at the head of the list, so if nothing is due update() is
+# just a comparison. We keep an index to the next event rather than popping
+# events off of the front of the list so we don't need to shift the list or
+# allocate anything.
+#
+# Ideally this would be a heap (heapq), but heapq isn't available on
+# CircuitPython and all of the events are known up front so a list that we sort
+# once does the same job.
+#
+# The timeline also keeps track of which trains we are currently showing a
+# warning for. Normally that is at most one train, but an inbound and outbound
+# train can pass by at about the same time in which case their warnings
+# overlap. warning_direction is the direction of the train whose warning
+# started most recently, so when the first train's warning ends we keep showing
+# the warning for the other train until it has passed by too.
+class WarningTimeline:
+    def __init__(self, events=None):
+        self._events = [] if events is None else events
+        self._events.sort(key=_event_deadline)
+        self._next = 0
+        self._active = []
+
+    def __len__(self):
+        return len(self._events) - self._next
+
+    # peek returns the next event or None if there are no more events.
+    def peek(self):
+        if self._next >= len(self._events):
+            return None
+        return self._events[self._next]
+
+    # update processes every event whose deadline is at or before
+    # monotonic_now. arrivedFcn is called with each train once its warning has
+    # ended.
+    def update(self, monotonic_now, arrivedFcn=None):
+        while self._next < len(self._events):
+            deadline, event, train = self._events[self._next]
+            if deadline > monotonic_now:
+                return
+            self._next += 1
+
+            if event == TimelineEvent.WARNING_START:
+                self._active.append(train)
+            elif event == TimelineEvent.WARNING_END:
+                if train in self._active:
+                    self._active.remove(train)
+                if arrivedFcn is not None:
+                    arrivedFcn(train)
+
+    # warning_active is True if we are currently showing the warning for a
+    # train.
+    @property
+    def warning_active(self):
+        return len(self._active) > 0
+
+    @property
+    def warning_direction(self):
+        if not self._active:
+            return None
+        return self._active[-1].direction
@@ -0,0 +1,105 @@
+from warning_timeline import WarningTimeline, TimelineEvent
+from train_predictor import TrainPredictor, TrainPredictorDependencies, TrainArrival, Direction
+from time_conversion import seconds_from_datetime
+from datetime import datetime, timedelta
+import unittest
+import logging
+
+mock_logger = logging.getLogger("mock")
+
+NOW = datetime.fromisoformat('2025-10-22T12:00:00')
+
+def create_predictor():
+    deps = TrainPredictorDependencies(network=None, datetime=datetime, timedelta=timedelta, nowFcn=lambda: NOW, mbta_api_key=None, logger=mock_logger)
+    return TrainPredictor(deps, trainWarningSeconds=60)
+
+def train_in(schedule_id, seconds, direction, std_dev=10):
+    return TrainArrival(schedule_id, seconds_from_datetime(NOW) + seconds, direction, std_dev)
+
+class Test_WarningTimeline(unittest.TestCase):
+    def test_empty(self):
+        timeline = WarningTimeline()
+        self.assertIsNone(timeline.peek())
+        timeline.update(1000)
+        self.assertFalse(timeline.warning_active)
+        self.assertIsNone(timeline.warning_direction)
+
+    def test_events_are_sorted(self):
+        timeline = WarningTimeline([(30, TimelineEvent.WARNING_END, "a"), (10, TimelineEvent.WARNING_START, "a"), (20, TimelineEvent.ARRIVAL, "a")])
+        self.assertEqual(len(timeline), 3)
+        self.assertEqual(timeline.peek(), (10, TimelineEvent.WARNING_START, "a"))
+        timeline.update(25)
+        self.assertEqual(len(timeline), 1)
+        self.assertEqual(timeline.peek(), (30, TimelineEvent.WARNING_END, "a"))
+
+    def test_from_predictor(self):
+        # The deadlines are the same as the times used by
+        # train_passing_warning, just relative to monotonic_now.
+        train = train_in("a", 600, Direction.IN_BOUND)
+        timeline = create_predictor().warning_timeline([train, None, None], monotonic_now=1000)
+        events = []
+        while timeline.peek() is not None:
+            events.append(timeline.peek())
+            timeline.update(timeline.peek()[0])
+        self.assertEqual(events, [
+            (1000 + 600 - 60 - 20, TimelineEvent.WARNING_START, train),
+            (1000 + 600, TimelineEvent.ARRIVAL, train),
+            (1000 + 600 + 30, TimelineEvent.WARNING_END, train),
+        ])
+
+class Test_warning_simulation(unittest.TestCase):
+    # simulate steps through the timeline one second at a time like the main
+    # loop does and records which direction the warning is showing each second
+    # along with when each train is marked as arrived.
+    def simulate(self, trains, seconds):
+        timeline = create_predictor().warning_timeline(trains, monotonic_now=0)
+        arrived = []
+        directions = []
+        for now in range(seconds):
+            timeline.update(now, lambda train: arrived.append((now, train.schedule_id)))
+            directions.append(timeline.warning_direction)
+        return directions, arrived
+
+    def test_single_train(self):
+        directions, arrived = self.simulate([train_in("a", 300, Direction.IN_BOUND), None, None], 600)
+        self.assertEqual(set(directions[:220]), {None})
+        self.assertEqual(set(directions[220:330]), {Direction.IN_BOUND})
+        self.assertEqual(set(directions[330:]), {None})
+        self.assertEqual(arrived, [(330, "a")])
+
+    def test_overlapping_trains(self):
+        # An inbound and an outbound train pass by 60 seconds apart so their
+        # warnings overlap. Looking at only the first train (like we used to)
+        # the outbound warning would only start once the inbound warning ended.
+        trains = [
+            train_in("inbound", 300, Direction.IN_BOUND),
+            train_in("outbound", 360, Direction.OUT_BOUND),
+            train_in("later", 3600, Direction.IN_BOUND),
+        ]
+        directions, arrived = self.simulate(trains, 600)
+
+        # inbound: warning 220-330, outbound: warning 280-390
+        self.assertEqual(set(directions[:220]), {None})
+        self.assertEqual(set(directions[220:280]), {Direction.IN_BOUND})
+        self.assertEqual(set(directions[280:390]), {Direction.OUT_BOUND})
+        self.assertEqual(set(directions[390:]), {None})
+        self.assertEqual(arrived, [(330, "inbound"), (390, "outbound")])
+
+    def test_outbound_ends_first(self):
+        # If the second train's warning ends first we go back to showing the
+        # warning for the first train.
+        trains = [
+            train_in("inbound", 300, Direction.IN_BOUND, std_dev=60),
+            train_in("outbound", 320, Direction.OUT_BOUND, std_dev=0),
+        ]
+        directions, arrived = self.simulate(trains, 600)
+
+        # inbound: warning 120-480, outbound: warning 260-320
+        self.assertEqual(set(directions[120:260]), {Direction.IN_BOUND})
+        self.assertEqual(set(directions[260:320]), {Direction.OUT_BOUND})
+        self.assertEqual(set(directions[320:480]), {Direction.IN_BOUND})
+        self.assertEqual(set(directions[480:]), {None})
+        self.assertEqual(arrived, [(320, "outbound"), (480, "inbound")])
+
+if __name__ == '__main__':
+    unittest.main()